@@ -0,0 +1,96 @@
+import random, threading, time
+import timeline
+
+class FakeService:
+  """
+  Simulated remote service: every call waits latency_ms (plus up to jitter_ms) and is
+  rejected once more than rate calls per second (with burst headroom) come in.
+  """
+  def __init__(self, latency_ms=0.0, jitter_ms=0.0, rate=None, burst=None):
+    self.latency = latency_ms / 1000.0
+    self.jitter = jitter_ms / 1000.0
+    self.rate = rate
+    self.burst = float(burst or rate or 0)
+    self.throttled = 0
+    self._tokens = self.burst
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def admit(self):
+    """
+    Returns:
+      <bool> False when the call should be throttled.
+    """
+    if self.rate is None:
+      return True
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return True
+      self.throttled += 1
+      return False
+
+  def wait(self):
+    delay = self.latency + (random.random() * self.jitter if self.jitter else 0.0)
+    if delay:
+      time.sleep(delay)
+
+class FakeEmails:
+  """
+  Stand-in for PostmarkClient.emails that accepts every message without network calls.
+  """
+  def __init__(self, service=None):
+    self.calls = 0
+    self.messages = 0
+    self.service = service or FakeService()
+    self._lock = threading.Lock()
+
+  def send(self, **message):
+    return self.send_batch(message)[0]
+
+  def send_batch(self, *messages):
+    with self._lock:
+      self.calls += 1
+    self.service.wait()
+    if not self.service.admit():
+      from postmarker.exceptions import ClientError
+      raise ClientError("[429] Rate limit exceeded", error_code=429)
+    with self._lock:
+      self.messages += len(messages)
+    return [{"ErrorCode": 0, "Message": "OK", "To": message["To"]} for message in messages]
+
+class FakePostmark:
+  def __init__(self, latency_ms=0.0, jitter_ms=0.0, rate=None, burst=None):
+    self.emails = FakeEmails(FakeService(latency_ms, jitter_ms, rate, burst))
+
+class FakeScheduler(timeline.FakeScheduler):
+  """
+  timeline.FakeScheduler with simulated latency and throttling, counting the calls per method.
+  """
+  def __init__(self, latency_ms=0.0, jitter_ms=0.0, rate=None, burst=None):
+    super().__init__()
+    self.service = FakeService(latency_ms, jitter_ms, rate, burst)
+    self.calls = {}
+
+  def _call(self, method, kwargs):
+    with self._lock:
+      self.calls[method] = self.calls.get(method, 0) + 1
+    self.service.wait()
+    if not self.service.admit():
+      raise timeline.SchedulerError("ThrottlingException", "Rate exceeded")
+    return getattr(super(), method)(**kwargs)
+
+  def create_schedule(self, **kwargs):
+    return self._call("create_schedule", kwargs)
+
+  def update_schedule(self, **kwargs):
+    return self._call("update_schedule", kwargs)
+
+  def delete_schedule(self, **kwargs):
+    return self._call("delete_schedule", kwargs)
+
+  def get_schedule(self, **kwargs):
+    return self._call("get_schedule", kwargs)
@@ -0,0 +1,294 @@
+"""
+End to end load test of the order lambdas with fake Postmark and Scheduler services.
+Drives hacer-pedido with a stream of synthetic orders, then fires every schedule they
+created through the downstream handlers, advancing a simulated clock minute by minute.
+Reports orders per second, p50/p99 latency per handler, memory allocated per order and
+the external calls per order. Compare against a saved run to catch regressions.
+
+With --batch N the orders are submitted N at a time as NDJSON, the way partner
+integrations send them.
+
+Usage: python bench/load.py [--orders N] [--concurrency C] [--batch N] [--save FILE] [--baseline FILE]
+"""
+import argparse, importlib.util, json, os, random, statistics, sys, tempfile, time, tracemalloc, types
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS = os.path.join(ROOT, "lambdas")
+sys.path[:0] = [LAMBDAS, os.path.dirname(os.path.abspath(__file__))]
+
+# Handler file of every function targeted by a schedule
+HANDLERS = {
+  "orderCheckIn": "confirmar-estimado.py",
+  "orderSent": "pedido-enviado.py",
+  "orderDelivered": "pedido-entregado.py",
+  "orderFeedback": "feedback-pedido.py",
+}
+NAMES = ["Mariano", "Ana", "Lucía", "Jorge", "Itzel", "Diego", "Ximena", "Emiliano"]
+LAST_NAMES = ["Rodríguez", "López", "Hernández", "García", "Martínez", "Pérez"]
+COLONIES = ["Col. Santa Cruz Buenavista, Puebla", "Polanco, CDMX", "Col. Roma Norte, CDMX", "Centro, Oaxaca"]
+
+def setup_env(args, workdir):
+  env = {
+    "POSTMARK_API_TOKEN": "POSTMARK_API_TEST",
+    "AWS_DEFAULT_REGION": "us-west-2",
+    "EMAIL_FROM": "bot@example.com",
+    "RESTAURANT_EMAIL": "restaurant@example.com",
+    "DELIVERY_EMAIL": "delivery@example.com",
+    "LOG_LEVEL": "ERROR",
+    "OUTBOX_DB": os.path.join(workdir, "outbox.db"),
+    "OFFERS_DB": os.path.join(workdir, "offers.db"),
+    "FEEDBACK_DB": os.path.join(workdir, "feedback.db"),
+    "ORDER_STATE_DB": os.path.join(workdir, "orders.db"),
+    "ETA_DB": os.path.join(workdir, "eta.db"),
+    # Keep the metric lines of every invocation out of the report
+    "METRICS_SAMPLE_RATE": "0",
+  }
+  if not args.client_limits:
+    # Measure the code, not the client side rate limits of throttle.py
+    for provider in ("POSTMARK", "SCHEDULER"):
+      env[provider + "_RATE"] = env[provider + "_BURST"] = "1000000"
+  for key, value in env.items():
+    os.environ.setdefault(key, value)
+
+def load(filename):
+  spec = importlib.util.spec_from_file_location(filename.replace("-", "_")[:-3], os.path.join(LAMBDAS, filename))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def orders(count, seed):
+  """
+  Yield synthetic order events of menu items, each with its own idempotency key.
+  """
+  import menu
+  from decimal import Decimal
+  rng = random.Random(seed)
+  for index in range(count):
+    name = rng.choice(NAMES)
+    dishes = rng.sample(menu.MENU, rng.randint(1, 4))
+    quantities = [rng.choice([1, 1, 1, 2, 3]) for _ in dishes]
+    body = {
+      "nombre": name,
+      "apellido": rng.choice(LAST_NAMES),
+      "correo": "{}{}@example.com".format(name.lower(), index),
+      "pedido": ", ".join(dish["name"] if quantity == 1 else "{}x {}".format(quantity, dish["name"]) for dish, quantity in zip(dishes, quantities)),
+      "total": str(sum(Decimal(dish["price"]) * quantity for dish, quantity in zip(dishes, quantities))),
+      "direccion": rng.choice(COLONIES),
+    }
+    yield {"body": json.dumps(body), "headers": {"idempotency-key": "bench-{}-{}".format(seed, index)}}
+
+def batches(events, size):
+  """
+  Group order events into NDJSON bulk requests of up to size orders.
+  """
+  batch = []
+  for event in events:
+    batch.append(event["body"])
+    if len(batch) == size:
+      yield {"body": "\n".join(batch), "headers": {"content-type": "application/x-ndjson"}}
+      batch = []
+  if batch:
+    yield {"body": "\n".join(batch), "headers": {"content-type": "application/x-ndjson"}}
+
+def percentile(samples, fraction):
+  ordered = sorted(samples)
+  if not ordered:
+    return 0.0
+  return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def timed(handler, samples):
+  """
+  Wrap a handler to time it, turning its exceptions into a 500 response so one broken
+  handler does not stop the run.
+  """
+  def call(event, context):
+    start = time.perf_counter()
+    try:
+      return handler(event, context)
+    except Exception as error:
+      return {"statusCode": 500, "error": repr(error)}
+    finally:
+      samples.append((time.perf_counter() - start) * 1000)
+  return call
+
+def status(result):
+  if isinstance(result, dict):
+    return result.get("statusCode")
+  try:
+    return json.loads(result)["statusCode"]
+  except (TypeError, ValueError, KeyError):
+    return None
+
+def order_statuses(result):
+  """
+  Returns:
+    <list> with the status of every order of a response, one for a single order.
+  """
+  try:
+    return [order["statusCode"] for order in json.loads(result["body"])["orders"]]
+  except (TypeError, ValueError, KeyError):
+    return [status(result)]
+
+def run(args):
+  import clients, outbox, timeline
+  from fakes import FakePostmark, FakeScheduler
+  intake = load("hacer-pedido.py")
+  postmark = FakePostmark(args.postmark_latency_ms, args.jitter_ms, args.postmark_rate)
+  scheduler = FakeScheduler(args.scheduler_latency_ms, args.jitter_ms, args.scheduler_rate)
+  clients.override(postmark=postmark, scheduler=scheduler)
+
+  latencies = {"hacer-pedido": []}
+  handlers = {}
+  for function, filename in HANDLERS.items():
+    samples = latencies.setdefault(filename[:-3], [])
+    handlers[intake.LAMBDA_ARN.format(function)] = timed(load(filename).lambda_handler, samples)
+  if intake.NOTIFICATION_ROUTER:
+    handlers[intake.LAMBDA_ARN.format(intake.NOTIFICATION_ROUTER)] = timed(load("enrutar-notificaciones.py").lambda_handler, latencies.setdefault("enrutar-notificaciones", []))
+  dispatcher = load("despachar-linea.py")
+  handlers[intake.LAMBDA_ARN.format(timeline.DISPATCHER_FUNCTION)] = timed(
+    lambda event, context: dispatcher.lambda_handler(event, context, client=clients.scheduler()),
+    latencies.setdefault("despachar-linea", []))
+
+  context = types.SimpleNamespace(aws_request_id="bench", invoked_function_arn="arn:local")
+  handle = timed(intake.lambda_handler, latencies["hacer-pedido"])
+  statuses = {}
+
+  # Intake
+  started = time.perf_counter()
+  with ThreadPoolExecutor(args.concurrency) as pool:
+    events = orders(args.orders, args.seed)
+    if args.batch > 1:
+      events = batches(events, args.batch)
+    for result in pool.map(lambda event: handle(event, context), events):
+      for code in order_statuses(result):
+        statuses[code] = statuses.get(code, 0) + 1
+  if intake.SIDE_EFFECTS == "outbox":
+    outbox.default_flusher().drain()
+  intake_seconds = time.perf_counter() - started
+
+  # Downstream, firing the schedules as the simulated clock moves on
+  now = int(time.time())
+  downstream = 0
+  errors = {}
+  for minute in range(args.minutes + 1):
+    if len(scheduler.schedules) == len(scheduler.fired):
+      break
+    for result in scheduler.run_due(handlers, now + minute * 60):
+      downstream += 1
+      code = status(result)
+      if code not in (None, 200):
+        errors.setdefault(code, result.get("error") if isinstance(result, dict) else None)
+        statuses["downstream {}".format(code)] = statuses.get("downstream {}".format(code), 0) + 1
+
+  report = {
+    "orders": args.orders,
+    "orders_per_sec": args.orders / intake_seconds,
+    "statuses": statuses,
+    "downstream_invocations": downstream,
+    "pending_schedules": len(scheduler.schedules) - len(scheduler.fired),
+    "downstream_errors": {str(code): error for code, error in errors.items()},
+    "latency_ms": {
+      name: {"p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99), "count": len(samples)}
+      for name, samples in latencies.items() if samples
+    },
+    "calls_per_order": {
+      "postmark": postmark.emails.calls / args.orders,
+      "emails": postmark.emails.messages / args.orders,
+      **{method: count / args.orders for method, count in sorted(scheduler.calls.items())},
+    },
+    "throttled": {"postmark": postmark.emails.service.throttled, "scheduler": scheduler.service.throttled},
+  }
+  if args.memory_orders:
+    report["memory"] = memory(handle, context, args)
+  return report
+
+def memory(handle, context, args):
+  """
+  Trace the allocations of a sequential run of extra orders.
+  """
+  events = list(orders(args.memory_orders, args.seed + 1))
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  tracemalloc.reset_peak()
+  for event in events:
+    handle(event, context)
+  _, peak = tracemalloc.get_traced_memory()
+  after = tracemalloc.take_snapshot()
+  tracemalloc.stop()
+  stats = after.compare_to(before, "filename")
+  retained = sum(stat.size_diff for stat in stats)
+  blocks = sum(stat.count_diff for stat in stats)
+  return {
+    "peak_kib": peak / 1024,
+    "retained_kib_per_order": retained / 1024 / len(events),
+    "retained_blocks_per_order": blocks / len(events),
+  }
+
+def regressions(report, baseline, tolerance):
+  """
+  Returns:
+    <list> with a message for every metric worse than the baseline beyond the tolerance.
+  """
+  found = []
+  if report["orders_per_sec"] < baseline["orders_per_sec"] * (1 - tolerance):
+    found.append("orders/sec {:.1f} < {:.1f}".format(report["orders_per_sec"], baseline["orders_per_sec"]))
+  for name, stats in report["latency_ms"].items():
+    previous = baseline["latency_ms"].get(name)
+    if previous and stats["p99"] > previous["p99"] * (1 + tolerance):
+      found.append("{} p99 {:.2f}ms > {:.2f}ms".format(name, stats["p99"], previous["p99"]))
+  for name, calls in report["calls_per_order"].items():
+    if calls > baseline["calls_per_order"].get(name, 0) * (1 + tolerance):
+      found.append("{} calls per order {:.2f} > {:.2f}".format(name, calls, baseline["calls_per_order"].get(name, 0)))
+  memory, previous = report.get("memory"), baseline.get("memory")
+  if memory and previous and memory["retained_kib_per_order"] > previous["retained_kib_per_order"] * (1 + tolerance) + 0.5:
+    found.append("retained {:.2f}KiB per order > {:.2f}KiB".format(memory["retained_kib_per_order"], previous["retained_kib_per_order"]))
+  return found
+
+def show(report):
+  print("orders: {orders}  orders/sec: {orders_per_sec:.1f}  statuses: {statuses}".format(**report))
+  print("downstream invocations: {downstream_invocations}  pending schedules: {pending_schedules}".format(**report))
+  for code, error in report["downstream_errors"].items():
+    print("downstream {}: {}".format(code, error))
+  print("{:<24}{:>10}{:>10}{:>10}".format("handler", "count", "p50_ms", "p99_ms"))
+  for name, stats in report["latency_ms"].items():
+    print("{:<24}{:>10}{:>10.2f}{:>10.2f}".format(name, stats["count"], stats["p50"], stats["p99"]))
+  print("calls per order: " + "  ".join("{}={:.2f}".format(name, calls) for name, calls in report["calls_per_order"].items()))
+  print("throttled: " + "  ".join("{}={}".format(name, count) for name, count in report["throttled"].items()))
+  if "memory" in report:
+    print("memory: peak {peak_kib:.1f}KiB  retained {retained_kib_per_order:.2f}KiB / {retained_blocks_per_order:.1f} blocks per order".format(**report["memory"]))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--orders", type=int, default=500, help="synthetic orders to submit")
+  parser.add_argument("--concurrency", type=int, default=8, help="orders submitted in parallel")
+  parser.add_argument("--batch", type=int, default=1, help="orders per bulk request, 1 for single order requests")
+  parser.add_argument("--minutes", type=int, default=240, help="most simulated minutes to fire the schedules")
+  parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic orders")
+  parser.add_argument("--postmark-latency-ms", type=float, default=0.0)
+  parser.add_argument("--postmark-rate", type=float, help="Postmark calls per second before throttling")
+  parser.add_argument("--scheduler-latency-ms", type=float, default=0.0)
+  parser.add_argument("--scheduler-rate", type=float, help="Scheduler calls per second before throttling")
+  parser.add_argument("--client-limits", action="store_true", help="keep the production client side rate limits")
+  parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra latency of every fake call")
+  parser.add_argument("--memory-orders", type=int, default=100, help="orders traced with tracemalloc, 0 to skip")
+  parser.add_argument("--save", help="write the report as JSON to this file")
+  parser.add_argument("--baseline", help="report of a previous run to compare with")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+  args = parser.parse_args()
+  with tempfile.TemporaryDirectory() as workdir:
+    setup_env(args, workdir)
+    report = run(args)
+  show(report)
+  if args.save:
+    with open(args.save, "w") as file:
+      json.dump(report, file, indent=2)
+  if args.baseline:
+    with open(args.baseline) as file:
+      found = regressions(report, json.load(file), args.tolerance)
+    for message in found:
+      print("REGRESSION: " + message, file=sys.stderr)
+    sys.exit(1 if found else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,65 @@
+"""
+Benchmark of the order line-item parser against the menu index.
+Generates free text orders with quantities, accents dropped, typos and items that
+are not on the menu, then reports orders and items parsed per second, on a cold
+lookup cache and on a warm one, and the share of lines matched.
+
+Usage: python bench/menu_parse.py [--orders N] [--typos RATE]
+"""
+import argparse, os, random, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "lambdas")]
+
+import menu
+
+UNKNOWN = ["Sushi roll", "Hamburguesa doble", "Ensalada César"]
+
+def typo(rng, text):
+  index = rng.randrange(len(text))
+  return text[:index] + text[index + 1:]
+
+def orders(count, typos, seed):
+  """
+  Returns:
+    <list> of free text orders and the expected number of lines of each.
+  """
+  rng = random.Random(seed)
+  names = [item["name"] for item in menu.MENU] + [alias for item in menu.MENU for alias in item["aliases"]]
+  generated = []
+  for _ in range(count):
+    lines = []
+    for _ in range(rng.randint(1, 5)):
+      name = rng.choice(UNKNOWN) if rng.random() < 0.02 else rng.choice(names)
+      if rng.random() < typos:
+        name = typo(rng, name)
+      if rng.random() < 0.3:
+        name = name.lower()
+      quantity = rng.choice(["", "", "", "2x ", "3 ", "2 x "])
+      lines.append(quantity + name)
+    generated.append(", ".join(lines))
+  return generated
+
+def run(index, texts):
+  started = time.perf_counter()
+  parsed = [index.parse(text) for text in texts]
+  return time.perf_counter() - started, parsed
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--orders", type=int, default=20000)
+  parser.add_argument("--typos", type=float, default=0.1, help="share of item names with a typo")
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+  texts = orders(args.orders, args.typos, args.seed)
+  index = menu.MenuIndex(menu.MENU)
+  for label in ("cold cache", "warm cache"):
+    elapsed, parsed = run(index, texts)
+    lines = sum(len(order.lines) for order in parsed)
+    matched = sum(1 for order in parsed for line in order.lines if line.item)
+    print("{:<12}{:>12.0f} orders/s{:>12.0f} items/s   matched {:.1%}".format(label, len(texts) / elapsed, lines / elapsed, matched / lines))
+  info = index.lookup.cache_info()
+  print("lookup cache: {} entries, {:.1%} hits".format(info.currsize, info.hits / (info.hits + info.misses)))
+
+if __name__ == "__main__":
+  main()
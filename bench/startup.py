@@ -0,0 +1,102 @@
+"""
+Cold start benchmark for the five order lambdas.
+Each handler runs in a fresh interpreter, measuring the module import, the creation of
+the real Postmark and Scheduler clients, and the first and second (warm) invocations
+with network calls replaced by fakes.
+
+Usage: python bench/startup.py [--runs N]
+"""
+import argparse, importlib.util, json, os, statistics, subprocess, sys, tempfile, time, types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS = os.path.join(ROOT, "lambdas")
+sys.path[:0] = [LAMBDAS, os.path.dirname(os.path.abspath(__file__))]
+
+ORDER = {
+  "nombre": "Mariano",
+  "apellido": "Rodríguez",
+  "correo": "mariano@example.com",
+  "pedido": "Pizza Margarita, Coca-Cola regular, Brownie",
+  "total": "148.25",
+  "direccion": "Col. Santa Cruz Buenavista, Puebla"
+}
+EVENTS = {
+  "hacer-pedido.py": {"body": json.dumps(ORDER)},
+  "confirmar-estimado.py": {"order_id": "1", "from_email": "AjoloEats <bot@example.com>", "restaurant_email": "r@example.com", "restaurant_name": "El Ajolote Frito", "expected_pickup": "01:00 PM"},
+  "pedido-enviado.py": {"order_id": "1", "from_email": "AjoloEats <bot@example.com>", "client_email": "c@example.com", "client_name": "Mariano", "expected_delivery": "01:10 PM"},
+  "pedido-entregado.py": {"order_id": "1", "from_email": "AjoloEats <bot@example.com>", "client_email": "c@example.com"},
+  "feedback-pedido.py": {"order_id": "1", "from_email": "AjoloEats <bot@example.com>", "client_email": "c@example.com", "client_name": "Mariano"},
+}
+# Handlers whose result is cached by idempotency key
+IDEMPOTENT = {"hacer-pedido.py"}
+# Handlers that talk to the scheduler
+SCHEDULES = {"hacer-pedido.py"}
+
+def event(filename, invocation):
+  """
+  Each invocation of an idempotent handler gets its own key, otherwise the warm call
+  would only measure the cached answer.
+  """
+  event = dict(EVENTS[filename])
+  if filename in IDEMPOTENT:
+    event["headers"] = {"idempotency-key": "startup-{}-{}".format(os.getpid(), invocation)}
+  return event
+
+def child(filename):
+  started = time.perf_counter()
+  spec = importlib.util.spec_from_file_location("handler", os.path.join(LAMBDAS, filename))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  imported = time.perf_counter()
+  import clients, timeline
+  from fakes import FakePostmark
+  clients.postmark()
+  if filename in SCHEDULES:
+    clients.scheduler()
+  built = time.perf_counter()
+  clients.override(postmark=FakePostmark(), scheduler=timeline.FakeScheduler())
+  context = types.SimpleNamespace(aws_request_id="12345678-0000", invoked_function_arn="arn:local")
+  invocations = []
+  for invocation in range(2):
+    payload = event(filename, invocation)
+    start = time.perf_counter()
+    try:
+      module.lambda_handler(payload, context)
+    except Exception as error:
+      print("{} raised {!r}".format(filename, error), file=sys.stderr)
+    invocations.append(time.perf_counter() - start)
+  print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "clients_ms": (built - imported) * 1000,
+    "first_ms": invocations[0] * 1000,
+    "warm_ms": invocations[1] * 1000
+  }))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per handler")
+  parser.add_argument("--child", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child:
+    return child(args.child)
+  env = dict(os.environ)
+  env.setdefault("POSTMARK_API_TOKEN", "POSTMARK_API_TEST")
+  env.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+  # The stores shared between the lambdas, on a local directory instead of EFS
+  workdir = tempfile.mkdtemp(prefix="ajoloeats-startup-")
+  env.setdefault("ORDER_STATE_DB", os.path.join(workdir, "orders.db"))
+  env.setdefault("OFFERS_DB", os.path.join(workdir, "offers.db"))
+  env.setdefault("FEEDBACK_DB", os.path.join(workdir, "feedback.db"))
+  env.setdefault("ETA_DB", os.path.join(workdir, "eta.db"))
+  columns = ("import_ms", "clients_ms", "first_ms", "warm_ms")
+  print("{:<24}".format("handler") + "".join("{:>12}".format(column) for column in columns))
+  for filename in EVENTS:
+    samples = []
+    for _ in range(args.runs):
+      output = subprocess.run([sys.executable, __file__, "--child", filename], env=env, capture_output=True, text=True, check=True)
+      samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    medians = [statistics.median(sample[column] for sample in samples) for column in columns]
+    print("{:<24}".format(filename) + "".join("{:>12.1f}".format(value) for value in medians))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,111 @@
+import base64, logging, os, time
+from urllib.parse import parse_qsl
+import tracing
+import offers, order_state, responses, stages, templates
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Stage each confirmation link records, and the answer to the courier
+CONFIRMATIONS = {
+  "pickup": (order_state.PICKED_UP, "Recolección registrada."),
+  "deliver": (order_state.DELIVERED, "Entrega registrada."),
+}
+
+# Question and button of the page each link opens
+QUESTIONS = {
+  "accept": ("¿Aceptas la entrega del pedido #{}?", "Aceptar entrega"),
+  "decline": ("¿Rechazas la entrega del pedido #{}?", "Rechazar entrega"),
+  "pickup": ("¿Recogiste el pedido #{} en el restaurante?", "Confirmar recolección"),
+  "deliver": ("¿Entregaste el pedido #{} al cliente?", "Confirmar entrega"),
+}
+
+def request_method(event):
+  """
+  Returns:
+    <string> with the HTTP method of a REST or HTTP API event, None for a scheduled one.
+  """
+  method = event.get("httpMethod") or (event.get("requestContext") or {}).get("http", {}).get("method")
+  return method.upper() if method else None
+
+def form(event):
+  """
+  Returns:
+    <Dict> with the fields of a form posted as application/x-www-form-urlencoded.
+  """
+  body = event.get("body") or ""
+  if event.get("isBase64Encoded"):
+    body = base64.b64decode(body).decode("utf-8", "replace")
+  return dict(parse_qsl(body))
+
+def confirmation_page(order_id, courier_id, action, token):
+  """
+  Returns:
+    <string> with the page asking the courier to confirm the action of a link.
+  """
+  question, button = QUESTIONS[action]
+  return templates.render(
+    "link_confirmation", title=button, question=question.format(order_id), button=button,
+    order_id=order_id, courier_id=courier_id, action=action, token=token
+  )
+
+@tracing.handler("asignar-repartidor")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Takes the answer of a courier to a delivery offer, from the links of the offer email
+  (query string with order, courier, action and token), or the courier confirming the
+  pickup and the delivery with the same links (action pickup or deliver), whose times
+  teach the stage estimates. Every link is signed for its own action, and only the
+  courier assigned to the order can confirm it. Opening a link (GET) only shows a page asking to confirm,
+  the action happens when its form is posted (POST), so mail scanners that follow the
+  links change nothing. Without a query string it
+  escalates the offers that timed out, meant to run on a rate schedule, the only
+  place waves expire.
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the API Gateway response, the confirmation page or a JSON status message.
+  """
+  engine = offers.default_engine()
+  method = request_method(event)
+  query = dict(event.get("queryStringParameters") or {})
+  if method == "POST":
+    query.update(form(event))
+  if not query:
+    with tracing.span("expire"):
+      engine.reload()
+      escalated = engine.expire()
+    return responses.body(200, {"escalated": escalated})
+  order_id, courier_id, action = query.get("order"), query.get("courier"), query.get("action")
+  if action not in QUESTIONS or not order_id or not courier_id or not offers.verify(order_id, courier_id, action, query.get("token")):
+    return responses.body(403, {"message": "Invalid offer link."})
+  if method != "POST":
+    return responses.page(200, confirmation_page(order_id, courier_id, action, query["token"]))
+  if action in CONFIRMATIONS:
+    state, message = CONFIRMATIONS[action]
+    store = order_state.default_store()
+    with tracing.span("confirm"):
+      assigned = store.courier(order_id)
+      if assigned != courier_id:
+        return responses.body(404 if assigned is None else 403, {"message": "El pedido no está asignado a este repartidor."})
+      recorded = store.confirm(order_id, state, at=time.time())
+    if recorded:
+      stages.confirmed(order_id, state, courier_id)
+    return responses.body(200 if recorded else 409, {"message": message if recorded else "El pedido ya estaba registrado en esa etapa."})
+  with tracing.span("respond"):
+    outcome = engine.respond(order_id, courier_id, action == "accept")
+    if outcome == "assigned":
+      # Only the assigned courier can confirm the pickup and the delivery
+      order_state.default_store().assign(order_id, courier_id)
+  messages = {
+    "assigned": "¡La entrega es tuya!",
+    "taken": "La entrega ya fue asignada a otro repartidor.",
+    "declined": "Rechazaste la entrega."
+  }
+  return responses.body(409 if outcome == "taken" else 200, {"outcome": outcome, "message": messages[outcome]})
@@ -0,0 +1,31 @@
+import logging, os
+import tracing
+import timing_wheel
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+@tracing.handler("avanzar-rueda")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Ticks the timing wheel of SCHEDULER_BACKEND=wheel, sending the notifications of
+  every schedule due. Meant to run on a rate(1 minute) schedule, with WHEEL_PATH on
+  storage shared with the functions creating the schedules (e.g. an EFS mount).
+  Parameters:
+    event: <Dict> with the Lambda function event data, optionally the epoch seconds to tick to ("now").
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the number of schedules fired and the failures per target.
+  """
+  with tracing.span("tick"):
+    fired, failures = timing_wheel.tick(now=event.get("now"), context=context)
+  return {
+    "statusCode": 200 if not failures else 502,
+    "fired": fired,
+    "failures": failures
+  }
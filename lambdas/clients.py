@@ -0,0 +1,103 @@
+import os, threading
+
+# Load env
+POSTMARK_TOKEN = os.environ.get('POSTMARK_API_TOKEN')
+SCHEDULER_BACKEND = os.environ.get('SCHEDULER_BACKEND', 'eventbridge')
+POSTMARK_URL = os.environ.get('POSTMARK_URL', 'https://api.postmarkapp.com')
+WARM_UP = os.environ.get('WARM_UP_CONNECTIONS', '0')
+
+# Clients are built on first use and reused across warm invocations, so a cold start
+# only pays for the imports and clients the invocation actually needs.
+_clients = {}
+_lock = threading.Lock()
+
+def _get(name, build):
+  client = _clients.get(name)
+  if client is None:
+    with _lock:
+      client = _clients.get(name)
+      if client is None:
+        client = _clients[name] = build()
+  return client
+
+def _build_postmark():
+  from postmarker.core import PostmarkClient
+  import transport
+  client = PostmarkClient(server_token=POSTMARK_TOKEN)
+  # postmarker builds its own session lazily; hand it the pooled keep-alive one instead
+  client._session = transport.session()
+  return client
+
+def _build_dispatcher():
+  from email_dispatch import EmailDispatcher
+  return EmailDispatcher(postmark())
+
+# Scheduler calls go through the shared rate limiter, see throttle.py
+SCHEDULER_METHODS = {"create_schedule", "update_schedule", "delete_schedule", "get_schedule"}
+
+def _throttled_scheduler(client):
+  import throttle
+  return throttle.ThrottledClient(client, throttle.provider("scheduler"), SCHEDULER_METHODS)
+
+def _build_scheduler():
+  if SCHEDULER_BACKEND == "wheel":
+    import timing_wheel
+    return _throttled_scheduler(timing_wheel.shared())
+  import boto3, transport
+  client = boto3.client("scheduler", config=transport.botocore_config())
+  return _throttled_scheduler(transport.instrument_boto(client))
+
+def postmark():
+  """
+  Returns:
+    <PostmarkClient> shared by the process.
+  """
+  return _get("postmark", _build_postmark)
+
+def dispatcher():
+  """
+  Returns:
+    <EmailDispatcher> batching every email sent by the process.
+  """
+  return _get("dispatcher", _build_dispatcher)
+
+def scheduler():
+  """
+  Returns:
+    The EventBridge Scheduler client, or the local timing wheel when SCHEDULER_BACKEND is "wheel".
+  """
+  return _get("scheduler", _build_scheduler)
+
+def override(**clients):
+  """
+  Replace the shared clients, e.g. with fakes for local runs and benchmarks.
+  A scheduler override is still rate limited like the real client.
+  Parameters:
+    clients: <Dict> with postmark, dispatcher and/or scheduler instances.
+  """
+  if "scheduler" in clients:
+    clients["scheduler"] = _throttled_scheduler(clients["scheduler"])
+  with _lock:
+    _clients.update(clients)
+
+def warm_up(connections=None):
+  """
+  Build the clients and open the Postmark connections ahead of the first request.
+  Parameters:
+    connections: <int> with the connections to open, defaults to WARM_UP_CONNECTIONS.
+  Returns:
+    <int> with the connections opened.
+  """
+  import transport
+  connections = int(WARM_UP if connections is None else connections)
+  scheduler()
+  client = postmark()
+  session = getattr(client, "_session", None)
+  if not connections or session is None:
+    return 0
+  return transport.warm(session, POSTMARK_URL, connections)
+
+# Handshakes during the Lambda init phase run on the init CPU boost and overlap the
+# rest of the imports, instead of landing on the first invocation.
+if WARM_UP != '0':
+  threading.Thread(target=warm_up, daemon=True).start()
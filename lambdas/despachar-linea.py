@@ -0,0 +1,49 @@
+import logging, os, time
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+import clients, timeline
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+ROLE_ARN = os.environ.get('SCHEDULER_ROLE_ARN', "arn:aws:iam::833307389424:role/AllowLambdasRole")
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Worker pool to run the steps of many orders at once
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+@tracing.handler("despachar-linea")
+def lambda_handler(event, context, client=None):
+  """
+  Lambda handler function
+  Runs the due steps of one order timeline and moves its schedule to the next step.
+  Every order keeps its own schedule, so EventBridge invokes this once per firing;
+  the "timelines" batch form is for callers that collect due timelines themselves,
+  such as a backfill or the local schedulers.
+  Parameters:
+    event: <Dict> with order_id and steps, or with a "timelines" list of them and
+      optionally the epoch seconds to run them at ("now").
+    context: Lambda runtime context.
+    client: EventBridge Scheduler client, defaults to the shared one.
+  Returns:
+    <Dict> with the number of timelines processed and the failed steps per order.
+  """
+  client = client or clients.scheduler()
+  timelines = event["timelines"] if "timelines" in event else [event]
+  now = event.get("now", int(time.time()))
+  with tracing.span("steps"):
+    results = timeline.run_due(timelines, context, now, executor)
+  failures = {}
+  for result in results:
+    if result["failures"]:
+      failures[result["order_id"]] = result["failures"]
+    with tracing.span("advance"):
+      timeline.advance(client, result, context.invoked_function_arn, ROLE_ARN, now)
+  return {
+    "statusCode": 200,
+    "timelines": len(results),
+    "failures": failures
+  }
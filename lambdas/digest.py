@@ -0,0 +1,60 @@
+import os
+import templates
+
+# Load env
+MODE = os.environ.get('DIGEST_MODE', 'off')
+QUIET_SECONDS = float(os.environ.get('DIGEST_QUIET_SECONDS', '60'))
+MAX_WAIT_SECONDS = float(os.environ.get('DIGEST_MAX_WAIT_SECONDS', '30'))
+MAX_ORDERS = int(os.environ.get('DIGEST_MAX_ORDERS', '10'))
+
+# Restaurant notifications are coalesced per restaurant inbox when MODE is "on":
+# the first order after QUIET_SECONDS without any goes out right away, the next ones
+# wait at most MAX_WAIT_SECONDS, or until MAX_ORDERS are waiting, and leave together
+# as a single kitchen ticket.
+
+HEADINGS = {
+  "new_order": ("¡Nuevos Pedidos Recibidos!", "Has recibido {} pedidos nuevos:"),
+  "check_in": ("¡Recordatorio de pedidos por entregar!", "Te recordamos que estos {} pedidos deben estar listos para recogerse:"),
+}
+
+def enabled():
+  return MODE == "on"
+
+def due(pending, first_due, last_order, now, quiet=QUIET_SECONDS, max_wait=MAX_WAIT_SECONDS, max_orders=MAX_ORDERS):
+  """
+  When a new notification of a restaurant should be sent.
+  Parameters:
+    pending: <int> with the notifications of the restaurant already waiting.
+    first_due: <float> with the timestamp the waiting ones are due at, None when none wait.
+    last_order: <float> with the timestamp of the previous notification, None for the first one.
+    now: <float> with the current timestamp.
+  Returns:
+    <float> with the timestamp the new one and every waiting one are due at.
+  """
+  if pending + 1 >= max_orders:
+    return now
+  if pending:
+    return first_due
+  if last_order is None or last_order <= now - quiet:
+    return now
+  return now + max_wait
+
+def ticket(kind, restaurant, orders):
+  """
+  Render the consolidated ticket of the notifications waiting for a restaurant.
+  Parameters:
+    kind: <string> with the notification coalesced, "new_order" or "check_in".
+    restaurant: <string> with the restaurant name.
+    orders: <list> of <Dict> with the order_id, expected_pickup and items (HTML) of every order.
+  Returns:
+    <tuple> with the subject and body of the email.
+  """
+  heading, intro = HEADINGS[kind]
+  subject = "{} - {} pedidos".format(heading.strip("¡!"), len(orders))
+  # The items were rendered by items_table, possibly before a trip through the outbox
+  rows = templates.Markup("".join(
+    templates.render("ticket_order", order_id=order["order_id"], expected_pickup=order["expected_pickup"], items=templates.Markup(order.get("items", "")))
+    for order in orders
+  ))
+  body = templates.render("kitchen_ticket", title=subject, heading=heading, restaurant=restaurant, intro=intro.format(len(orders)), rows=rows)
+  return subject, body
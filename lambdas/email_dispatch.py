@@ -0,0 +1,146 @@
+import logging, os, threading, time
+from concurrent.futures import Future
+import throttle, tracing
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+BATCH_WINDOW_MS = int(os.environ.get('EMAIL_BATCH_WINDOW_MS', '0'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Postmark accepts up to 500 messages per batch request
+MAX_BATCH_SIZE = 500
+
+class EmailError(Exception):
+  """
+  Raised for a message that Postmark rejected inside a batch.
+  """
+  def __init__(self, message, error_code):
+    super().__init__("[{}] {}".format(error_code, message))
+    self.error_code = error_code
+
+class EmailDispatcher:
+  """
+  Coalesce the emails produced by one or more concurrent invocations and send them
+  through the Postmark batch endpoint.
+  Queued messages leave together when the caller flushes, so the emails of an order
+  or of a batch of events go in a single HTTP request. With a window, messages are
+  also held for that long after the first one arrives, to coalesce the emails of
+  concurrent invocations; without one (the default) a lone send goes out at once.
+  Each message gets a Future with its own outcome.
+  """
+  def __init__(self, postmark, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH_SIZE):
+    """
+    Parameters:
+      postmark: <PostmarkClient> with the client instantiation of Postmark.
+      window_ms: <int> with the milliseconds to wait for more messages before flushing,
+        0 to only send on flush() or send().
+      max_batch: <int> with the maximum number of messages per batch request.
+    """
+    self.postmark = postmark
+    self.window = window_ms / 1000
+    self.max_batch = max_batch
+    self._lock = threading.Lock()
+    self._pending = []
+    self._timer = None
+
+  def enqueue(self, receiver, subject, body, sender):
+    """
+    Queue an email for the next batch.
+    Parameters:
+      receiver: <list> with the recipients (TO) of the email.
+      subject: <string> with the subject of the email.
+      body: <string> with the body of the email.
+      sender: <string> with the sender (FROM) of the email.
+    Returns:
+      <Future> resolved with the Postmark response for this message.
+    """
+    future = Future()
+    message = {
+      "From": sender,
+      "To": receiver,
+      "Subject": subject,
+      "HtmlBody": body,
+    }
+    with self._lock:
+      self._pending.append((message, future))
+      full = len(self._pending) >= self.max_batch
+      if not full and self.window and self._timer is None:
+        self._timer = threading.Timer(self.window, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+    if full:
+      self.flush()
+    return future
+
+  def send(self, receiver, subject, body, sender):
+    """
+    Queue an email and wait until its batch has been sent.
+    Parameters:
+      Same as enqueue.
+    Returns:
+      <Dict> with the Postmark response for this message.
+    """
+    future = self.enqueue(receiver, subject, body, sender)
+    if not self.window:
+      self.flush()
+    try:
+      return future.result()
+    finally:
+      tracing.add("postmark", getattr(future, "postmark_ms", 0.0))
+
+  def flush(self):
+    """
+    Send every pending message, MAX_BATCH_SIZE at a time.
+    Returns:
+      <list> with one (message, response or exception) tuple per message sent.
+    """
+    with self._lock:
+      pending, self._pending = self._pending, []
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+    results = []
+    for start in range(0, len(pending), self.max_batch):
+      results.extend(self._send_batch(pending[start:start + self.max_batch]))
+    return results
+
+  def _send_batch(self, batch):
+    messages = [message for message, _ in batch]
+    started = time.perf_counter()
+    try:
+      responses = throttle.provider("postmark").call(self.postmark.emails.send_batch, *messages)
+    except Exception as error:
+      self._elapsed(batch, started)
+      logger.error("Batch of %s emails failed: %s", len(batch), error)
+      for _, future in batch:
+        future.set_exception(error)
+      return [(message, error) for message in messages]
+    self._elapsed(batch, started)
+    results = []
+    if len(responses) != len(batch):
+      logger.error("Postmark answered %s of a batch of %s emails", len(responses), len(batch))
+    for (message, future), response in zip(batch, responses):
+      if response.get("ErrorCode", 0) != 0:
+        error = EmailError(response.get("Message"), response["ErrorCode"])
+        logger.error("Email to %s rejected: %s", message["To"], error)
+        future.set_exception(error)
+        results.append((message, error))
+      else:
+        future.set_result(response)
+        results.append((message, response))
+    # Messages without a response of their own fail rather than wait forever
+    for message, future in batch[len(responses):]:
+      error = EmailError("No response from Postmark for this message", -1)
+      future.set_exception(error)
+      results.append((message, error))
+    return results
+
+  @staticmethod
+  def _elapsed(batch, started):
+    # Time spent on Postmark, read by send() for the tracing of its invocation
+    elapsed = (time.perf_counter() - started) * 1000
+    for _, future in batch:
+      future.postmark_ms = elapsed
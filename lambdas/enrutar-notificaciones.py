@@ -0,0 +1,32 @@
+import logging, os
+import tracing
+import stages
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+@tracing.handler("enrutar-notificaciones")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Single entry point for every order lifecycle notification. Dispatches on the
+  "event_type" field (check_in, order_sent, order_delivered or feedback) and accepts
+  a batch of mixed events under "events", sent together.
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with status message and the failures per event.
+  """
+  events = event["events"] if "events" in event else [event]
+  results = stages.notify_batch(events)
+  failures = {index: error for index, error in enumerate(results) if error is not None}
+  return {
+    "statusCode": 200 if not failures else 502,
+    "sent": len(events) - len(failures),
+    "failures": failures
+  }
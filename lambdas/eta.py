@@ -0,0 +1,359 @@
+import logging, math, os, sqlite3, threading, time
+from collections import deque
+from datetime import timedelta
+from functools import lru_cache
+import menu
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Corrections shared by the lambdas that see the confirmations and hacer-pedido, which
+# estimates; without it the estimates are not corrected
+DB_PATH = os.environ.get('ETA_DB')
+REFRESH_SECONDS = float(os.environ.get('ETA_REFRESH_SECONDS', '60'))
+SPEED_KMH = float(os.environ.get('ETA_SPEED_KMH', '20'))
+ROAD_FACTOR = float(os.environ.get('ETA_ROAD_FACTOR', '1.3'))
+DEFAULT_DISTANCE_KM = float(os.environ.get('ETA_DEFAULT_DISTANCE_KM', '5'))
+HANDOFF_MINUTES = float(os.environ.get('ETA_HANDOFF_MINUTES', '3'))
+DEFAULT_PREP_MINUTES = float(os.environ.get('ETA_DEFAULT_PREP_MINUTES', '10'))
+PARALLEL_PREP = float(os.environ.get('ETA_PARALLEL_PREP', '0.25'))
+CHECK_IN_LEAD_MINUTES = float(os.environ.get('ETA_CHECK_IN_LEAD_MINUTES', '3'))
+FEEDBACK_DELAY_MINUTES = float(os.environ.get('ETA_FEEDBACK_DELAY_MINUTES', '3'))
+LOAD_WINDOW_MINUTES = float(os.environ.get('ETA_LOAD_WINDOW_MINUTES', '15'))
+KITCHEN_CAPACITY = int(os.environ.get('ETA_KITCHEN_CAPACITY', '6'))
+MAX_LOAD_FACTOR = float(os.environ.get('ETA_MAX_LOAD_FACTOR', '3'))
+MIN_SAMPLES = int(os.environ.get('ETA_MIN_SAMPLES', '20'))
+SAFETY_SIGMAS = float(os.environ.get('ETA_SAFETY_SIGMAS', '1.0'))
+VECTOR_MIN_POINTS = int(os.environ.get('ETA_VECTOR_MIN_POINTS', '32'))
+
+EARTH_RADIUS_KM = 6371.0
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Delivery zones: centroid and the words of an address that place it in the zone
+ZONES = {
+  "polanco": {"location": (19.4333, -99.1950), "keywords": ["polanco"]},
+  "anzures": {"location": (19.4290, -99.1790), "keywords": ["anzures"]},
+  "lomas": {"location": (19.4240, -99.2160), "keywords": ["lomas de chapultepec", "lomas"]},
+  "roma": {"location": (19.4195, -99.1600), "keywords": ["roma norte", "roma sur", "roma"]},
+  "condesa": {"location": (19.4110, -99.1730), "keywords": ["condesa", "hipodromo"]},
+  "juarez": {"location": (19.4270, -99.1580), "keywords": ["juarez", "reforma"]},
+  "centro": {"location": (19.4326, -99.1332), "keywords": ["centro historico", "centro"]},
+  "narvarte": {"location": (19.3960, -99.1530), "keywords": ["narvarte"]},
+  "del_valle": {"location": (19.3850, -99.1650), "keywords": ["del valle"]},
+  "coyoacan": {"location": (19.3467, -99.1617), "keywords": ["coyoacan"]},
+  "santa_fe": {"location": (19.3590, -99.2590), "keywords": ["santa fe"]},
+}
+RESTAURANT_ZONE = os.environ.get('ETA_RESTAURANT_ZONE', 'polanco')
+
+@lru_cache(maxsize=None)
+def _numpy():
+  """
+  Returns:
+    The numpy module when it is packaged with the function, None otherwise. Imported
+    on the first batch large enough to vectorise, never during the init phase.
+  """
+  try:
+    import numpy
+  except ImportError:
+    return None
+  return numpy
+
+def haversine(lat1, lon1, lat2, lon2, vectorise=True):
+  """
+  Great circle distances, element-wise over sequences of coordinates in degrees.
+  Parameters:
+    vectorise: <bool> False to skip numpy, e.g. for a one-off table.
+  Returns:
+    Sequence with the kilometers between every pair of points.
+  """
+  numpy = _numpy() if vectorise and len(lat1) >= VECTOR_MIN_POINTS else None
+  if numpy is not None:
+    lat1, lon1, lat2, lon2 = (numpy.radians(numpy.asarray(values, dtype=float)) for values in (lat1, lon1, lat2, lon2))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(a))
+  distances = []
+  for a1, o1, a2, o2 in zip(lat1, lon1, lat2, lon2):
+    a1, o1, a2, o2 = map(math.radians, (a1, o1, a2, o2))
+    a = math.sin((a2 - a1) / 2) ** 2 + math.cos(a1) * math.cos(a2) * math.sin((o2 - o1) / 2) ** 2
+    distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a)))
+  return distances
+
+class ZoneMatrix:
+  """
+  Road kilometers between every pair of zones, computed once from their centroids.
+  """
+  def __init__(self, zones=ZONES, road_factor=ROAD_FACTOR):
+    self.names = list(zones)
+    self.index = {name: position for position, name in enumerate(self.names)}
+    self.keywords = sorted(
+      ((menu.normalize(keyword), name) for name, zone in zones.items() for keyword in zone["keywords"]),
+      key=lambda pair: -len(pair[0])
+    )
+    points = [zones[name]["location"] for name in self.names]
+    pairs = [(a, b) for a in points for b in points]
+    distances = haversine(*zip(*(a + b for a, b in pairs)), vectorise=False)
+    size = len(points)
+    self.km = [[float(distances[row * size + column]) * road_factor for column in range(size)] for row in range(size)]
+
+  def zone(self, address):
+    """
+    Returns:
+      <string> with the zone named in the address, or None.
+    """
+    words = " {} ".format(menu.normalize(address))
+    for keyword, name in self.keywords:
+      if " {} ".format(keyword) in words:
+        return name
+    return None
+
+  def distance(self, origin, destination):
+    """
+    Returns:
+      <float> with the road kilometers between two zones, DEFAULT_DISTANCE_KM for unknown ones.
+    """
+    if origin not in self.index or destination not in self.index:
+      return DEFAULT_DISTANCE_KM
+    return self.km[self.index[origin]][self.index[destination]]
+
+class RollingStats:
+  """
+  Exponentially weighted mean and variance of a series.
+  """
+  __slots__ = ("alpha", "count", "mean", "variance")
+
+  def __init__(self, alpha=0.1, count=0, mean=0.0, variance=0.0):
+    self.alpha = alpha
+    self.count = count
+    self.mean = mean
+    self.variance = variance
+
+  def observe(self, value):
+    self.count += 1
+    if self.count == 1:
+      self.mean = value
+      return
+    delta = value - self.mean
+    self.mean += self.alpha * delta
+    self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+
+  def upper(self, sigmas=SAFETY_SIGMAS):
+    return self.mean + sigmas * math.sqrt(self.variance)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS corrections (
+  stage TEXT NOT NULL,
+  key TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  mean REAL NOT NULL,
+  variance REAL NOT NULL,
+  PRIMARY KEY (stage, key)
+);
+"""
+
+class CorrectionStore:
+  """
+  Rolling ratios of actual to estimated durations kept in SQLite, a local stand-in for
+  a shared table: asignar-repartidor writes them as couriers confirm, hacer-pedido
+  reads them to estimate. An unknown zone is stored under the empty key.
+  """
+  def __init__(self, path=DB_PATH):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.executescript(SCHEMA)
+    self._lock = threading.Lock()
+
+  def observe(self, stage, key, ratio):
+    """
+    Add a ratio to the statistics of a stage.
+    Returns:
+      <RollingStats> of the stage after the observation.
+    """
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        row = self._db.execute("SELECT count, mean, variance FROM corrections WHERE stage = ? AND key = ?", (stage, key or "")).fetchone()
+        stats = RollingStats(count=row[0], mean=row[1], variance=row[2]) if row else RollingStats()
+        stats.observe(ratio)
+        self._db.execute("INSERT OR REPLACE INTO corrections VALUES (?, ?, ?, ?, ?)", (stage, key or "", stats.count, stats.mean, stats.variance))
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+    return stats
+
+  def load(self):
+    """
+    Returns:
+      <Dict> mapping every (stage, key) to its <RollingStats>.
+    """
+    with self._lock:
+      rows = self._db.execute("SELECT stage, key, count, mean, variance FROM corrections").fetchall()
+    return {(stage, key or None): RollingStats(count=count, mean=mean, variance=variance) for stage, key, count, mean, variance in rows}
+
+class Estimator:
+  """
+  Estimate when every stage of an order happens: preparation from its items and the
+  kitchen load, travel from the zone matrix, both corrected by the ratio of actual
+  to estimated durations observed so far, read from the shared corrections at most
+  every refresh seconds.
+  """
+  def __init__(self, matrix=None, restaurant_zone=RESTAURANT_ZONE, corrections=None, refresh=REFRESH_SECONDS):
+    self.matrix = matrix or ZoneMatrix()
+    self.restaurant_zone = restaurant_zone
+    self.corrections = corrections
+    self.refresh = refresh
+    self.stats = {}
+    self.orders = {}
+    self._loaded = None
+    self._lock = threading.Lock()
+
+  def observe(self, stage, key, estimated, actual):
+    """
+    Record how long a stage actually took against its estimate.
+    Parameters:
+      stage: <string> "prep" or "travel".
+      key: <string> with the restaurant (prep) or the destination zone (travel).
+      estimated: <float> minutes estimated for the stage.
+      actual: <float> minutes the stage took.
+    """
+    if estimated <= 0:
+      return
+    if self.corrections is None:
+      logger.debug("ETA_DB is not set, %s of %s is not recorded", stage, key)
+      return
+    stats = self.corrections.observe(stage, key, actual / estimated)
+    with self._lock:
+      self.stats[(stage, key)] = stats
+
+  def _reload(self):
+    if self.corrections is None:
+      return
+    now = time.monotonic()
+    if self._loaded is not None and now - self._loaded < self.refresh:
+      return
+    stats = self.corrections.load()
+    with self._lock:
+      self.stats, self._loaded = stats, now
+
+  def correction(self, stage, key):
+    """
+    Returns:
+      <float> with the factor applied to the estimates of a stage, 1.0 until MIN_SAMPLES
+      durations were observed. It errs on the late side so callbacks do not fire early.
+    """
+    self._reload()
+    stats = self.stats.get((stage, key))
+    if stats is None or stats.count < MIN_SAMPLES:
+      return 1.0
+    return max(stats.upper(), 0.5)
+
+  def load(self, restaurant, now):
+    """
+    Register an order for a restaurant and return how many it got in the last LOAD_WINDOW_MINUTES.
+    Only the orders seen by this instance count.
+    """
+    with self._lock:
+      recent = self.orders.setdefault(restaurant, deque())
+      while recent and recent[0] < now - LOAD_WINDOW_MINUTES * 60:
+        recent.popleft()
+      recent.append(now)
+      return len(recent)
+
+  def prep_minutes(self, items, restaurant, now):
+    """
+    Returns:
+      <float> with the preparation minutes: the longest dish, plus a share of the
+      others cooked alongside, slowed down when the kitchen is over capacity.
+    """
+    minutes = sorted(items.prep_minutes if items is not None else [], reverse=True)
+    base = minutes[0] + PARALLEL_PREP * sum(minutes[1:]) if minutes else DEFAULT_PREP_MINUTES
+    queued = self.load(restaurant, now)
+    if queued > KITCHEN_CAPACITY:
+      base *= min(MAX_LOAD_FACTOR, 1 + (queued - KITCHEN_CAPACITY) / KITCHEN_CAPACITY)
+    return base * self.correction("prep", restaurant)
+
+  def travel(self, address, origin=None):
+    """
+    Returns:
+      <tuple> with the destination zone, the road kilometers from the origin zone
+      (the restaurant zone by default) and the travel minutes.
+    """
+    zone = self.matrix.zone(address)
+    km = self.matrix.distance(origin or self.restaurant_zone, zone)
+    minutes = (HANDOFF_MINUTES + km / SPEED_KMH * 60) * self.correction("travel", zone)
+    return zone, km, minutes
+
+  def estimate(self, now, items, address, restaurant, origin=None):
+    """
+    Parameters:
+      now: <datetime> when the order was received.
+      items: <ParsedOrder> with the order line items.
+      address: <string> with the delivery address.
+      restaurant: <string> with the restaurant name.
+      origin: <string> with the zone of the restaurant, restaurant_zone by default.
+    Returns:
+      <Estimate>
+    """
+    prep = self.prep_minutes(items, restaurant, now.timestamp())
+    zone, km, travel = self.travel(address, origin)
+    return Estimate(now, prep, zone, km, travel)
+
+  def estimate_many(self, orders, restaurant, origin=None):
+    """
+    Estimate a batch of orders, with their distances computed in one vectorised pass.
+    Parameters:
+      orders: <list> of (now <datetime>, items <ParsedOrder>, location <tuple> of
+        latitude and longitude or None, address <string>) tuples.
+      restaurant: <string> with the restaurant name.
+      origin: <string> with the zone of the restaurant, restaurant_zone by default.
+    Returns:
+      <list> of <Estimate>
+    """
+    origin = origin or self.restaurant_zone
+    start = ZONES[origin]["location"] if origin in ZONES else None
+    located = [position for position, order in enumerate(orders) if order[2] is not None and start is not None]
+    direct = {}
+    if located:
+      kms = haversine(
+        [start[0]] * len(located), [start[1]] * len(located),
+        [orders[position][2][0] for position in located], [orders[position][2][1] for position in located]
+      )
+      direct = {position: float(km) * ROAD_FACTOR for position, km in zip(located, kms)}
+    estimates = []
+    for position, (now, items, location, address) in enumerate(orders):
+      prep = self.prep_minutes(items, restaurant, now.timestamp())
+      if position in direct:
+        zone, km = self.matrix.zone(address), direct[position]
+        travel = (HANDOFF_MINUTES + km / SPEED_KMH * 60) * self.correction("travel", zone)
+      else:
+        zone, km, travel = self.travel(address, origin)
+      estimates.append(Estimate(now, prep, zone, km, travel))
+    return estimates
+
+class Estimate:
+  """
+  Expected times of the stages of an order.
+  """
+  __slots__ = ("prep_minutes", "zone", "distance_km", "travel_minutes", "confirmation", "pickup", "arrival", "feedback")
+
+  def __init__(self, now, prep_minutes, zone, distance_km, travel_minutes):
+    self.prep_minutes = prep_minutes
+    self.zone = zone
+    self.distance_km = distance_km
+    self.travel_minutes = travel_minutes
+    self.pickup = now + timedelta(minutes=prep_minutes)
+    # The check-in reminds the restaurant a few minutes before pickup, never before now
+    self.confirmation = max(now + timedelta(minutes=1), self.pickup - timedelta(minutes=CHECK_IN_LEAD_MINUTES))
+    self.arrival = self.pickup + timedelta(minutes=travel_minutes)
+    self.feedback = self.arrival + timedelta(minutes=FEEDBACK_DELAY_MINUTES)
+
+@lru_cache(maxsize=None)
+def default_estimator():
+  """
+  Returns:
+    <Estimator> shared by the process, keeping its load across warm invocations and
+    its corrections at ETA_DB.
+  """
+  return Estimator(corrections=CorrectionStore() if DB_PATH else None)
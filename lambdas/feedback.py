@@ -0,0 +1,234 @@
+import hashlib, hmac, json, os, sqlite3, threading, time
+from functools import lru_cache
+from urllib.parse import urlencode
+import order_schema
+from sketches import HyperLogLog, TDigest
+
+# Load env
+# Shared by recibir-opinion and asignar-repartidor, a /tmp default would be private to each
+DB_PATH = os.environ.get('FEEDBACK_DB')
+FEEDBACK_URL = os.environ.get('FEEDBACK_URL')
+SECRET = os.environ.get('FEEDBACK_SECRET', '').encode()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratings (
+  order_id TEXT PRIMARY KEY,
+  rating INTEGER NOT NULL,
+  comment TEXT,
+  restaurant_id TEXT,
+  courier_id TEXT,
+  created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aggregates (
+  kind TEXT NOT NULL,
+  key TEXT NOT NULL,
+  sketch TEXT NOT NULL,
+  summary TEXT NOT NULL,
+  PRIMARY KEY (kind, key)
+);
+"""
+
+def rating(value):
+  """
+  Normalize a rating, sent as a string or a number, to an int from 1 to 5.
+  """
+  if isinstance(value, bool) or not isinstance(value, (str, int)):
+    raise ValueError("must be a whole number")
+  try:
+    value = int(value)
+  except ValueError:
+    raise ValueError("must be a whole number") from None
+  if not 1 <= value <= 5:
+    raise ValueError("must be between 1 and 5")
+  return value
+
+FEEDBACK = {
+  "pedido": order_schema.text(64),
+  "calificacion": rating,
+  "token": order_schema.text(64),
+}
+FEEDBACK_OPTIONAL = {
+  "comentario": order_schema.text(1000, multiline=True),
+  "restaurante": order_schema.text(64),
+  "repartidor": order_schema.text(64),
+  "cliente": order_schema.text(32),
+}
+
+validate_feedback = order_schema.compile_schema(FEEDBACK, FEEDBACK_OPTIONAL)
+
+def client_key(email):
+  """
+  Returns:
+    <string> standing for a customer in the feedback links and the distinct raters, without the email.
+  """
+  return hashlib.blake2b(email.strip().lower().encode(), digest_size=8).hexdigest()
+
+def token(order_id, restaurant_id, courier_id, client=None):
+  """
+  Returns:
+    <string> signing the feedback link of an order, so ratings cannot be attributed to other restaurants or couriers.
+  Raises:
+    RuntimeError when FEEDBACK_SECRET is not set, links signed with an empty key could be forged.
+  """
+  if not SECRET:
+    raise RuntimeError("FEEDBACK_SECRET must be set to sign the feedback links")
+  message = "{}:{}:{}:{}".format(order_id, restaurant_id or "", courier_id or "", client or "")
+  return hmac.new(SECRET, message.encode(), hashlib.sha256).hexdigest()[:32]
+
+def verify(order_id, restaurant_id, courier_id, client, signature):
+  return hmac.compare_digest(token(order_id, restaurant_id, courier_id, client), signature or "")
+
+def link(order_id, restaurant_id, courier_id, client_email=None):
+  """
+  Returns:
+    <string> with the URL of the feedback form of an order, None when FEEDBACK_URL is not set.
+  """
+  if not FEEDBACK_URL:
+    return None
+  client = client_key(client_email) if client_email else None
+  query = {"pedido": order_id, "token": token(order_id, restaurant_id, courier_id, client)}
+  for parameter, value in (("restaurante", restaurant_id), ("repartidor", courier_id), ("cliente", client)):
+    if value:
+      query[parameter] = value
+  return "{}?{}".format(FEEDBACK_URL, urlencode(query))
+
+def keys(restaurant_id, courier_id):
+  """
+  Returns:
+    <list> of the (kind, key) aggregates an order of the restaurant and courier counts in.
+  """
+  return [(kind, key) for kind, key in (("restaurant", restaurant_id), ("courier", courier_id)) if key]
+
+class Sketch:
+  """
+  Rolling quality of a restaurant or courier: ratings per star, distinct raters and
+  delivery minutes, in a few KB whatever the number of orders. Sketches merge, so
+  the aggregates of several stores or periods combine without the raw feedback.
+  """
+  __slots__ = ("stars", "raters", "latency")
+
+  def __init__(self, stars=None, raters=None, latency=None):
+    self.stars = stars or [0] * 5
+    self.raters = raters or HyperLogLog()
+    self.latency = latency or TDigest()
+
+  def rate(self, rating, client=None):
+    self.stars[rating - 1] += 1
+    if client:
+      self.raters.add(client)
+
+  def merge(self, other):
+    self.stars = [a + b for a, b in zip(self.stars, other.stars)]
+    self.raters.merge(other.raters)
+    self.latency.merge(other.latency)
+
+  def summary(self):
+    """
+    Returns:
+      <Dict> with the ratings count and average, the count per star, the distinct
+      raters and the delivery minutes percentiles.
+    """
+    count = sum(self.stars)
+    deliveries = self.latency.count
+    return {
+      "ratings": count,
+      "average": round(sum(star * total for star, total in enumerate(self.stars, 1)) / count, 2) if count else None,
+      "stars": {str(star): total for star, total in enumerate(self.stars, 1)},
+      "raters": self.raters.count(),
+      "deliveries": deliveries,
+      "delivery_minutes": {
+        "p50": round(self.latency.quantile(0.5), 1),
+        "p90": round(self.latency.quantile(0.9), 1),
+        "p99": round(self.latency.quantile(0.99), 1),
+      } if deliveries else None,
+    }
+
+  def to_dict(self):
+    return {"stars": self.stars, "raters": self.raters.to_dict(), "latency": self.latency.to_dict()}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(list(data["stars"]), HyperLogLog.from_dict(data["raters"]), TDigest.from_dict(data["latency"]))
+
+class FeedbackStore:
+  """
+  Ratings and per restaurant and courier aggregates kept in SQLite, a local stand-in
+  for a shared table. Every write updates the sketch and its summary together, so
+  reading the aggregates of a restaurant or courier is a single row lookup.
+  """
+  def __init__(self, path=DB_PATH):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.executescript(SCHEMA)
+    self._lock = threading.Lock()
+
+  def _update(self, targets, apply):
+    for kind, key in targets:
+      row = self._db.execute("SELECT sketch FROM aggregates WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+      sketch = Sketch.from_dict(json.loads(row[0])) if row else Sketch()
+      apply(sketch)
+      self._db.execute(
+        "INSERT OR REPLACE INTO aggregates VALUES (?, ?, ?, ?)",
+        (kind, key, json.dumps(sketch.to_dict(), separators=(",", ":")), json.dumps(sketch.summary()))
+      )
+
+  def _transaction(self, work):
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        result = work()
+        self._db.execute("COMMIT")
+        return result
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+
+  def rate(self, order_id, rating, comment=None, restaurant_id=None, courier_id=None, client=None):
+    """
+    Store the rating of an order and add it to the aggregates of its restaurant and courier.
+    Returns:
+      <bool> False when the order was already rated.
+    """
+    def work():
+      cursor = self._db.execute(
+        "INSERT OR IGNORE INTO ratings VALUES (?, ?, ?, ?, ?, ?)",
+        (order_id, rating, comment, restaurant_id, courier_id, time.time())
+      )
+      if cursor.rowcount != 1:
+        return False
+      self._update(keys(restaurant_id, courier_id), lambda sketch: sketch.rate(rating, client))
+      return True
+    return self._transaction(work)
+
+  def observe_delivery(self, restaurant_id, courier_id, minutes):
+    """
+    Add the minutes an order took from being received to being delivered.
+    """
+    self._transaction(lambda: self._update(keys(restaurant_id, courier_id), lambda sketch: sketch.latency.add(minutes)))
+
+  def merge(self, kind, key, sketch):
+    """
+    Merge a sketch built elsewhere, e.g. by another region, into an aggregate.
+    """
+    self._transaction(lambda: self._update([(kind, key)], lambda aggregate: aggregate.merge(sketch)))
+
+  def summary(self, kind, key):
+    """
+    Returns:
+      <Dict> as in Sketch.summary, or None when nothing was recorded.
+    """
+    with self._lock:
+      row = self._db.execute("SELECT summary FROM aggregates WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+@lru_cache(maxsize=None)
+def default_store():
+  """
+  Returns:
+    <FeedbackStore> shared by the process, stored at FEEDBACK_DB.
+  Raises:
+    RuntimeError when FEEDBACK_DB is not set.
+  """
+  if not DB_PATH:
+    raise RuntimeError("FEEDBACK_DB must point to the ratings shared by recibir-opinion and asignar-repartidor")
+  return FeedbackStore()
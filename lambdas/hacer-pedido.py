@@ -1,16 +1,26 @@
-from time import strftime
-import boto3, json, logging, os, random, re
-from datetime import datetime, timedelta
-from dateutil import tz
-from postmarker.core import PostmarkClient
+import json, logging, math, os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+import tracing
+import clients, idempotency, menu, order_ids, order_schema, responses, templates
+# The modules of the order path (eta, routing, order_state, stages) load with the
+# first order and those of each mode (offers, timeline, outbox) in its branch, so
+# the init phase only pays for what every request needs
 
 # Load env
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
-POSTMARK_TOKEN = os.environ.get('POSTMARK_API_TOKEN')
 TIMEZONE = os.environ.get('TZ', 'America/Mexico_City')
 EMAIL_FROM = "AjoloEats <{}>".format(os.environ.get('EMAIL_FROM'))
-RESTAURANT_EMAIL = os.environ.get('RESTAURANT_EMAIL')
-DELIVERY_EMAIL = os.environ.get('DELIVERY_EMAIL')
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'concurrent')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '7'))
+SCHEDULE_MODE = os.environ.get('SCHEDULE_MODE', 'per_event')
+SIDE_EFFECTS = os.environ.get('SIDE_EFFECTS', 'direct')
+NOTIFICATION_ROUTER = os.environ.get('NOTIFICATION_ROUTER')
+TOTAL_CHECK = os.environ.get('TOTAL_CHECK', 'warn')
+DISPATCH_MODE = os.environ.get('DISPATCH_MODE', 'nearest')
+BATCH_SCHEDULE_SECONDS = int(os.environ.get('BATCH_SCHEDULE_SECONDS', '60'))
+BATCH_SCHEDULE_EVENTS = int(os.environ.get('BATCH_SCHEDULE_EVENTS', '200'))
 
 # Logger setup
 logger = logging.getLogger("__name__")
@@ -20,281 +30,686 @@ ch = logging.StreamHandler()
 ch.setLevel(LOG_LEVEL)
 logger.addHandler(ch)
 
-# Timezone setup
-runtime_tz = tz.gettz(TIMEZONE)
-mex_tz = tz.gettz('America/Mexico_City')
-
 # Constants
 time_format = "%I:%M %p"
-restaurant_address = "Periférico Blvrd Manuel Ávila Camacho 261, Polanco"
-restaurant_name = "El Ajolote Frito"
-delivery_name = "Juan"
+LAMBDA_ARN = "arn:aws:lambda:us-west-2:833307389424:function:{}"
+ROLE_ARN = "arn:aws:iam::833307389424:role/AllowLambdasRole"
+
+# Worker pool for the order side effects, reused across warm invocations
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-# Postmark setup
-postmark = PostmarkClient(server_token=POSTMARK_TOKEN)
+@lru_cache(maxsize=None)
+def timezones():
+  """
+  Timezone setup, deferred to the first order.
+  Returns:
+    <tuple> with the runtime and Mexico City timezones.
+  """
+  from dateutil import tz
+  return tz.gettz(TIMEZONE), tz.gettz('America/Mexico_City')
 
-def send_email(receiver, subject, body, postmark=postmark, sender=EMAIL_FROM):
+def send_email(receiver, subject, body, dispatcher=None, sender=EMAIL_FROM):
   """
   Send an email using Postmark service.
   Parameters:
     receiver: <list> with the recipients (TO) of the email.
     subject: <string> with the subject of the email.
     body: <string> with the body of the email.
-    postmark: <PostmarkClient> with the client instantiation of Postmark.
+    dispatcher: <EmailDispatcher> batching the emails sent through Postmark, defaults to the shared one.
     sender: <string> with the sender (FROM) of the email.
   """
-  postmark.emails.send(
-    From = sender,
-    To = receiver,
-    Subject = subject,
-    HtmlBody = body,
-  )
+  (dispatcher or clients.dispatcher()).send(receiver, subject, body, sender)
 
-def notify_restaurant(restaurant_email, order_id, order, amount, expected_pickup, restaurant = restaurant_name):
-  subject = "Nuevo Pedido - {}".format(order_id)
-  email_body = """
-    <!DOCTYPE html>
-    <html lang="es">
-    <head>
-        <meta charset="UTF-8">
-        <title>{}</title>
-    </head>
-    <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-        <div style="background-color: #f8f8f8; padding: 20px; border-radius: 5px;">
-            <h1 style="color: #2b2b2b; margin-bottom: 20px;">¡Nuevo Pedido Recibido!</h1>
-            <p>Estimado {},</p>
-            <p>Has recibido un nuevo pedido con el número #{}.</p>
-            
-            <div style="background-color: white; padding: 15px; border-radius: 5px; margin: 20px 0;">
-                <h3 style="margin-top: 0;">Detalles del Pedido:</h3>
-                <p><strong>Items:</strong></p>
-                {}
-                <p><strong>Total:</strong> ${}</p>
-            </div>
+def order_restaurant(body):
+  """
+  Returns:
+    <Restaurant> the order is placed at, the default one when it names none.
+  Raises:
+    order_schema.ValidationError when the restaurant is not in the registry.
+  """
+  import routing
+  restaurant = routing.default_registry().restaurant(body.get('restaurante'))
+  if restaurant is None:
+    raise order_schema.ValidationError({"restaurante": "is not a known restaurant"})
+  return restaurant
 
-            <p>Por favor, confirma la recepción de este pedido en tu panel de control.</p>
-            <p>La orden debería estar lista a las: {}</p>
-            
-            <p style="color: #666;">Este es un mensaje automático, por favor no respondas a este correo.</p>
-        </div>
-    </body>
-    </html>
-  """.format(subject, restaurant, order_id, order, amount, expected_pickup)
-  send_email(restaurant_email, subject, email_body)
+def order_items(order, amount, restaurant=None):
+  """
+  Parse the order into menu items and check the total sent by the client against them.
+  Parameters:
+    order: <string> with the order as written by the client.
+    amount: <Decimal> with the total sent by the client.
+    restaurant: <Restaurant> whose menu the order is parsed with, the default menu when not given.
+  Returns:
+    <ParsedOrder> with the line items.
+  Raises:
+    order_schema.ValidationError when TOTAL_CHECK is "reject" and every item is on
+    the menu but their total differs.
+  """
+  items = (restaurant.index() if restaurant else menu.default_index()).parse(order)
+  if TOTAL_CHECK != "off" and items.complete and items.total != amount:
+    if TOTAL_CHECK == "reject":
+      raise order_schema.ValidationError({"total": "does not match the items, expected {}".format(items.total)})
+    logger.warning("Order total %s does not match its items, expected %s", amount, items.total)
+  return items
 
-def notify_delivery(delivery_email, delivery_address, expected_pickup, delivery_name = delivery_name, restaurant = restaurant_name, restaurant_address = restaurant_address):
-  subject = "Nueva Entrega Disponible"
-  random.seed()
-  distance = "{}Km".format(random.randrange(1, 25))
-  email_body = """
-    <!DOCTYPE html>
-    <html lang="es">
-    <head>
-        <meta charset="UTF-8">
-        <title>{}</title>
-    </head>
-    <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-        <div style="background-color: #f8f8f8; padding: 20px; border-radius: 5px;">
-            <h1 style="color: #2b2b2b; margin-bottom: 20px;">¡Nueva Entrega Disponible!</h1>
-            <p>Hola {},</p>
-            <p>Hay un nuevo pedido disponible para entrega.</p>
-            
-            <div style="background-color: white; padding: 15px; border-radius: 5px; margin: 20px 0;">
-                <h3 style="margin-top: 0;">Información de la Entrega:</h3>
-                <p><strong>Restaurante:</strong> {}</p>
-                <p><strong>Dirección del restaurante:</strong> {}</p>
-                <p><strong>Dirección de entrega:</strong> {}</p>
-                <p><strong>Distancia aproximada:</strong> {}</p>
-                <p><strong>Se estima que lo recojas del restaurante a las:</strong> {}</p>
-            </div>
+def items_table(items):
+  """
+  Returns:
+    <Markup> with the HTML table of the order line items, prices included when known.
+  """
+  rows = templates.Markup("".join(
+    templates.render(
+      "order_item",
+      quantity=line.quantity,
+      name=line.name,
+      price="${}".format(line.item.price) if line.item else "-",
+      subtotal="${}".format(line.subtotal) if line.item else "-"
+    )
+    for line in items.lines
+  ))
+  return templates.render("order_items", rows=rows)
 
-            <div style="background-color: #4CAF50; color: white; padding: 15px; border-radius: 5px; text-align: center; margin: 20px 0;">
-                <p style="margin: 0;">¿Aceptas esta entrega?</p>
-                <p style="margin: 5px 0;">Tienes 30 segundos para responder</p>
-            </div>
+def restaurant_email(restaurant_email, order_id, order, amount, expected_pickup, restaurant):
+  subject = "Nuevo Pedido - {}".format(order_id)
+  header = templates.render_cached("restaurant_header", restaurant=restaurant)
+  email_body = templates.render("new_order", title=subject, header=header, order_id=order_id, order=order, amount=amount, expected_pickup=expected_pickup)
+  return restaurant_email, subject, email_body
 
-            <p>Accede a la app para aceptar o rechazar este pedido.</p>
-            
-            <p style="color: #666;">Este es un mensaje automático, por favor no respondas a este correo.</p>
-        </div>
-    </body>
-    </html>
-  """.format(subject, delivery_name, restaurant, restaurant_address, delivery_address, distance, expected_pickup)
-  send_email(delivery_email, subject, email_body)
+def delivery_email(delivery_email, delivery_address, expected_pickup, distance, delivery_name, restaurant, restaurant_address, order_id=None, courier_id=None):
+  subject = "Nueva Entrega Disponible"
+  actions = ""
+  if order_id and courier_id:
+    # Links the courier confirms the pickup and the delivery with
+    import offers
+    actions = offers.courier_actions(order_id, courier_id)
+  email_body = templates.render("new_delivery", title=subject, delivery_name=delivery_name, restaurant=restaurant, restaurant_address=restaurant_address, delivery_address=delivery_address, distance=distance, expected_pickup=expected_pickup, actions=actions)
+  return delivery_email, subject, email_body
 
-def notify_customer(customer_email, name, order, amount, expected_arrival, client_address, restaurant = restaurant_name):
+def customer_email(customer_email, name, order, amount, expected_arrival, client_address, restaurant):
   subject = "AjoloEats - Confirmación de pedido"
-  email_body = """
-    <!DOCTYPE html>
-    <html lang="es">
-    <head>
-        <meta charset="UTF-8">
-        <title>{}</title>
-    </head>
-    <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-        <div style="background-color: #f8f8f8; padding: 20px; border-radius: 5px;">
-            <h1 style="color: #2b2b2b; margin-bottom: 20px;">¡Gracias por tu pedido!</h1>
-            <p>Hola {},</p>
-            <p>Hemos recibido tu pedido #{} correctamente. A continuación, te mostramos los detalles:</p>
-            
-            <div style="background-color: white; padding: 15px; border-radius: 5px; margin: 20px 0;">
-                <p><strong>Restaurante:</strong> {}</p>
-                <p><strong>Total:</strong> ${}</p>
-                <p><strong>Tiempo estimado de entrega:</strong> {}</p>
-                <p><strong>Dirección de entrega:</strong> {}</p>
-            </div>
+  email_body = templates.render("order_confirmation", title=subject, name=name, order_id=order, restaurant=restaurant, amount=amount, expected_arrival=expected_arrival, client_address=client_address)
+  return customer_email, subject, email_body
 
-            <p>Te mantendremos informado sobre el estado de tu pedido.</p>
-            <p><strong>¿Preguntas?</strong> Contáctanos a través de nuestra app o responde a este correo.</p>
-            
-            <p style="margin-top: 20px;">¡Que disfrutes tu comida!</p>
-        </div>
-    </body>
-    </html>
-  """.format(subject, name, order, restaurant, amount, expected_arrival, client_address)
-  send_email(customer_email, subject, email_body)
+def notify_restaurant(*args, **kwargs):
+  send_email(*restaurant_email(*args, **kwargs))
 
-def create_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name):
-  client = boto3.client("scheduler")
+def notify_delivery(*args, **kwargs):
+  send_email(*delivery_email(*args, **kwargs))
 
-  scheduler_time_format = f"%Y-%m-%dT%H:%M:%S"
+def notify_customer(*args, **kwargs):
+  send_email(*customer_email(*args, **kwargs))
 
-  # Create restaurant check-in schedule
-  confirmation = client.create_schedule(
-    ActionAfterCompletion = 'DELETE',
-    Name="{}_ready_confirmation".format(order_id),
-    Description="Schedule to send the restaurant a check-in about order #{} status".format(order_id),
-    FlexibleTimeWindow={
-      'Mode': 'OFF'
-    },
-    ScheduleExpression="at({})".format(expected_confirmation.strftime(scheduler_time_format)),
-    State="ENABLED",
-    Target={
-      'Arn': "arn:aws:lambda:us-west-2:833307389424:function:orderCheckIn",
-      'RoleArn': "arn:aws:iam::833307389424:role/AllowLambdasRole",
-      'Input': json.dumps({
-        "order_id": order_id,
-        "from_email": EMAIL_FROM,
-        "restaurant_email": RESTAURANT_EMAIL,
-        "restaurant_name": restaurant_name,
-        "expected_pickup": "{}".format(expected_pickup.astimezone(mex_tz).strftime(time_format))
-      })
-    }
-  )
+def build_steps(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name, restaurant=None, courier_id=None):
+  """
+  Build the lifecycle steps of an order.
+  Parameters:
+    expected_*: <datetime> with the time each event should fire.
+    order_id: <string> with the order identifier.
+    client_email: <string> with the customer email.
+    client_name: <string> with the customer name.
+    restaurant: <Restaurant> preparing the order, the default one when not given.
+    courier_id: <string> with the courier assigned to the order, if known.
+  Returns:
+    <list> of <Dict> with the name, description, time, target function and input of every step.
+  """
+  import routing, stages
+  mex_tz = timezones()[1]
+  restaurant = restaurant or routing.default_registry().default
 
-  # Create order on its way schedule
-  order_moving = client.create_schedule(
-    ActionAfterCompletion = 'DELETE',
-    Name="{}_order_moving".format(order_id),
-    Description="Schedule to send the customer a notification about #{} status".format(order_id),
-    FlexibleTimeWindow={
-      'Mode': 'OFF'
-    },
-    ScheduleExpression="at({})".format(expected_pickup.strftime(scheduler_time_format)),
-    State="ENABLED",
-    Target={
-      'Arn': "arn:aws:lambda:us-west-2:833307389424:function:orderSent",
-      'RoleArn': "arn:aws:iam::833307389424:role/AllowLambdasRole",
-      'Input': json.dumps({
-        "order_id": order_id,
-        "from_email": EMAIL_FROM,
-        "client_email": client_email,
-        "client_name": client_name,
-        "expected_delivery": "{}".format(expected_arrival.astimezone(mex_tz).strftime(time_format))
-      })
+  def step(name, description, when, function, payload):
+    # The notification router handles every stage when it is deployed
+    payload["event_type"] = stages.FUNCTIONS[function]
+    return {
+      "name": name,
+      "description": description.format(order_id),
+      "at": when,
+      "function": NOTIFICATION_ROUTER or function,
+      "input": payload
     }
-  )
 
-  # Create order delivered schedule
-  confirmation = client.create_schedule(
-    ActionAfterCompletion = 'DELETE',
-    Name="{}_order_delivered".format(order_id),
-    Description="Schedule to send the involved parties a notification about #{} being delivered".format(order_id),
-    FlexibleTimeWindow={
-      'Mode': 'OFF'
-    },
-    ScheduleExpression="at({})".format(expected_confirmation.strftime(scheduler_time_format)),
-    State="ENABLED",
-    Target={
-      'Arn': "arn:aws:lambda:us-west-2:833307389424:function:orderDelivered",
-      'RoleArn': "arn:aws:iam::833307389424:role/AllowLambdasRole",
-      'Input': json.dumps({
-        "order_id": order_id,
-        "from_email": EMAIL_FROM,
-        "client_email": client_email
-      })
-    }
-  )
+  return [
+    # Restaurant check-in schedule
+    step("ready_confirmation", "Schedule to send the restaurant a check-in about order #{} status", expected_confirmation, "orderCheckIn", {
+      "order_id": order_id,
+      "from_email": EMAIL_FROM,
+      "restaurant_email": restaurant.email,
+      "restaurant_name": restaurant.name,
+      "expected_pickup": "{}".format(expected_pickup.astimezone(mex_tz).strftime(time_format))
+    }),
+    # Order on its way schedule
+    step("order_moving", "Schedule to send the customer a notification about #{} status", expected_pickup, "orderSent", {
+      "order_id": order_id,
+      "from_email": EMAIL_FROM,
+      "client_email": client_email,
+      "client_name": client_name,
+      "expected_delivery": "{}".format(expected_arrival.astimezone(mex_tz).strftime(time_format))
+    }),
+    # Order delivered schedule
+    step("order_delivered", "Schedule to send the involved parties a notification about #{} being delivered", expected_arrival, "orderDelivered", {
+      "order_id": order_id,
+      "from_email": EMAIL_FROM,
+      "client_email": client_email,
+      "restaurant_id": restaurant.id,
+      "courier_id": courier_id
+    }),
+    # Feedback schedule
+    step("feedback_request", "Schedule to send the customer a reminder to give feedback on #{}", expected_feedback, "orderFeedback", {
+      "order_id": order_id,
+      "from_email": EMAIL_FROM,
+      "client_email": client_email,
+      "client_name": client_name,
+      "restaurant_id": restaurant.id,
+      "courier_id": courier_id
+    }),
+  ]
 
-  # Create feedback schedule
-  confirmation = client.create_schedule(
-    ActionAfterCompletion = 'DELETE',
-    Name="{}_feedback_request".format(order_id),
-    Description="Schedule to send the customer a reminder to give feedback on #{}".format(order_id),
-    FlexibleTimeWindow={
-      'Mode': 'OFF'
-    },
-    ScheduleExpression="at({})".format(expected_confirmation.strftime(scheduler_time_format)),
-    State="ENABLED",
-    Target={
-      'Arn': "arn:aws:lambda:us-west-2:833307389424:function:orderFeedback",
-      'RoleArn': "arn:aws:iam::833307389424:role/AllowLambdasRole",
-      'Input': json.dumps({
-        "order_id": order_id,
-        "from_email": EMAIL_FROM,
-        "client_email": client_email,
-        "client_name": client_name
-      })
+def build_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name, restaurant=None, courier_id=None):
+  """
+  Build the create_schedule arguments for every order lifecycle event.
+  Parameters:
+    Same as build_steps.
+  Returns:
+    <Dict> mapping the schedule name to its create_schedule keyword arguments.
+  """
+  scheduler_time_format = f"%Y-%m-%dT%H:%M:%S"
+  events = {}
+  for step in build_steps(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name, restaurant, courier_id):
+    name = "{}_{}".format(order_id, step["name"])
+    events[name] = {
+      "ActionAfterCompletion": 'DELETE',
+      "Name": name,
+      "Description": step["description"],
+      "FlexibleTimeWindow": {
+        'Mode': 'OFF'
+      },
+      "ScheduleExpression": "at({})".format(step["at"].astimezone(timezone.utc).strftime(scheduler_time_format)),
+      "ScheduleExpressionTimezone": "UTC",
+      "State": "ENABLED",
+      "Target": {
+        'Arn': LAMBDA_ARN.format(step["function"]),
+        'RoleArn': ROLE_ARN,
+        'Input': json.dumps(step["input"])
+      }
     }
-  )
+  return events
+
+def create_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name, restaurant=None, courier_id=None):
+  client = clients.scheduler()
+  events = build_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, order_id, client_email, client_name, restaurant, courier_id)
+  for event in events.values():
+    client.create_schedule(**event)
+
+def build_batch_events(batch_id, steps):
+  """
+  Group the lifecycle steps of a batch of orders into notification router schedules,
+  one per fire time rounded up to BATCH_SCHEDULE_SECONDS with at most
+  BATCH_SCHEDULE_EVENTS events each, instead of a schedule per step.
+  Parameters:
+    batch_id: <string> naming the schedules of the batch.
+    steps: <list> of (position, step) tuples, step as returned by build_steps for
+      the order at that position of the batch.
+  Returns:
+    <list> of (create_schedule keyword arguments <Dict>, positions <list>) tuples,
+    with the positions of the orders every schedule notifies.
+  """
+  scheduler_time_format = f"%Y-%m-%dT%H:%M:%S"
+  buckets = {}
+  for position, step in steps:
+    # Rounded up, so no notification fires before its time
+    at = math.ceil(step["at"].timestamp() / BATCH_SCHEDULE_SECONDS) * BATCH_SCHEDULE_SECONDS
+    buckets.setdefault(at, []).append((position, step))
+  schedules = []
+  for at, bucket in sorted(buckets.items()):
+    for start in range(0, len(bucket), BATCH_SCHEDULE_EVENTS):
+      chunk = bucket[start:start + BATCH_SCHEDULE_EVENTS]
+      name = "{}_batch_{}_{}".format(batch_id, at, start // BATCH_SCHEDULE_EVENTS)
+      schedules.append(({
+        "ActionAfterCompletion": 'DELETE',
+        "Name": name,
+        "Description": "Schedule to send {} lifecycle notifications of batch #{}".format(len(chunk), batch_id),
+        "FlexibleTimeWindow": {
+          'Mode': 'OFF'
+        },
+        "ScheduleExpression": "at({})".format(datetime.fromtimestamp(at, timezone.utc).strftime(scheduler_time_format)),
+        "ScheduleExpressionTimezone": "UTC",
+        "State": "ENABLED",
+        "Target": {
+          'Arn': LAMBDA_ARN.format(NOTIFICATION_ROUTER),
+          'RoleArn': ROLE_ARN,
+          'Input': json.dumps({"events": [step["input"] for _, step in chunk]})
+        }
+      }, sorted({position for position, _ in chunk})))
+  return schedules
+
+def run_tasks(tasks, mode=EXECUTION_MODE):
+  """
+  Run the order side effects, collecting failures per task.
+  Parameters:
+    tasks: <Dict> mapping a task label to a callable without arguments.
+    mode: <string> either "concurrent" or "sequential".
+  Returns:
+    <Dict> mapping the label of every failed task to its error message.
+  """
+  failures = {}
+  if mode == "concurrent":
+    futures = {label: executor.submit(task) for label, task in tasks.items()}
+    outcomes = ((label, future.exception()) for label, future in futures.items())
+  else:
+    def call(task):
+      try:
+        task()
+      except Exception as error:
+        return error
+    outcomes = ((label, call(task)) for label, task in tasks.items())
+  for label, error in outcomes:
+    if error is not None:
+      logger.error("Task %s failed: %s", label, error, exc_info=error)
+      failures[label] = str(error)
+  return failures
 
+@tracing.handler("hacer-pedido")
 def lambda_handler(event, context):
   """
   Lambda handler function
+  Invalid payloads are rejected before any external call. Retries of an already
+  processed request return the original result without repeating any side effect.
+  A JSON array of orders, or an NDJSON stream, is taken in bulk by process_batch.
   Parameters:
     event: <Dict> with the Lambda function event data.
     context: Lambda runtime context.
   Returns:
-    <Dict> with status message.
+    <Dict> with the API Gateway response, a JSON status message.
+  """
+  if order_schema.is_batch(event.get('body'), event.get('isBase64Encoded', False), (event.get('headers') or {}).get('content-type')):
+    return process_batch(event, context)
+  try:
+    with tracing.span("parse"):
+      body = order_schema.parse(event.get('body'), event.get('isBase64Encoded', False))
+    with tracing.span("items"):
+      restaurant = order_restaurant(body)
+      items = order_items(body['pedido'], body['total'], restaurant)
+  except order_schema.ValidationError as error:
+    logger.info("Rejected order: %s", error)
+    return responses.body(error.status, {"message": "Invalid order.", "errors": error.errors})
+  with tracing.span("idempotency"):
+    key = idempotency.request_key(body, (event.get('headers') or {}).get('idempotency-key'))
+    store = idempotency.default_store()
+    previous = store.get(key)
+    if previous is None and not store.claim(key):
+      previous = idempotency.IN_PROGRESS
+  if previous == idempotency.IN_PROGRESS:
+    return responses.body(409, {"message": "Order is already being processed."})
+  if previous is not None:
+    logger.info("Repeated order request %s, returning the original result.", key)
+    return respond(previous)
+  try:
+    result = process_order(body, context, items, restaurant)
+  except Exception:
+    store.release(key)
+    raise
+  store.put(key, result)
+  return respond(result)
+
+def respond(outcome):
+  """
+  Parameters:
+    outcome: <Dict> with the statusCode and the status message of an order, as kept
+      by the idempotency store.
+  Returns:
+    <Dict> with the API Gateway response.
+  """
+  return responses.body(outcome["statusCode"], {key: value for key, value in outcome.items() if key != "statusCode"})
+
+def flush_outbox(order_ids):
+  """
+  Perform the side effects of the orders just recorded before returning, the container
+  is frozen once the handler returns so they cannot be left to a background thread.
+  Only these orders are flushed, within OUTBOX_FLUSH_BUDGET_MS: effects that fail or
+  take longer, digest tickets not due yet and the rest of the outbox are left to
+  vaciar-outbox.
+  """
+  import outbox
+  with tracing.span("flush"):
+    try:
+      outbox.default_flusher().perform(order_ids)
+    except Exception as error:
+      logger.error("Outbox flush failed, left to vaciar-outbox: %s", error)
+
+def process_order(body, context, items=None, restaurant=None):
+  """
+  Schedule the lifecycle events of an order and notify every party.
+  Parameters:
+    body: <Dict> with the order body validated by order_schema.
+    context: Lambda runtime context.
+    items: <ParsedOrder> with the line items of the order, parsed when not given.
+    restaurant: <Restaurant> the order is placed at, looked up when not given.
+  Returns:
+    <Dict> with the statusCode and the status message of the order.
   """
+  import eta, order_state, routing
   # Grab variables from event
-  id = context.aws_request_id
-  id = re.sub("[^0-9]", '', id)[:8]
-  body = json.loads(event['body'])
+  id = order_ids.new_id()
   name = body['nombre']
   last_name = body['apellido']
   email = body['correo']
   order = body['pedido']
   order_total = body['total']
   client_address = body['direccion']
+  restaurant = restaurant or order_restaurant(body)
+  items = items or order_items(order, order_total, restaurant)
   # Define times
-  now = datetime.now(tz=runtime_tz)
-  received_time = now.astimezone(mex_tz)
-  received_time = received_time.strftime(time_format)
-  expected_confirmation = (now + timedelta(minutes = 3))
-  expected_pickup = (now + timedelta(minutes = 6))
-  expected_arrival = (now + timedelta(minutes = 9))
-  expected_feedback = (now + timedelta(minutes = 12))
-  # Create events
-  create_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, id, email, name)
-  notify_restaurant(RESTAURANT_EMAIL, id, order, order_total, expected_pickup.astimezone(mex_tz).strftime(time_format))
-  notify_delivery(DELIVERY_EMAIL, client_address, expected_pickup.astimezone(mex_tz).strftime(time_format))
-  notify_customer(email, name, id, order_total, expected_arrival.astimezone(mex_tz).strftime(time_format), client_address)
-  # Return successfully
-  success = '''
-    {
-      "statusCode": 200,
-      "message": "Order received successfully, will start processing."
+  with tracing.span("times"):
+    runtime_tz, mex_tz = timezones()
+    now = datetime.now(tz=runtime_tz)
+    received_time = now.astimezone(mex_tz)
+    received_time = received_time.strftime(time_format)
+    # Stage times from the order items, the kitchen load and the delivery distance
+    estimate = eta.default_estimator().estimate(now, items, client_address, restaurant.id, restaurant.zone)
+    expected_confirmation = estimate.confirmation
+    expected_pickup = estimate.pickup
+    expected_arrival = estimate.arrival
+    expected_feedback = estimate.feedback
+    pickup_time = expected_pickup.astimezone(mex_tz).strftime(time_format)
+  # Closest free courier to the restaurant, kept busy until the expected arrival, or
+  # an offer to the closest ones, given to the first that accepts
+  offer, assigned = None, None
+  if DISPATCH_MODE == "offers":
+    import offers
+    details = {"delivery_address": client_address, "expected_pickup": pickup_time, "distance": "{:.1f}Km".format(estimate.distance_km)}
+    offer = partial(offers.default_engine().offer, id, restaurant, details, expected_arrival.timestamp())
+  else:
+    with tracing.span("routing"):
+      assigned = routing.default_registry().couriers.assign(restaurant.location, expected_arrival.timestamp())
+  courier_id = assigned[0].id if assigned is not None else None
+  # Lifecycle record, so repeated or late events of the order are told apart
+  with tracing.span("state"):
+    order_state.default_store().create(id, restaurant.id, estimate.zone, now, estimate, courier_id)
+  # Describe the lifecycle schedules and the emails of every party
+  with tracing.span("build_schedules"):
+    if SCHEDULE_MODE == "timeline":
+      import timeline
+      steps = build_steps(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, id, email, name, restaurant, courier_id)
+      schedules = {"timeline": timeline.registration(id, steps, LAMBDA_ARN.format(timeline.DISPATCHER_FUNCTION), ROLE_ARN)}
+    else:
+      schedules = build_events(expected_confirmation, expected_pickup, expected_arrival, expected_feedback, id, email, name, restaurant, courier_id)
+  with tracing.span("render"):
+    table = items_table(items)
+    emails = {"notify_restaurant": restaurant_email(restaurant.email, id, table, order_total, pickup_time, restaurant.name)}
+    if assigned is not None:
+      courier = assigned[0]
+      emails["notify_delivery"] = delivery_email(courier.email, client_address, pickup_time, "{:.1f}Km".format(estimate.distance_km), courier.name, restaurant.name, restaurant.address, id, courier.id)
+    elif offer is None:
+      logger.warning("No courier free for order %s at %s", id, restaurant.id)
+    emails["notify_customer"] = customer_email(email, name, id, order_total, expected_arrival.astimezone(mex_tz).strftime(time_format), client_address, restaurant.name)
+  if SIDE_EFFECTS == "outbox":
+    # Store the order with its side effects and let the flusher perform them
+    import digest, outbox
+    effects = [("schedule", schedule) for schedule in schedules.values()]
+    for label, (receiver, subject, email_body) in emails.items():
+      payload = {"From": EMAIL_FROM, "To": receiver, "Subject": subject, "HtmlBody": email_body}
+      if label == "notify_restaurant" and digest.enabled():
+        # Coalesced with the other orders of the restaurant during a rush
+        payload.update(digest="new_order", restaurant=restaurant.name, order_id=id, expected_pickup=pickup_time, items=table)
+        effects.append(("ticket", payload))
+      else:
+        effects.append(("email", payload))
+    with tracing.span("outbox"):
+      outbox.default_outbox().record(id, body, effects)
+    flush_outbox([id])
+    if offer is not None:
+      with tracing.span("offers"):
+        offer()
+    return {
+      "statusCode": 202,
+      "message": "Order received successfully, will start processing.",
+      "order_id": id
     }
-  '''
-  return success
+  client = clients.scheduler()
+  tasks = {schedule_name: tracing.timed("create_schedule", partial(client.create_schedule, **schedule)) for schedule_name, schedule in schedules.items()}
+  # The emails of the order leave together in a single Postmark request
+  dispatcher = clients.dispatcher()
+  sent = {label: dispatcher.enqueue(receiver, subject, email_body, EMAIL_FROM) for label, (receiver, subject, email_body) in emails.items()}
+  tasks["emails"] = tracing.timed("email", dispatcher.flush)
+  if offer is not None:
+    tasks["offer_couriers"] = tracing.timed("offers", offer)
+  with tracing.span("side_effects"):
+    failures = run_tasks(tasks)
+  for label, future in sent.items():
+    error = future.exception()
+    if error is not None:
+      failures[label] = str(error)
+  if failures:
+    return {
+      "statusCode": 502,
+      "message": "Order received, but some side effects failed.",
+      "order_id": id,
+      "failures": failures
+    }
+  return {
+    "statusCode": 200,
+    "message": "Order received successfully, will start processing.",
+    "order_id": id
+  }
+
+def process_batch(event, context):
+  """
+  Take the orders of a partner integration in bulk, as a JSON array or one order per
+  line (NDJSON). Every order is validated as the body is read and gets its own
+  status: an invalid or repeated one does not hold back the others.
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the API Gateway response, the status of every order in order.
+  """
+  headers = event.get('headers') or {}
+  results, valid = [], []
+  try:
+    with tracing.span("parse"):
+      stream = order_schema.parse_stream(event.get('body'), event.get('isBase64Encoded', False), ndjson="ndjson" in (headers.get('content-type') or ""))
+      for position, (body, error) in enumerate(stream):
+        if error is None:
+          try:
+            restaurant = order_restaurant(body)
+            items = order_items(body['pedido'], body['total'], restaurant)
+          except order_schema.ValidationError as invalid:
+            error = invalid
+        if error is not None:
+          results.append({"statusCode": error.status, "message": "Invalid order.", "errors": error.errors})
+          continue
+        results.append(None)
+        valid.append((position, body, restaurant, items))
+    if not results:
+      raise order_schema.ValidationError({"body": "must have at least one order"})
+  except order_schema.ValidationError as error:
+    logger.info("Rejected batch: %s", error)
+    return responses.body(error.status, {"message": "Invalid batch.", "errors": error.errors})
+  # Every order is idempotent on its own, so a partner can resend a whole batch
+  claimed = []
+  with tracing.span("idempotency"):
+    store = idempotency.default_store()
+    for position, body, restaurant, items in valid:
+      key = idempotency.request_key(body, headers.get('idempotency-key'))
+      previous = store.get(key)
+      if previous is None and not store.claim(key):
+        previous = idempotency.IN_PROGRESS
+      if previous == idempotency.IN_PROGRESS:
+        results[position] = {"statusCode": 409, "message": "Order is already being processed."}
+      elif previous is not None:
+        results[position] = previous
+      else:
+        claimed.append((position, key, body, restaurant, items))
+  try:
+    outcomes = process_orders([(body, restaurant, items) for _, _, body, restaurant, items in claimed], context)
+  except Exception:
+    for _, key, *_ in claimed:
+      store.release(key)
+    raise
+  for (position, key, *_), outcome in zip(claimed, outcomes):
+    store.put(key, outcome)
+    results[position] = outcome
+  failed = sum(result["statusCode"] >= 300 for result in results)
+  return responses.body(207 if failed else 200, {
+    "message": "{} of {} orders received.".format(len(results) - failed, len(results)),
+    "orders": results
+  })
+
+def order_location(body):
+  """
+  Returns:
+    <tuple> with the latitude and longitude of the delivery point, None when not sent.
+  """
+  if body.get('latitud') is None or body.get('longitud') is None:
+    return None
+  return body['latitud'], body['longitud']
+
+def process_orders(orders, context):
+  """
+  Schedule the lifecycle events of a batch of orders and notify every party, sharing
+  the work across the batch: the stage times of each restaurant in one pass, a single
+  transaction for their state, one email per restaurant, every email in the same
+  Postmark batch and notification router schedules per fire time.
+  Parameters:
+    orders: <list> of (body, restaurant, items) tuples with the validated orders.
+    context: Lambda runtime context.
+  Returns:
+    <list> of <Dict> with the status of every order.
+  """
+  if not orders:
+    return []
+  import digest, eta, order_state, routing
+  ids = [order_ids.new_id() for _ in orders]
+  with tracing.span("times"):
+    runtime_tz, mex_tz = timezones()
+    now = datetime.now(tz=runtime_tz)
+    groups = {}
+    for position, (body, restaurant, items) in enumerate(orders):
+      groups.setdefault(restaurant.id, []).append(position)
+    estimates = [None] * len(orders)
+    for positions in groups.values():
+      restaurant = orders[positions[0]][1]
+      batch = [(now, orders[position][2], order_location(orders[position][0]), orders[position][0]['direccion']) for position in positions]
+      for position, estimate in zip(positions, eta.default_estimator().estimate_many(batch, restaurant.id, restaurant.zone)):
+        estimates[position] = estimate
+    pickup_times = [estimate.pickup.astimezone(mex_tz).strftime(time_format) for estimate in estimates]
+  offered, assigned = {}, [None] * len(orders)
+  if DISPATCH_MODE == "offers":
+    import offers
+    for position, ((body, restaurant, _), estimate) in enumerate(zip(orders, estimates)):
+      details = {"delivery_address": body['direccion'], "expected_pickup": pickup_times[position], "distance": "{:.1f}Km".format(estimate.distance_km)}
+      offered[position] = partial(offers.default_engine().offer, ids[position], restaurant, details, estimate.arrival.timestamp())
+  else:
+    with tracing.span("routing"):
+      couriers = routing.default_registry().couriers
+      for position, ((_, restaurant, _), estimate) in enumerate(zip(orders, estimates)):
+        assigned[position] = couriers.assign(restaurant.location, estimate.arrival.timestamp())
+  courier_ids = [courier[0].id if courier is not None else None for courier in assigned]
+  with tracing.span("state"):
+    order_state.default_store().create_many([
+      (ids[position], restaurant.id, estimate.zone, now, estimate, courier_ids[position])
+      for position, ((_, restaurant, _), estimate) in enumerate(zip(orders, estimates))
+    ])
+  # Schedules as (create_schedule arguments, positions of the orders they serve)
+  with tracing.span("build_schedules"):
+    steps = [
+      build_steps(estimate.confirmation, estimate.pickup, estimate.arrival, estimate.feedback, ids[position], body['correo'], body['nombre'], restaurant, courier_ids[position])
+      for position, ((body, restaurant, _), estimate) in enumerate(zip(orders, estimates))
+    ]
+    if NOTIFICATION_ROUTER:
+      schedules = build_batch_events(ids[0], [(position, step) for position, order_steps in enumerate(steps) for step in order_steps])
+    elif SCHEDULE_MODE == "timeline":
+      import timeline
+      schedules = [(timeline.registration(ids[position], order_steps, LAMBDA_ARN.format(timeline.DISPATCHER_FUNCTION), ROLE_ARN), [position]) for position, order_steps in enumerate(steps)]
+    else:
+      schedules = [
+        (schedule, [position])
+        for position, ((body, restaurant, _), estimate) in enumerate(zip(orders, estimates))
+        for schedule in build_events(estimate.confirmation, estimate.pickup, estimate.arrival, estimate.feedback, ids[position], body['correo'], body['nombre'], restaurant, courier_ids[position]).values()
+      ]
+  # Emails as (label, positions of the orders they are about, message)
+  with tracing.span("render"):
+    tables = [items_table(items) for _, _, items in orders]
+    tickets = SIDE_EFFECTS == "outbox" and digest.enabled()
+    emails = []
+    for positions in groups.values():
+      restaurant = orders[positions[0]][1]
+      if len(positions) > 1 and not tickets:
+        # A single kitchen ticket with every order of the batch
+        ticket = [{"order_id": ids[position], "expected_pickup": pickup_times[position], "items": tables[position]} for position in positions]
+        emails.append(("notify_restaurant", positions, (restaurant.email,) + digest.ticket("new_order", restaurant.name, ticket)))
+      else:
+        emails.extend(
+          ("notify_restaurant", [position], restaurant_email(restaurant.email, ids[position], tables[position], orders[position][0]['total'], pickup_times[position], restaurant.name))
+          for position in positions
+        )
+    for position, ((body, restaurant, _), estimate) in enumerate(zip(orders, estimates)):
+      if assigned[position] is not None:
+        courier = assigned[position][0]
+        emails.append(("notify_delivery", [position], delivery_email(courier.email, body['direccion'], pickup_times[position], "{:.1f}Km".format(estimate.distance_km), courier.name, restaurant.name, restaurant.address, ids[position], courier.id)))
+      elif position not in offered:
+        logger.warning("No courier free for order %s at %s", ids[position], restaurant.id)
+      emails.append(("notify_customer", [position], customer_email(body['correo'], body['nombre'], ids[position], body['total'], estimate.arrival.astimezone(mex_tz).strftime(time_format), body['direccion'], restaurant.name)))
+  if SIDE_EFFECTS == "outbox":
+    # Every order with its side effects in one transaction, those of several orders kept with the first
+    import outbox
+    effects = [[] for _ in orders]
+    for schedule, positions in schedules:
+      effects[positions[0]].append(("schedule", schedule))
+    for label, positions, (receiver, subject, email_body) in emails:
+      payload = {"From": EMAIL_FROM, "To": receiver, "Subject": subject, "HtmlBody": email_body}
+      if label == "notify_restaurant" and tickets:
+        restaurant = orders[positions[0]][1]
+        payload.update(digest="new_order", restaurant=restaurant.name, order_id=ids[positions[0]], expected_pickup=pickup_times[positions[0]], items=tables[positions[0]])
+        effects[positions[0]].append(("ticket", payload))
+      else:
+        effects[positions[0]].append(("email", payload))
+    with tracing.span("outbox"):
+      outbox.default_outbox().record_many([(ids[position], body, effects[position]) for position, (body, _, _) in enumerate(orders)])
+    flush_outbox(ids)
+    if offered:
+      with tracing.span("offers"):
+        for offer in offered.values():
+          offer()
+    return [{"statusCode": 202, "message": "Order received successfully, will start processing.", "order_id": id} for id in ids]
+  client = clients.scheduler()
+  dispatcher = clients.dispatcher()
+  served = {}
+  tasks = {}
+  for schedule, positions in schedules:
+    tasks[schedule["Name"]] = tracing.timed("create_schedule", partial(client.create_schedule, **schedule))
+    served[schedule["Name"]] = positions
+  for position, offer in offered.items():
+    tasks["offer_couriers_{}".format(position)] = tracing.timed("offers", offer)
+    served["offer_couriers_{}".format(position)] = [position]
+  # The emails of the whole batch leave in as few Postmark requests as possible
+  sent = [(label, positions, dispatcher.enqueue(receiver, subject, email_body, EMAIL_FROM)) for label, positions, (receiver, subject, email_body) in emails]
+  tasks["emails"] = tracing.timed("email", dispatcher.flush)
+  with tracing.span("side_effects"):
+    failures = run_tasks(tasks)
+  order_failures = [{} for _ in orders]
+  for label, error in failures.items():
+    for position in served.get(label, []):
+      order_failures[position][label] = error
+  for label, positions, future in sent:
+    error = future.exception()
+    if error is not None:
+      for position in positions:
+        order_failures[position][label] = str(error)
+  return [
+    {"statusCode": 502, "message": "Order received, but some side effects failed.", "order_id": id, "failures": failed}
+    if failed else
+    {"statusCode": 200, "message": "Order received successfully, will start processing.", "order_id": id}
+    for id, failed in zip(ids, order_failures)
+  ]
 
 if __name__ == "__main__":
-  logger.warning("Local invocation detected, using fixed event.")
+  import random
+  from types import SimpleNamespace
+  logger.warning("Local invocation detected, using fixed event. See bench/load.py to run against fakes.")
   random.seed()
-  context = {}
-  event = {
-    "event_id": "{:06d}".format(random.randrange(1, 999999)),
+  context = SimpleNamespace(aws_request_id="local", invoked_function_arn=LAMBDA_ARN.format("orderCreate"))
+  body = {
     "nombre": "Mariano",
     "apellido": "Rodríguez",
     "correo": "marianox1994@gmail.com",
@@ -302,4 +717,9 @@ if __name__ == "__main__":
     "total": "148.25",
     "direccion": "Col. Santa Cruz Buenavista, Puebla"
   }
-  lambda_handler(event, context)
+  # API Gateway delivers the body as a JSON string
+  event = {
+    "body": json.dumps(body),
+    "headers": {"idempotency-key": "{:06d}".format(random.randrange(1, 999999))}
+  }
+  print(lambda_handler(event, context))
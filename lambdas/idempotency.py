@@ -0,0 +1,158 @@
+import hashlib, json, os, sqlite3, threading, time
+from collections import OrderedDict
+from functools import lru_cache
+
+# Load env
+TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL', '3600'))
+# How long an in-progress claim blocks retries, slightly above the 30 s function timeout
+# so the claim of a request killed mid-flight expires instead of lasting the full TTL
+LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE', '35'))
+MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', '10000'))
+DB_PATH = os.environ.get('IDEMPOTENCY_DB')
+
+# Value stored while the first request is still running
+IN_PROGRESS = "__in_progress__"
+
+def request_key(body, client_key=None):
+  """
+  Hash an order request so retries of the same request map to the same key.
+  Parameters:
+    body: <Dict> with the parsed order body.
+    client_key: <string> with the Idempotency-Key sent by the client, if any.
+  Returns:
+    <string> with the hex digest identifying the request.
+  """
+  # default=str serializes the Decimal total the way it was sent
+  digest = hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":"), default=str).encode())
+  if client_key:
+    digest.update(b"\0" + client_key.encode())
+  return digest.hexdigest()
+
+class MemoryStore:
+  """
+  Bounded in-memory tier: least recently used entries are evicted past max_entries,
+  and entries expire after their TTL.
+  """
+  def __init__(self, max_entries=MAX_ENTRIES):
+    self.max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      if entry[1] < time.time():
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return entry[0]
+
+  def put(self, key, value, ttl=TTL_SECONDS):
+    with self._lock:
+      self._entries[key] = (value, time.time() + ttl)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def claim(self, key, ttl=LEASE_SECONDS):
+    """
+    Atomically mark a key as in progress for ttl seconds.
+    Returns:
+      <bool> True when the key was free and is now claimed by the caller.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] >= time.time():
+        return False
+      self._entries[key] = (IN_PROGRESS, time.time() + ttl)
+      return True
+
+  def delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+class SQLiteStore:
+  """
+  Persistent tier kept in a SQLite file, a local stand-in for a shared table.
+  """
+  def __init__(self, path):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      row = self._db.execute("SELECT value FROM idempotency WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+    return None if row is None else json.loads(row[0])
+
+  def put(self, key, value, ttl=TTL_SECONDS):
+    with self._lock:
+      self._db.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?)", (key, json.dumps(value), time.time() + ttl))
+
+  def claim(self, key, ttl=LEASE_SECONDS):
+    now = time.time()
+    with self._lock:
+      self._db.execute("DELETE FROM idempotency WHERE key = ? AND expires < ?", (key, now))
+      cursor = self._db.execute("INSERT OR IGNORE INTO idempotency VALUES (?, ?, ?)", (key, json.dumps(IN_PROGRESS), now + ttl))
+    return cursor.rowcount == 1
+
+  def delete(self, key):
+    with self._lock:
+      self._db.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+class IdempotencyStore:
+  """
+  Two-tier store: the in-memory tier answers warm retries without I/O, the optional
+  persistent tier catches retries that land on another container. Claims hold for
+  the short lease, results are kept for the full TTL.
+  """
+  def __init__(self, memory=None, persistent=None, ttl=TTL_SECONDS, lease=LEASE_SECONDS):
+    self.memory = memory or MemoryStore()
+    self.persistent = persistent
+    self.ttl = ttl
+    self.lease = lease
+
+  def get(self, key):
+    """
+    Returns:
+      The stored result, IN_PROGRESS, or None when the request was not seen.
+    """
+    value = self.memory.get(key)
+    if value is None and self.persistent is not None:
+      value = self.persistent.get(key)
+      if value is not None and value != IN_PROGRESS:
+        self.memory.put(key, value, self.ttl)
+    return value
+
+  def claim(self, key):
+    """
+    Returns:
+      <bool> True when the caller should process the request.
+    """
+    if self.persistent is not None and not self.persistent.claim(key, self.lease):
+      return False
+    return self.memory.claim(key, self.lease)
+
+  def put(self, key, value):
+    self.memory.put(key, value, self.ttl)
+    if self.persistent is not None:
+      self.persistent.put(key, value, self.ttl)
+
+  def release(self, key):
+    """
+    Drop a claim so the request can be retried, e.g. after an unexpected error.
+    """
+    self.memory.delete(key)
+    if self.persistent is not None:
+      self.persistent.delete(key)
+
+@lru_cache(maxsize=None)
+def default_store():
+  """
+  Returns:
+    <IdempotencyStore> shared by the process, persisted to IDEMPOTENCY_DB when set.
+  """
+  return IdempotencyStore(persistent=SQLiteStore(DB_PATH) if DB_PATH else None)
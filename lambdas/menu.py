@@ -0,0 +1,202 @@
+import json, os, re, unicodedata
+from bisect import bisect_left
+from decimal import Decimal
+from functools import lru_cache
+import order_schema
+
+# Load env
+MENU_PATH = os.environ.get('MENU_PATH')
+FUZZY_THRESHOLD = float(os.environ.get('MENU_FUZZY_THRESHOLD', '0.6'))
+MAX_QUANTITY = int(os.environ.get('MENU_MAX_QUANTITY', '99'))
+
+# Menu of the restaurant: name, price, preparation minutes and other names it is ordered by
+MENU = [
+  {"name": "Pizza Margarita", "price": "99.00", "prep_minutes": 15, "aliases": ["margarita"]},
+  {"name": "Pizza Pepperoni", "price": "119.00", "prep_minutes": 15, "aliases": ["pepperoni"]},
+  {"name": "Coca-Cola regular", "price": "24.25", "prep_minutes": 1, "aliases": ["coca", "coca cola", "coca-cola"]},
+  {"name": "Coca-Cola sin azúcar", "price": "24.25", "prep_minutes": 1, "aliases": ["coca light", "coca zero"]},
+  {"name": "Brownie", "price": "25.00", "prep_minutes": 2, "aliases": []},
+  {"name": "Tacos al pastor", "price": "85.00", "prep_minutes": 8, "aliases": ["pastor", "tacos de pastor"]},
+  {"name": "Tacos de suadero", "price": "85.00", "prep_minutes": 8, "aliases": ["suadero"]},
+  {"name": "Quesadilla", "price": "45.00", "prep_minutes": 6, "aliases": ["quesadillas"]},
+  {"name": "Chilaquiles verdes", "price": "95.00", "prep_minutes": 10, "aliases": []},
+  {"name": "Chilaquiles rojos", "price": "95.00", "prep_minutes": 10, "aliases": []},
+  {"name": "Enchiladas suizas", "price": "110.00", "prep_minutes": 12, "aliases": ["enchiladas"]},
+  {"name": "Pozole rojo", "price": "120.00", "prep_minutes": 5, "aliases": ["pozole"]},
+  {"name": "Guacamole con totopos", "price": "75.00", "prep_minutes": 5, "aliases": ["guacamole"]},
+  {"name": "Torta ahogada", "price": "90.00", "prep_minutes": 8, "aliases": ["torta"]},
+  {"name": "Elote", "price": "35.00", "prep_minutes": 4, "aliases": ["elotes", "esquite"]},
+  {"name": "Churros", "price": "45.00", "prep_minutes": 6, "aliases": []},
+  {"name": "Flan napolitano", "price": "40.00", "prep_minutes": 1, "aliases": ["flan"]},
+  {"name": "Agua de horchata", "price": "30.00", "prep_minutes": 1, "aliases": ["horchata"]},
+  {"name": "Agua de jamaica", "price": "30.00", "prep_minutes": 1, "aliases": ["jamaica"]},
+  {"name": "Café de olla", "price": "28.00", "prep_minutes": 3, "aliases": ["cafe"]},
+]
+
+_separators = re.compile(r"\s*(?:[,;\n+]|\by\b(?=\s+\d))\s*")
+_quantity = re.compile(r"^(?:(?P<prefix>\d+)\s*[x×*]\s*|(?P<count>\d+)\s+)?(?P<name>.*?)(?:\s*[x×*]\s*(?P<suffix>\d+))?$", re.IGNORECASE)
+_not_alnum = re.compile(r"[^a-z0-9]+")
+
+def normalize(text):
+  """
+  Returns:
+    <string> lower case, without accents and with single spaces between words.
+  """
+  text = unicodedata.normalize("NFKD", text)
+  text = "".join(char for char in text if not unicodedata.combining(char))
+  return _not_alnum.sub(" ", text.lower()).strip()
+
+def trigrams(key):
+  padded = "  {} ".format(key)
+  return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+class MenuItem:
+  __slots__ = ("name", "price", "prep_minutes")
+
+  def __init__(self, name, price, prep_minutes):
+    self.name = name
+    self.price = Decimal(price)
+    self.prep_minutes = prep_minutes
+
+class LineItem:
+  """
+  A line of an order: the quantity, the text as written and the menu item it
+  matched, if any, with the match score (1.0 for an exact match).
+  """
+  __slots__ = ("quantity", "text", "item", "score")
+
+  def __init__(self, quantity, text, item, score):
+    self.quantity = quantity
+    self.text = text
+    self.item = item
+    self.score = score
+
+  @property
+  def name(self):
+    return self.item.name if self.item else self.text
+
+  @property
+  def subtotal(self):
+    return self.item.price * self.quantity if self.item else None
+
+class ParsedOrder:
+  __slots__ = ("lines",)
+
+  def __init__(self, lines):
+    self.lines = lines
+
+  @property
+  def complete(self):
+    """
+    <bool> True when every line matched a menu item, so the total is known.
+    """
+    return bool(self.lines) and all(line.item for line in self.lines)
+
+  @property
+  def total(self):
+    return sum((line.subtotal for line in self.lines if line.item), Decimal("0.00"))
+
+  @property
+  def prep_minutes(self):
+    """
+    <list> with the preparation minutes of every unit ordered.
+    """
+    return [line.item.prep_minutes for line in self.lines if line.item for _ in range(line.quantity)]
+
+class MenuIndex:
+  """
+  Menu lookup by exact name or alias (hash), by unique prefix (sorted keys) and by
+  trigram similarity for typos, caching the result of every text seen.
+  """
+  def __init__(self, items, threshold=FUZZY_THRESHOLD):
+    self.threshold = threshold
+    self.keys = {}
+    self.grams = {}
+    self.sizes = {}
+    for entry in items:
+      item = MenuItem(entry["name"], entry["price"], entry.get("prep_minutes", 0))
+      for name in [entry["name"]] + list(entry.get("aliases", [])):
+        key = normalize(name)
+        self.keys.setdefault(key, item)
+        grams = trigrams(key)
+        self.sizes[key] = len(grams)
+        for gram in grams:
+          self.grams.setdefault(gram, set()).add(key)
+    self.sorted_keys = sorted(self.keys)
+    self.lookup = lru_cache(maxsize=4096)(self._lookup)
+
+  def _lookup(self, text):
+    """
+    Parameters:
+      text: <string> with the name of an item as written by the customer.
+    Returns:
+      <tuple> with the matched MenuItem, or None, and the match score.
+    """
+    key = normalize(text)
+    if not key:
+      return None, 0.0
+    item = self.keys.get(key)
+    if item is not None:
+      return item, 1.0
+    start = bisect_left(self.sorted_keys, key)
+    prefixed = set()
+    for candidate in self.sorted_keys[start:]:
+      if not candidate.startswith(key) or len(prefixed) > 1:
+        break
+      prefixed.add(self.keys[candidate])
+    if len(prefixed) == 1:
+      return prefixed.pop(), 0.9
+    grams = trigrams(key)
+    shared = {}
+    for gram in grams:
+      for candidate in self.grams.get(gram, ()):
+        shared[candidate] = shared.get(candidate, 0) + 1
+    best, score = None, 0.0
+    for candidate, count in shared.items():
+      # Dice coefficient of the trigram sets
+      similarity = 2.0 * count / (len(grams) + self.sizes[candidate])
+      if similarity > score:
+        best, score = candidate, similarity
+    if best is None or score < self.threshold:
+      return None, score
+    return self.keys[best], score
+
+  def parse(self, text):
+    """
+    Split an order written as free text, e.g. "2x Pizza Margarita, Coca-Cola regular",
+    into line items. Quantities go before the name ("2x", "2 x", "2") or after it ("x2").
+    Parameters:
+      text: <string> with the order.
+    Returns:
+      <ParsedOrder>
+    Raises:
+      order_schema.ValidationError when a quantity is not between 1 and MAX_QUANTITY.
+    """
+    lines = []
+    for part in _separators.split(text):
+      if not part:
+        continue
+      match = _quantity.match(part)
+      quantity = match.group("prefix") or match.group("count") or match.group("suffix")
+      name = match.group("name") or part
+      item, score = self.lookup(name)
+      if item is None and match.group("count"):
+        # A leading number that is part of the name, e.g. "7 leguas"
+        item, score = self.lookup(part)
+        if item is not None:
+          name, quantity = part, None
+      if quantity is not None and not 1 <= int(quantity) <= MAX_QUANTITY:
+        raise order_schema.ValidationError({"pedido": "quantity of {} must be between 1 and {}".format(name, MAX_QUANTITY)})
+      lines.append(LineItem(int(quantity or 1), name, item, score))
+    return ParsedOrder(lines)
+
+@lru_cache(maxsize=None)
+def default_index():
+  """
+  Returns:
+    <MenuIndex> of the menu at MENU_PATH (a JSON list like MENU), or of MENU.
+  """
+  if MENU_PATH:
+    with open(MENU_PATH) as file:
+      return MenuIndex(json.load(file))
+  return MenuIndex(MENU)
@@ -0,0 +1,391 @@
+import heapq, hashlib, hmac, json, logging, os, sqlite3, threading, time
+from functools import lru_cache
+from urllib.parse import urlencode
+import clients, routing, templates, tracing
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Shared by hacer-pedido and asignar-repartidor, a /tmp default would be private to each
+DB_PATH = os.environ.get('OFFERS_DB')
+WAVE_SIZE = int(os.environ.get('OFFERS_WAVE_SIZE', '3'))
+MAX_WAVES = int(os.environ.get('OFFERS_MAX_WAVES', '3'))
+TIMEOUT_SECONDS = int(os.environ.get('OFFERS_TIMEOUT_SECONDS', '30'))
+RESPOND_URL = os.environ.get('OFFERS_URL')
+SECRET = os.environ.get('OFFERS_SECRET', '').encode()
+FALLBACK_EMAIL = os.environ.get('OFFERS_FALLBACK_EMAIL', routing.DELIVERY_EMAIL)
+EMAIL_FROM = "AjoloEats <{}>".format(os.environ.get('EMAIL_FROM'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dispatches (
+  order_id TEXT PRIMARY KEY,
+  restaurant_id TEXT NOT NULL,
+  details TEXT NOT NULL,
+  until REAL NOT NULL,
+  wave INTEGER NOT NULL,
+  expires REAL NOT NULL,
+  status TEXT NOT NULL DEFAULT 'open',
+  courier_id TEXT,
+  created REAL NOT NULL,
+  assigned REAL
+);
+CREATE INDEX IF NOT EXISTS dispatches_open ON dispatches (status, expires);
+CREATE TABLE IF NOT EXISTS offers (
+  order_id TEXT NOT NULL,
+  courier_id TEXT NOT NULL,
+  wave INTEGER NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  PRIMARY KEY (order_id, courier_id)
+);
+"""
+
+def token(order_id, courier_id, action):
+  """
+  Returns:
+    <string> signing a link of a courier for a single action, so it cannot be forged for
+    another courier nor turned into another action.
+  Raises:
+    RuntimeError when OFFERS_SECRET is not set, links signed with an empty key could be forged.
+  """
+  if not SECRET:
+    raise RuntimeError("OFFERS_SECRET must be set to sign the courier links")
+  return hmac.new(SECRET, "{}:{}:{}".format(order_id, courier_id, action).encode(), hashlib.sha256).hexdigest()[:32]
+
+def verify(order_id, courier_id, action, signature):
+  return hmac.compare_digest(token(order_id, courier_id, action), signature or "")
+
+def link(order_id, courier_id, action):
+  """
+  Returns:
+    <string> with the signed URL of an action of the courier on an order.
+  """
+  query = {"order": order_id, "courier": courier_id, "action": action, "token": token(order_id, courier_id, action)}
+  return "{}?{}".format(RESPOND_URL, urlencode(query))
+
+def courier_actions(order_id, courier_id):
+  """
+  Returns:
+    <string> with the links the courier confirms the pickup and the delivery of an
+    order with, empty when OFFERS_URL is not set.
+  """
+  if not RESPOND_URL:
+    return ""
+  return templates.render("courier_actions", pickup=link(order_id, courier_id, "pickup"), deliver=link(order_id, courier_id, "deliver"))
+
+class OfferStore:
+  """
+  Dispatches and their offers kept in SQLite, a local stand-in for a shared table.
+  A dispatch is assigned with a conditional update, so only the first acceptance wins.
+  """
+  def __init__(self, path=DB_PATH):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.executescript(SCHEMA)
+    self._lock = threading.Lock()
+
+  def _transaction(self, work):
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        result = work(self._db)
+        self._db.execute("COMMIT")
+        return result
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+
+  def open(self, order_id, restaurant_id, details, until, expires, courier_ids, now):
+    """
+    Store a dispatch with the offers of its first wave.
+    Returns:
+      <bool> False when the order was already being dispatched, e.g. on a retry.
+    """
+    def work(db):
+      cursor = db.execute(
+        "INSERT OR IGNORE INTO dispatches (order_id, restaurant_id, details, until, wave, expires, created) VALUES (?, ?, ?, ?, 1, ?, ?)",
+        (order_id, restaurant_id, json.dumps(details), until, expires, now)
+      )
+      if cursor.rowcount != 1:
+        return False
+      db.executemany("INSERT INTO offers (order_id, courier_id, wave) VALUES (?, ?, 1)", [(order_id, courier_id) for courier_id in courier_ids])
+      return True
+    return self._transaction(work)
+
+  def add_wave(self, order_id, wave, expires, courier_ids):
+    """
+    Move an open dispatch from wave - 1 to wave, offering it to more couriers.
+    Returns:
+      <bool> False when it was assigned or escalated meanwhile.
+    """
+    def work(db):
+      cursor = db.execute(
+        "UPDATE dispatches SET wave = ?, expires = ? WHERE order_id = ? AND status = 'open' AND wave = ?",
+        (wave, expires, order_id, wave - 1)
+      )
+      if cursor.rowcount != 1:
+        return False
+      db.executemany("INSERT OR IGNORE INTO offers (order_id, courier_id, wave) VALUES (?, ?, ?)", [(order_id, courier_id, wave) for courier_id in courier_ids])
+      return True
+    return self._transaction(work)
+
+  def accept(self, order_id, courier_id, now):
+    """
+    Assign the dispatch to the courier if it is still open and the courier holds a pending offer.
+    Returns:
+      <Dict> with the dispatch and the couriers whose offers got cancelled, or None when
+      another courier won or the offer is no longer pending.
+    """
+    def work(db):
+      cursor = db.execute(
+        "UPDATE dispatches SET status = 'assigned', courier_id = ?, assigned = ? WHERE order_id = ? AND status = 'open' "
+        "AND EXISTS (SELECT 1 FROM offers WHERE order_id = ? AND courier_id = ? AND status = 'pending')",
+        (courier_id, now, order_id, order_id, courier_id)
+      )
+      if cursor.rowcount != 1:
+        return None
+      db.execute("UPDATE offers SET status = 'accepted' WHERE order_id = ? AND courier_id = ?", (order_id, courier_id))
+      cancelled = [row[0] for row in db.execute("SELECT courier_id FROM offers WHERE order_id = ? AND status = 'pending'", (order_id,))]
+      db.execute("UPDATE offers SET status = 'cancelled' WHERE order_id = ? AND status = 'pending'", (order_id,))
+      dispatch = self._dispatch(db, order_id)
+      dispatch["cancelled"] = cancelled
+      return dispatch
+    return self._transaction(work)
+
+  def decline(self, order_id, courier_id):
+    """
+    Returns:
+      <int> with the offers of the dispatch still pending, or None when the offer was not pending.
+    """
+    def work(db):
+      cursor = db.execute("UPDATE offers SET status = 'declined' WHERE order_id = ? AND courier_id = ? AND status = 'pending'", (order_id, courier_id))
+      if cursor.rowcount != 1:
+        return None
+      return db.execute("SELECT COUNT(*) FROM offers WHERE order_id = ? AND status = 'pending'", (order_id,)).fetchone()[0]
+    return self._transaction(work)
+
+  def give_up(self, order_id, wave):
+    """
+    Close a dispatch that no courier accepted after its last wave.
+    Returns:
+      <bool> False when it was assigned or escalated meanwhile.
+    """
+    def work(db):
+      cursor = db.execute("UPDATE dispatches SET status = 'unassigned' WHERE order_id = ? AND status = 'open' AND wave = ?", (order_id, wave))
+      if cursor.rowcount != 1:
+        return False
+      db.execute("UPDATE offers SET status = 'expired' WHERE order_id = ? AND status = 'pending'", (order_id,))
+      return True
+    return self._transaction(work)
+
+  @staticmethod
+  def _dispatch(db, order_id):
+    row = db.execute(
+      "SELECT order_id, restaurant_id, details, until, wave, expires, status, courier_id, created, assigned FROM dispatches WHERE order_id = ?",
+      (order_id,)
+    ).fetchone()
+    if row is None:
+      return None
+    names = ("order_id", "restaurant_id", "details", "until", "wave", "expires", "status", "courier_id", "created", "assigned")
+    dispatch = dict(zip(names, row))
+    dispatch["details"] = json.loads(dispatch["details"])
+    return dispatch
+
+  def dispatch(self, order_id):
+    with self._lock:
+      return self._dispatch(self._db, order_id)
+
+  def offered(self, order_id):
+    """
+    Returns:
+      <set> with the couriers the order was offered to in any wave.
+    """
+    with self._lock:
+      return {row[0] for row in self._db.execute("SELECT courier_id FROM offers WHERE order_id = ?", (order_id,))}
+
+  def open_waves(self):
+    """
+    Returns:
+      <list> of (expires, order_id, wave) tuples of every open dispatch.
+    """
+    with self._lock:
+      return [tuple(row) for row in self._db.execute("SELECT expires, order_id, wave FROM dispatches WHERE status = 'open'")]
+
+class DispatchEngine:
+  """
+  Offer an order to the WAVE_SIZE best free couriers at once and give it to the first
+  one that accepts, cancelling the other offers. A wave nobody accepts within
+  TIMEOUT_SECONDS escalates to the next best couriers, up to MAX_WAVES waves, and
+  then to FALLBACK_EMAIL. Open waves wait in an expiry heap of (expires, order_id,
+  wave) tuples, one per dispatch rather than per offer, escalated by expire() from the
+  scheduled sweep of asignar-repartidor: a frozen Lambda runs no background thread.
+  """
+  def __init__(self, store, registry=None, dispatcher=None, wave_size=WAVE_SIZE, max_waves=MAX_WAVES, timeout=TIMEOUT_SECONDS):
+    self.store = store
+    self.registry = registry
+    self.dispatcher = dispatcher
+    self.wave_size = wave_size
+    self.max_waves = max_waves
+    self.timeout = timeout
+    self.heap = []
+    self._tracked = set()
+    self._lock = threading.Lock()
+
+  def _registry(self):
+    return self.registry or routing.default_registry()
+
+  def _dispatcher(self):
+    return self.dispatcher or clients.dispatcher()
+
+  def _push(self, expires, order_id, wave):
+    with self._lock:
+      if (order_id, wave) not in self._tracked:
+        self._tracked.add((order_id, wave))
+        heapq.heappush(self.heap, (expires, order_id, wave))
+
+  def reload(self):
+    """
+    Track the open waves of the store, including those of dispatches started by other instances.
+    """
+    for expires, order_id, wave in self.store.open_waves():
+      self._push(expires, order_id, wave)
+
+  def offer(self, order_id, restaurant, details, until, now=None):
+    """
+    Start dispatching an order with its first wave of offers.
+    Parameters:
+      order_id: <string> with the order identifier.
+      restaurant: <Restaurant> where the order is picked up.
+      details: <Dict> with the delivery_address, expected_pickup and distance shown in the offer.
+      until: <float> with the timestamp the courier is expected to be free again.
+    Returns:
+      <list> with the ids of the couriers offered the order.
+    """
+    now = time.time() if now is None else now
+    couriers = [courier for _, _, courier in self._registry().couriers.nearest(restaurant.location, self.wave_size, now)]
+    expires = now + self.timeout
+    if not self.store.open(order_id, restaurant.id, details, until, expires, [courier.id for courier in couriers], now):
+      return []
+    self._push(expires, order_id, 1)
+    self._send_offers(order_id, restaurant, details, couriers)
+    return [courier.id for courier in couriers]
+
+  def _send_offers(self, order_id, restaurant, details, couriers):
+    dispatcher = self._dispatcher()
+    futures = []
+    for courier in couriers:
+      actions = ""
+      if RESPOND_URL:
+        actions = templates.render("offer_actions", accept=link(order_id, courier.id, "accept"), decline=link(order_id, courier.id, "decline"))
+      subject = "Nueva Entrega Disponible - {}".format(order_id)
+      body = templates.render(
+        "delivery_offer", title=subject, delivery_name=courier.name, order_id=order_id, restaurant=restaurant.name,
+        restaurant_address=restaurant.address, timeout=self.timeout, actions=actions, **details
+      )
+      futures.append((courier.id, dispatcher.enqueue(courier.email, subject, body, EMAIL_FROM)))
+    dispatcher.flush()
+    for courier_id, future in futures:
+      if future.exception() is not None:
+        logger.error("Offer of order %s to courier %s failed: %s", order_id, courier_id, future.exception())
+
+  def respond(self, order_id, courier_id, accepted, now=None):
+    """
+    Record the answer of a courier to an offer.
+    Returns:
+      <string> "assigned" when the courier got the order, "taken" when it was already
+      assigned or the offer is no longer open, "declined" otherwise.
+    """
+    now = time.time() if now is None else now
+    if not accepted:
+      pending = self.store.decline(order_id, courier_id)
+      if pending == 0:
+        # Every courier of the wave said no, no need to wait for the timeout
+        dispatch = self.store.dispatch(order_id)
+        if dispatch is not None and dispatch["status"] == "open":
+          self._escalate(order_id, dispatch["wave"], now)
+      return "declined"
+    dispatch = self.store.accept(order_id, courier_id, now)
+    if dispatch is None:
+      return "taken"
+    registry = self._registry()
+    registry.couriers.take(courier_id, dispatch["until"])
+    # Time to assignment, the latency that matters most for the delivery
+    tracing.add("time_to_assignment", (now - dispatch["created"]) * 1000)
+    logger.info("Order %s assigned to courier %s after %.1fs", order_id, courier_id, now - dispatch["created"])
+    dispatcher = self._dispatcher()
+    courier = registry.couriers.couriers.get(courier_id)
+    if courier is not None:
+      subject = "Entrega asignada - {}".format(order_id)
+      restaurant = registry.restaurant(dispatch["restaurant_id"])
+      body = templates.render(
+        "offer_assigned", title=subject, delivery_name=courier.name, order_id=order_id,
+        restaurant_address=restaurant.address if restaurant else "el restaurante", actions=courier_actions(order_id, courier_id)
+      )
+      dispatcher.enqueue(courier.email, subject, body, EMAIL_FROM)
+    for other in dispatch["cancelled"]:
+      courier = registry.couriers.couriers.get(other)
+      if courier is not None:
+        subject = "Entrega asignada - {}".format(order_id)
+        dispatcher.enqueue(courier.email, subject, templates.render("offer_cancelled", title=subject, delivery_name=courier.name, order_id=order_id), EMAIL_FROM)
+    dispatcher.flush()
+    return "assigned"
+
+  def _escalate(self, order_id, wave, now):
+    dispatch = self.store.dispatch(order_id)
+    if dispatch is None or dispatch["status"] != "open" or dispatch["wave"] != wave:
+      return False
+    restaurant = self._registry().restaurant(dispatch["restaurant_id"])
+    if wave >= self.max_waves or restaurant is None:
+      if not self.store.give_up(order_id, wave):
+        return False
+      logger.warning("No courier accepted order %s after %d waves", order_id, wave)
+      if FALLBACK_EMAIL and restaurant is not None:
+        subject = "Entrega sin repartidor - {}".format(order_id)
+        body = templates.render(
+          "delivery_offer", title=subject, delivery_name="equipo de reparto", order_id=order_id, restaurant=restaurant.name,
+          restaurant_address=restaurant.address, timeout=self.timeout, actions="", **dispatch["details"]
+        )
+        self._dispatcher().send(FALLBACK_EMAIL, subject, body, EMAIL_FROM)
+      return True
+    offered = self.store.offered(order_id)
+    couriers = [courier for _, _, courier in self._registry().couriers.nearest(restaurant.location, self.wave_size, now, offered)]
+    expires = now + self.timeout
+    if not self.store.add_wave(order_id, wave + 1, expires, [courier.id for courier in couriers]):
+      return False
+    self._push(expires, order_id, wave + 1)
+    self._send_offers(order_id, restaurant, dispatch["details"], couriers)
+    return True
+
+  def expire(self, now=None):
+    """
+    Escalate every wave whose offers timed out.
+    Returns:
+      <int> with the number of dispatches escalated.
+    """
+    now = time.time() if now is None else now
+    escalated = 0
+    while True:
+      with self._lock:
+        if not self.heap or self.heap[0][0] > now:
+          break
+        _, order_id, wave = heapq.heappop(self.heap)
+        self._tracked.discard((order_id, wave))
+      try:
+        escalated += self._escalate(order_id, wave, now)
+      except Exception as error:
+        logger.error("Cannot escalate order %s: %s", order_id, error)
+    return escalated
+
+@lru_cache(maxsize=None)
+def default_engine():
+  """
+  Returns:
+    <DispatchEngine> shared by the process, with its offers stored at OFFERS_DB.
+  Raises:
+    RuntimeError when OFFERS_DB is not set.
+  """
+  if not DB_PATH:
+    raise RuntimeError("OFFERS_DB must point to the offers shared by hacer-pedido and asignar-repartidor")
+  return DispatchEngine(OfferStore())
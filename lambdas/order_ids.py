@@ -0,0 +1,87 @@
+import os, threading, time
+
+# Crockford base32, in ascending ASCII order so ids sort by time
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_pairs = [a + b for a in ALPHABET for b in ALPHABET]
+
+# Id layout: 10 chars of milliseconds since epoch, 6 chars of node and 4 chars of counter
+TIME_CHARS = 10
+NODE_BITS = 30
+COUNTER_BITS = 20
+COUNTER_MAX = (1 << COUNTER_BITS) - 1
+
+def encode(value, length):
+  """
+  Parameters:
+    value: <int> to encode.
+    length: <int> with the number of base32 characters.
+  Returns:
+    <string> with the big-endian base32 representation.
+  """
+  chars = []
+  for _ in range(length):
+    chars.append(ALPHABET[value & 31])
+    value >>= 5
+  return "".join(reversed(chars))
+
+class OrderIdGenerator:
+  """
+  Monotonic, time-sortable 20 character ids, in the spirit of ULID and Snowflake.
+  The node part is random per process so concurrent containers do not collide, and
+  the counter orders ids created within the same millisecond.
+  """
+  def __init__(self, node=None):
+    """
+    Parameters:
+      node: <int> with the node number, random by default.
+    """
+    if node is None:
+      node = int.from_bytes(os.urandom(4), "big")
+    self.node = encode(node & ((1 << NODE_BITS) - 1), NODE_BITS // 5)
+    self._lock = threading.Lock()
+    self._last = -1
+    self._counter = 0
+    self._prefix = ""
+
+  def new_id(self):
+    """
+    Returns:
+      <string> with a new order id, greater than every id returned before.
+    """
+    now = time.time_ns() // 1000000
+    with self._lock:
+      if now > self._last:
+        self._last = now
+        self._counter = 0
+        self._prefix = encode(now, TIME_CHARS) + self.node
+      elif self._counter < COUNTER_MAX:
+        self._counter += 1
+      else:
+        # Counter exhausted within a millisecond, borrow the next one
+        self._last += 1
+        self._counter = 0
+        self._prefix = encode(self._last, TIME_CHARS) + self.node
+      counter = self._counter
+      prefix = self._prefix
+    return prefix + _pairs[counter >> 10] + _pairs[counter & 1023]
+
+def timestamp(order_id):
+  """
+  Parameters:
+    order_id: <string> created by OrderIdGenerator.
+  Returns:
+    <int> with the milliseconds since epoch the id was created at.
+  """
+  value = 0
+  for char in order_id[:TIME_CHARS]:
+    value = value * 32 + ALPHABET.index(char)
+  return value
+
+_generator = OrderIdGenerator()
+
+def new_id():
+  """
+  Returns:
+    <string> with a new order id from the process-wide generator.
+  """
+  return _generator.new_id()
@@ -0,0 +1,270 @@
+import base64, json, os, re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Load env
+MAX_BODY_BYTES = int(os.environ.get('ORDER_MAX_BODY_BYTES', '16384'))
+MAX_TOTAL = Decimal(os.environ.get('ORDER_MAX_TOTAL', '100000'))
+MAX_BATCH_BYTES = int(os.environ.get('ORDER_MAX_BATCH_BYTES', '4194304'))
+MAX_BATCH_ORDERS = int(os.environ.get('ORDER_MAX_BATCH_ORDERS', '500'))
+
+# orjson parses the body several times faster when it is packaged with the function
+try:
+  import orjson
+  loads = orjson.loads
+  DecodeError = orjson.JSONDecodeError
+except ImportError:
+  loads = json.loads
+  DecodeError = json.JSONDecodeError
+
+CENTS = Decimal("0.01")
+EMAIL = re.compile(r"[^@\s<>,;\"]+@[^@\s<>,;\"]+\.[^@\s<>,;\".]+")
+CONTROL = re.compile(r"[\x00-\x1f\x7f]")
+CONTROL_MULTILINE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+class ValidationError(Exception):
+  """
+  Raised for an order payload that does not follow the schema.
+  """
+  def __init__(self, errors, status=400):
+    super().__init__("; ".join("{}: {}".format(field, error) for field, error in errors.items()))
+    self.errors = errors
+    self.status = status
+
+def text(max_length, multiline=False):
+  """
+  Returns:
+    A checker for a non empty string of at most max_length characters, without
+    control characters (besides line breaks when multiline).
+  """
+  control = CONTROL_MULTILINE if multiline else CONTROL
+  def check(value):
+    if not isinstance(value, str):
+      raise ValueError("must be a string")
+    value = value.strip()
+    if not value:
+      raise ValueError("is required")
+    if len(value) > max_length:
+      raise ValueError("must be at most {} characters".format(max_length))
+    if control.search(value):
+      raise ValueError("contains control characters")
+    return value
+  return check
+
+_address = text(254)
+
+def email(value):
+  value = _address(value)
+  if not EMAIL.fullmatch(value):
+    raise ValueError("must be an email address")
+  return value
+
+def amount(value):
+  """
+  Normalize an amount, sent as a string or a number, to a Decimal with cents.
+  """
+  if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+    raise ValueError("must be a number")
+  try:
+    value = Decimal(value.strip() if isinstance(value, str) else str(value))
+  except InvalidOperation:
+    raise ValueError("must be a number") from None
+  if not value.is_finite() or value < 0 or value > MAX_TOTAL:
+    raise ValueError("must be between 0 and {}".format(MAX_TOTAL))
+  return value.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+def coordinate(limit):
+  """
+  Returns:
+    A checker for a latitude or longitude in degrees, between -limit and limit.
+  """
+  def check(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      raise ValueError("must be a number")
+    if not -limit <= value <= limit:
+      raise ValueError("must be between {} and {}".format(-limit, limit))
+    return float(value)
+  return check
+
+# Order fields and their checkers, each returning the normalized value
+ORDER = {
+  "nombre": text(100),
+  "apellido": text(100),
+  "correo": email,
+  "pedido": text(2000, multiline=True),
+  "total": amount,
+  "direccion": text(300, multiline=True),
+}
+
+# Fields an order may leave out
+ORDER_OPTIONAL = {
+  "restaurante": text(64),
+  # Geocoded delivery point, sent by the partner integrations
+  "latitud": coordinate(90),
+  "longitud": coordinate(180),
+}
+
+def compile_schema(fields, optional=None):
+  """
+  Build a validator for a flat object schema.
+  Parameters:
+    fields: <Dict> mapping every required field to its checker.
+    optional: <Dict> mapping the fields that may be missing to their checkers.
+  Returns:
+    A function taking the decoded payload and returning a new <Dict> with the
+    normalized fields only, or raising ValidationError with every problem found.
+  """
+  checks = tuple((field, check, True) for field, check in fields.items())
+  checks += tuple((field, check, False) for field, check in (optional or {}).items())
+  def validate(payload):
+    if not isinstance(payload, dict):
+      raise ValidationError({"body": "must be a JSON object"})
+    result, errors = {}, {}
+    for field, check, required in checks:
+      value = payload.get(field)
+      if value is None:
+        if required:
+          errors[field] = "is required"
+        continue
+      try:
+        result[field] = check(value)
+      except ValueError as error:
+        errors[field] = str(error)
+    if errors:
+      raise ValidationError(errors)
+    return result
+  return validate
+
+validate_order = compile_schema(ORDER, ORDER_OPTIONAL)
+
+def decode(raw, base64_encoded=False, max_bytes=MAX_BODY_BYTES):
+  """
+  Returns:
+    <string> or <bytes> with the request body, base64 decoded and checked against max_bytes.
+  """
+  if raw is None:
+    raise ValidationError({"body": "is required"})
+  if base64_encoded:
+    if len(raw) > (max_bytes + 2) // 3 * 4:
+      raise ValidationError({"body": "must be at most {} bytes".format(max_bytes)}, 413)
+    try:
+      raw = base64.b64decode(raw, validate=True)
+    except ValueError:
+      raise ValidationError({"body": "is not valid base64"}) from None
+  size = len(raw) if isinstance(raw, bytes) or raw.isascii() else len(raw.encode())
+  if size > max_bytes:
+    raise ValidationError({"body": "must be at most {} bytes".format(max_bytes)}, 413)
+  return raw
+
+def parse(raw, base64_encoded=False, validate=validate_order, max_bytes=MAX_BODY_BYTES):
+  """
+  Decode and validate a request body, rejecting it before any other work is done.
+  Parameters:
+    raw: <string> or <bytes> with the request body.
+    base64_encoded: <bool> as in the isBase64Encoded flag of API Gateway events.
+    validate: the compiled validator of the payload.
+    max_bytes: <int> with the largest body accepted.
+  Returns:
+    <Dict> with the normalized payload.
+  """
+  raw = decode(raw, base64_encoded, max_bytes)
+  try:
+    payload = loads(raw)
+  except (DecodeError, UnicodeDecodeError):
+    raise ValidationError({"body": "is not valid JSON"}) from None
+  return validate(payload)
+
+def is_batch(raw, base64_encoded=False, content_type=None):
+  """
+  Returns:
+    <bool> True for a bulk request: an NDJSON stream, by its content type, or a JSON array.
+  """
+  if content_type and "ndjson" in content_type:
+    return True
+  if not raw:
+    return False
+  if base64_encoded:
+    try:
+      raw = base64.b64decode(raw[:64], validate=True)
+    except ValueError:
+      return False
+  start = raw.lstrip()[:1]
+  return start in ("[", b"[")
+
+def parse_stream(raw, base64_encoded=False, validate=validate_order, ndjson=False, max_bytes=MAX_BATCH_BYTES, max_orders=MAX_BATCH_ORDERS, max_order_bytes=MAX_BODY_BYTES):
+  """
+  Decode and validate a bulk request body one order at a time, so an invalid order
+  only rejects itself.
+  Parameters:
+    raw: <string> or <bytes> with a JSON array of orders, or one order per line when ndjson.
+    base64_encoded: <bool> as in the isBase64Encoded flag of API Gateway events.
+    validate: the compiled validator of every order.
+    ndjson: <bool> True for newline delimited JSON.
+    max_bytes: <int> with the largest body accepted.
+    max_orders: <int> with the most orders accepted in a body.
+    max_order_bytes: <int> with the largest order accepted.
+  Yields:
+    <tuple> with the normalized order, or None, and the ValidationError of the order, or None.
+  Raises:
+    ValidationError when the body itself is malformed or too large.
+  """
+  raw = decode(raw, base64_encoded, max_bytes)
+  if isinstance(raw, bytes):
+    try:
+      raw = raw.decode()
+    except UnicodeDecodeError:
+      raise ValidationError({"body": "is not valid UTF-8"}) from None
+  chunks = _lines(raw) if ndjson else _elements(raw)
+  for count, (chunk, payload) in enumerate(chunks, 1):
+    if count > max_orders:
+      raise ValidationError({"body": "must have at most {} orders".format(max_orders)}, 413)
+    if len(chunk) > max_order_bytes:
+      yield None, ValidationError({"body": "must be at most {} bytes".format(max_order_bytes)}, 413)
+      continue
+    try:
+      payload = loads(chunk) if payload is _PENDING else payload
+    except DecodeError:
+      yield None, ValidationError({"body": "is not valid JSON"})
+      continue
+    try:
+      yield validate(payload), None
+    except ValidationError as error:
+      yield None, error
+
+# Marks a chunk whose JSON is not decoded yet
+_PENDING = object()
+
+def _lines(raw):
+  start = 0
+  while start < len(raw):
+    end = raw.find("\n", start)
+    end = len(raw) if end < 0 else end
+    line = raw[start:end].strip()
+    start = end + 1
+    if line:
+      yield line, _PENDING
+
+_decoder = json.JSONDecoder()
+_SPACE = re.compile(r"\s*")
+
+def _elements(raw):
+  position = _SPACE.match(raw).end()
+  if raw[position:position + 1] != "[":
+    raise ValidationError({"body": "must be a JSON array"})
+  position = _SPACE.match(raw, position + 1).end()
+  if raw[position:position + 1] == "]":
+    return
+  while True:
+    try:
+      payload, end = _decoder.raw_decode(raw, position)
+    except json.JSONDecodeError:
+      raise ValidationError({"body": "is not a valid JSON array"}) from None
+    yield raw[position:end], payload
+    position = _SPACE.match(raw, end).end()
+    separator = raw[position:position + 1]
+    position = _SPACE.match(raw, position + 1).end()
+    if separator == "]":
+      break
+    if separator != ",":
+      raise ValidationError({"body": "is not a valid JSON array"})
+  if position != len(raw):
+    raise ValidationError({"body": "is not a valid JSON array"})
@@ -0,0 +1,324 @@
+import logging, os, sqlite3, struct, threading, time
+from functools import lru_cache
+import eta
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Shared by every function of the order lifecycle, a /tmp default would be private to each
+DB_PATH = os.environ.get('ORDER_STATE_DB')
+LATE_GRACE_SECONDS = int(os.environ.get('ORDER_LATE_GRACE_SECONDS', '120'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Lifecycle of an order, in order. The record keeps when each stage is expected, the
+# last stage notified and when a person confirmed each stage; the next deadline is the
+# expected time of the stage after the furthest one reached.
+STATES = ("received", "confirmed", "picked_up", "delivered", "feedback")
+RECEIVED, CONFIRMED, PICKED_UP, DELIVERED, FEEDBACK = range(len(STATES))
+
+# State each lifecycle notification moves the order to
+EVENT_STATES = {
+  "check_in": CONFIRMED,
+  "order_sent": PICKED_UP,
+  "order_delivered": DELIVERED,
+  "feedback": FEEDBACK,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS order_states (
+  order_id TEXT PRIMARY KEY,
+  restaurant_id TEXT NOT NULL,
+  zone TEXT,
+  courier_id TEXT,
+  notified INTEGER NOT NULL,
+  next_deadline INTEGER,
+  record BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS order_states_deadline ON order_states (next_deadline) WHERE next_deadline IS NOT NULL;
+"""
+
+class OrderRecord:
+  """
+  State of an order packed in 37 bytes: a bit per stage notified, the epoch seconds
+  each stage after received is expected at and the epoch seconds every stage was
+  confirmed at (0 until it is; received is set on creation).
+  """
+  __slots__ = ("notified", "expected", "at")
+
+  LAYOUT = struct.Struct("<B4I5I")
+
+  def __init__(self, notified, expected, at):
+    self.notified = notified
+    self.expected = list(expected)
+    self.at = list(at)
+
+  @classmethod
+  def new(cls, received, estimate):
+    expected = [int(moment.timestamp()) for moment in (estimate.confirmation, estimate.pickup, estimate.arrival, estimate.feedback)]
+    return cls(0, expected, [int(received.timestamp()), 0, 0, 0, 0])
+
+  def pack(self):
+    return self.LAYOUT.pack(self.notified, *self.expected, *self.at)
+
+  @classmethod
+  def unpack(cls, data):
+    values = cls.LAYOUT.unpack(data)
+    return cls(values[0], values[1:5], values[5:])
+
+  @property
+  def last_notified(self):
+    """
+    <int> with the furthest stage notified, -1 before the first notification.
+    """
+    return self.notified.bit_length() - 1
+
+  @property
+  def confirmed(self):
+    """
+    <int> with the furthest stage confirmed.
+    """
+    return max(stage for stage, at in enumerate(self.at) if at)
+
+  @property
+  def progress(self):
+    """
+    <int> with the furthest stage reached, notified or confirmed.
+    """
+    return max(self.last_notified, self.confirmed)
+
+  @property
+  def next_deadline(self):
+    """
+    <int> with the epoch seconds the next stage is expected at, None once the lifecycle is over.
+    """
+    progress = self.progress
+    return self.expected[progress] if progress < FEEDBACK else None
+
+  def minutes(self, start, end, expected=False):
+    """
+    Returns:
+      <float> with the minutes between two stages, expected or as they happened.
+    """
+    times = [self.at[RECEIVED]] + self.expected if expected else self.at
+    return (times[end] - times[start]) / 60
+
+class OrderStateStore:
+  """
+  Order states kept in SQLite, a local stand-in for the order table, with the next
+  deadline indexed to find the late orders with a range scan. Notifications claim
+  their stage with a conditional update before they are sent, so a repeated or stale
+  event sends nothing; courier confirmations are recorded whatever was notified.
+  """
+  def __init__(self, path=DB_PATH, estimator=None):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.executescript(SCHEMA)
+    self._lock = threading.Lock()
+    self.estimator = estimator
+
+  def create(self, order_id, restaurant_id, zone, received, estimate, courier_id=None):
+    """
+    Store a new order in the received state.
+    Parameters:
+      order_id: <string> with the order identifier.
+      restaurant_id: <string> with the restaurant preparing it.
+      zone: <string> with the delivery zone, None when unknown.
+      received: <datetime> when it was received.
+      estimate: <Estimate> with the expected time of every stage.
+      courier_id: <string> with the courier assigned to deliver it, None until one is.
+    """
+    self.create_many([(order_id, restaurant_id, zone, received, estimate, courier_id)])
+
+  def create_many(self, orders):
+    """
+    Store a batch of new orders in a single transaction.
+    Parameters:
+      orders: <list> of (order_id, restaurant_id, zone, received, estimate, courier_id)
+        tuples, as in create.
+    """
+    rows = []
+    for order_id, restaurant_id, zone, received, estimate, courier_id in orders:
+      record = OrderRecord.new(received, estimate)
+      rows.append((order_id, restaurant_id, zone, courier_id, record.notified, record.next_deadline, record.pack()))
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        self._db.executemany(
+          "INSERT OR IGNORE INTO order_states (order_id, restaurant_id, zone, courier_id, notified, next_deadline, record) VALUES (?, ?, ?, ?, ?, ?, ?)",
+          rows
+        )
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+
+  def get(self, order_id):
+    """
+    Returns:
+      <OrderRecord> of the order, None when unknown.
+    """
+    with self._lock:
+      row = self._db.execute("SELECT record FROM order_states WHERE order_id = ?", (order_id,)).fetchone()
+    return None if row is None else OrderRecord.unpack(row[0])
+
+  def restaurant(self, order_id):
+    """
+    Returns:
+      <string> with the restaurant preparing the order, None when unknown.
+    """
+    with self._lock:
+      row = self._db.execute("SELECT restaurant_id FROM order_states WHERE order_id = ?", (order_id,)).fetchone()
+    return None if row is None else row[0]
+
+  def courier(self, order_id):
+    """
+    Returns:
+      <string> with the courier assigned to the order, None when unknown or not assigned yet.
+    """
+    with self._lock:
+      row = self._db.execute("SELECT courier_id FROM order_states WHERE order_id = ?", (order_id,)).fetchone()
+    return None if row is None else row[0]
+
+  def assign(self, order_id, courier_id):
+    """
+    Record the courier that accepted the delivery of an order.
+    Returns:
+      <bool> False when the order is unknown or another courier was assigned already.
+    """
+    with self._lock:
+      cursor = self._db.execute(
+        "UPDATE order_states SET courier_id = ? WHERE order_id = ? AND (courier_id IS NULL OR courier_id = ?)",
+        (courier_id, order_id, courier_id)
+      )
+    return cursor.rowcount == 1
+
+  def _change(self, order_id, change):
+    """
+    Apply a change to the record of an order in one transaction.
+    Parameters:
+      change: <callable> taking the OrderRecord, returning False to leave it untouched.
+    Returns:
+      <tuple> with the result of change, None when the order is unknown, and the
+      restaurant, zone and record of the order.
+    """
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        row = self._db.execute("SELECT restaurant_id, zone, notified, record FROM order_states WHERE order_id = ?", (order_id,)).fetchone()
+        if row is None:
+          self._db.execute("COMMIT")
+          return None, None, None, None
+        restaurant_id, zone, current, data = row
+        record = OrderRecord.unpack(data)
+        changed = change(record)
+        if changed:
+          self._db.execute(
+            "UPDATE order_states SET notified = ?, next_deadline = ?, record = ? WHERE order_id = ? AND notified = ?",
+            (record.notified, record.next_deadline, record.pack(), order_id, current)
+          )
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+    return changed, restaurant_id, zone, record
+
+  def claim(self, order_id, state):
+    """
+    Claim the notification of a stage before sending it.
+    Parameters:
+      order_id: <string> with the order identifier.
+      state: <int> with the index of the state in STATES.
+    Returns:
+      <bool> True when the caller should send it, False when it was already claimed
+      or the order is past the stage (a later stage was notified or confirmed), None
+      when the order is unknown.
+    """
+    def change(record):
+      if record.last_notified >= state or record.confirmed > state:
+        return False
+      record.notified |= 1 << state
+      return True
+    return self._change(order_id, change)[0]
+
+  def release(self, order_id, state):
+    """
+    Give back the claim of a notification that could not be sent, so a retry sends it.
+    """
+    def change(record):
+      if not record.notified & 1 << state:
+        return False
+      record.notified &= ~(1 << state)
+      return True
+    self._change(order_id, change)
+
+  def confirm(self, order_id, state, at=None):
+    """
+    Record a stage confirmed by a person, e.g. the courier picking the order up, even
+    when its notification already went out. Confirmed durations are observed by the
+    estimator; scheduled notifications happen at the estimate and teach it nothing.
+    Parameters:
+      order_id: <string> with the order identifier.
+      state: <int> with the index of the state in STATES.
+      at: <float> with the epoch seconds of the confirmation, now when not given.
+    Returns:
+      <bool> True when recorded, False when the stage was already confirmed, None
+      when the order is unknown.
+    """
+    def change(record):
+      if record.at[state]:
+        return False
+      record.at[state] = int(time.time() if at is None else at)
+      return True
+    recorded, restaurant_id, zone, record = self._change(order_id, change)
+    if recorded:
+      self._observe(restaurant_id, zone, record, state)
+    return recorded
+
+  def _observe(self, restaurant_id, zone, record, state):
+    estimator = self.estimator or eta.default_estimator()
+    # The confirmation is recorded already, a failing estimator only loses the sample
+    try:
+      if state == PICKED_UP:
+        estimator.observe("prep", restaurant_id, record.minutes(RECEIVED, PICKED_UP, expected=True), record.minutes(RECEIVED, PICKED_UP))
+      elif state == DELIVERED and record.at[PICKED_UP]:
+        estimator.observe("travel", zone, record.minutes(PICKED_UP, DELIVERED, expected=True), record.minutes(PICKED_UP, DELIVERED))
+    except Exception as error:
+      logger.error("Cannot observe %s of restaurant %s: %r", STATES[state], restaurant_id, error)
+
+  def late(self, now=None, grace=LATE_GRACE_SECONDS, limit=100):
+    """
+    Returns:
+      <list> of <Dict> with the orders whose next stage is overdue by more than grace
+      seconds, most overdue first.
+    """
+    now = int(time.time() if now is None else now)
+    with self._lock:
+      rows = self._db.execute(
+        "SELECT order_id, restaurant_id, next_deadline, record FROM order_states WHERE next_deadline < ? ORDER BY next_deadline LIMIT ?",
+        (now - grace, limit)
+      ).fetchall()
+    late = []
+    for order_id, restaurant_id, deadline, data in rows:
+      progress = OrderRecord.unpack(data).progress
+      late.append({
+        "order_id": order_id,
+        "restaurant_id": restaurant_id,
+        "state": STATES[progress],
+        "waiting_for": STATES[progress + 1],
+        "late_minutes": round((now - deadline) / 60, 1)
+      })
+    return late
+
+@lru_cache(maxsize=None)
+def default_store():
+  """
+  Returns:
+    <OrderStateStore> shared by the process, stored at ORDER_STATE_DB.
+  Raises:
+    RuntimeError when ORDER_STATE_DB is not set.
+  """
+  if not DB_PATH:
+    raise RuntimeError("ORDER_STATE_DB must point to the order states shared by the order lambdas")
+  return OrderStateStore()
@@ -0,0 +1,290 @@
+import json, logging, os, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+import clients, digest, timeline
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Shared with vaciar-outbox (e.g. an EFS mount), the default only suits a single process
+DB_PATH = os.environ.get('OUTBOX_DB', '/tmp/ajoloeats-outbox.db')
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '500'))
+CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', '8'))
+MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+BACKOFF_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', '2'))
+LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+FLUSH_BUDGET_SECONDS = float(os.environ.get('OUTBOX_FLUSH_BUDGET_MS', '3000')) / 1000
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+  order_id TEXT PRIMARY KEY,
+  body TEXT NOT NULL,
+  created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY,
+  order_id TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt REAL NOT NULL,
+  error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+CREATE INDEX IF NOT EXISTS outbox_tickets ON outbox (json_extract(payload, '$.To'), status) WHERE kind = 'ticket';
+CREATE TABLE IF NOT EXISTS digests (
+  inbox TEXT PRIMARY KEY,
+  last_order REAL NOT NULL
+);
+"""
+
+class Outbox:
+  """
+  Transactional outbox kept in SQLite, a local stand-in for the order table.
+  An order and all of its side effects are written in one transaction; a Flusher
+  performs them before the handler returns and vaciar-outbox retries the rest.
+  Effects that keep failing are marked dead, never dropped.
+  """
+  def __init__(self, path=DB_PATH):
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.executescript(SCHEMA)
+    self._lock = threading.Lock()
+
+  def record(self, order_id, body, effects):
+    """
+    Store an order with its pending side effects, atomically.
+    Parameters:
+      order_id: <string> with the order identifier.
+      body: <Dict> with the order body.
+      effects: <list> of (kind, payload) tuples, kind being "schedule", "email" or
+        "ticket", an email that digest coalesces with the others of its inbox.
+    """
+    self.record_many([(order_id, body, effects)])
+
+  def record_many(self, orders):
+    """
+    Store a batch of orders with their pending side effects in a single transaction.
+    Parameters:
+      orders: <list> of (order_id, body, effects) tuples, as in record.
+    """
+    now = time.time()
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        self._db.executemany("INSERT INTO orders VALUES (?, ?, ?)", [(order_id, json.dumps(body, default=str), now) for order_id, body, _ in orders])
+        self._db.executemany(
+          "INSERT INTO outbox (order_id, kind, payload, next_attempt) VALUES (?, ?, ?, ?)",
+          [
+            (order_id, kind, json.dumps(payload), self._ticket_due(payload["To"], now) if kind == "ticket" else now)
+            for order_id, _, effects in orders for kind, payload in effects
+          ]
+        )
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+
+  def _ticket_due(self, inbox, now):
+    """
+    Returns:
+      <float> with the timestamp a new ticket for the inbox is due at, moving the
+      tickets already waiting forward when the digest is full. Runs inside record.
+    """
+    # Leased tickets are due past now + LEASE_SECONDS, out of reach of the window
+    waiting = "kind = 'ticket' AND json_extract(payload, '$.To') = ? AND status = 'pending' AND next_attempt <= ?"
+    pending, first_due = self._db.execute("SELECT COUNT(*), MIN(next_attempt) FROM outbox WHERE " + waiting, (inbox, now + digest.MAX_WAIT_SECONDS)).fetchone()
+    row = self._db.execute("SELECT last_order FROM digests WHERE inbox = ?", (inbox,)).fetchone()
+    due = digest.due(pending, first_due, row and row[0], now)
+    if pending and due < first_due:
+      self._db.execute("UPDATE outbox SET next_attempt = ? WHERE " + waiting, (due, inbox, now + digest.MAX_WAIT_SECONDS))
+    self._db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?)", (inbox, now))
+    return due
+
+  def claim(self, limit=BATCH_SIZE, lease=LEASE_SECONDS, order_ids=None):
+    """
+    Lease the next due effects so concurrent flushers do not run them twice.
+    Parameters:
+      order_ids: <list> with the orders whose effects are claimed, every order when None.
+    Returns:
+      <list> of (id, kind, payload <Dict>, attempts) tuples.
+    """
+    now = time.time()
+    query = "SELECT id, kind, payload, attempts FROM outbox WHERE status = 'pending' AND next_attempt <= ?"
+    arguments = [now]
+    if order_ids is not None:
+      query += " AND order_id IN ({})".format(", ".join("?" * len(order_ids)))
+      arguments.extend(order_ids)
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        rows = self._db.execute(query + " ORDER BY next_attempt LIMIT ?", arguments + [limit]).fetchall()
+        self._db.executemany("UPDATE outbox SET next_attempt = ? WHERE id = ?", [(now + lease, row[0]) for row in rows])
+        self._db.execute("COMMIT")
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+    return [(id, kind, json.loads(payload), attempts) for id, kind, payload, attempts in rows]
+
+  def complete(self, ids):
+    with self._lock:
+      self._db.executemany("UPDATE outbox SET status = 'done', error = NULL WHERE id = ?", [(id,) for id in ids])
+
+  def fail(self, failures, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS):
+    """
+    Reschedule failed effects with exponential backoff.
+    Parameters:
+      failures: <list> of (id, attempts, error message) tuples.
+    """
+    now = time.time()
+    updates = []
+    for id, attempts, error in failures:
+      status = 'dead' if attempts + 1 >= max_attempts else 'pending'
+      if status == 'dead':
+        logger.error("Outbox effect %s failed %s times, giving up: %s", id, attempts + 1, error)
+      updates.append((status, attempts + 1, now + backoff * 2 ** attempts, error, id))
+    with self._lock:
+      self._db.executemany("UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, error = ? WHERE id = ?", updates)
+
+  def counts(self):
+    """
+    Returns:
+      <Dict> with the number of effects per status.
+    """
+    with self._lock:
+      return dict(self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+class Flusher:
+  """
+  Drains an Outbox: emails go out through the batching dispatcher, schedules are
+  created with bounded concurrency, and failures are retried with backoff.
+  """
+  def __init__(self, outbox, scheduler=None, dispatcher=None, concurrency=CONCURRENCY, batch_size=BATCH_SIZE):
+    self.outbox = outbox
+    self.scheduler = scheduler
+    self.dispatcher = dispatcher
+    self.batch_size = batch_size
+    self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+  def flush_once(self, order_ids=None, timeout=None):
+    """
+    Perform one batch of due effects.
+    Parameters:
+      order_ids: <list> with the orders whose effects are performed, every order when None.
+      timeout: <float> with the most seconds to wait for the effects, None to wait for all.
+        Those still running keep their lease and are recorded when they finish.
+    Returns:
+      <int> with the number of effects attempted.
+    """
+    rows = self.outbox.claim(self.batch_size, order_ids=order_ids)
+    if not rows:
+      return 0
+    scheduler = self.scheduler or clients.scheduler()
+    dispatcher = self.dispatcher or clients.dispatcher()
+    futures = []
+    tickets = {}
+    for id, kind, payload, attempts in rows:
+      if kind == "ticket":
+        tickets.setdefault(payload["To"], []).append((id, attempts, payload))
+        continue
+      if kind == "email":
+        future = dispatcher.enqueue(payload["To"], payload["Subject"], payload["HtmlBody"], payload["From"])
+      else:
+        future = self.executor.submit(self._create_schedule, scheduler, payload)
+      futures.append((id, attempts, future))
+    for inbox, group in tickets.items():
+      first = group[0][2]
+      if len(group) == 1:
+        subject, body = first["Subject"], first["HtmlBody"]
+      else:
+        subject, body = digest.ticket(first["digest"], first["restaurant"], [payload for _, _, payload in group])
+      future = dispatcher.enqueue(inbox, subject, body, first["From"])
+      futures.extend((id, attempts, future) for id, attempts, _ in group)
+    if timeout is None:
+      dispatcher.flush()
+    else:
+      self.executor.submit(dispatcher.flush)
+    finished, _ = wait([future for _, _, future in futures], timeout)
+    done, failed = [], []
+    for id, attempts, future in futures:
+      if future not in finished:
+        future.add_done_callback(lambda future, id=id, attempts=attempts: self._settle(id, attempts, future))
+      elif future.exception() is None:
+        done.append(id)
+      else:
+        failed.append((id, attempts, str(future.exception())))
+    self.outbox.complete(done)
+    if failed:
+      self.outbox.fail(failed)
+    return len(rows)
+
+  def _settle(self, id, attempts, future):
+    # Outcome of an effect that outlived the wait of its flush
+    try:
+      if future.exception() is None:
+        self.outbox.complete([id])
+      else:
+        self.outbox.fail([(id, attempts, str(future.exception()))])
+    except Exception as error:
+      logger.error("Cannot record outbox effect %s, left to its lease: %s", id, error)
+
+  def perform(self, order_ids, budget=FLUSH_BUDGET_SECONDS):
+    """
+    Perform the due effects of some orders, waiting at most budget seconds. The rest of
+    the outbox, and the effects still running when the budget runs out, are left to
+    vaciar-outbox, which retries the latter once their lease expires.
+    Returns:
+      <int> with the number of effects attempted.
+    """
+    deadline = time.monotonic() + budget
+    total = 0
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return total
+      count = self.flush_once(order_ids, remaining)
+      total += count
+      if count < self.batch_size:
+        return total
+
+  def drain(self):
+    """
+    Flush until no effect is due.
+    Returns:
+      <int> with the number of effects attempted.
+    """
+    total = 0
+    while True:
+      count = self.flush_once()
+      total += count
+      if count < self.batch_size:
+        return total
+
+  @staticmethod
+  def _create_schedule(scheduler, payload):
+    try:
+      scheduler.create_schedule(**payload)
+    except Exception as error:
+      # A retry of a schedule that was already created succeeded the first time
+      if timeline.error_code(error) != "ConflictException":
+        raise
+
+@lru_cache(maxsize=None)
+def default_outbox():
+  """
+  Returns:
+    <Outbox> shared by the process, stored at OUTBOX_DB.
+  """
+  return Outbox()
+
+@lru_cache(maxsize=None)
+def default_flusher():
+  """
+  Returns:
+    <Flusher> of the default outbox, using the shared clients.
+  """
+  return Flusher(default_outbox())
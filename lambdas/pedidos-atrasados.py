@@ -0,0 +1,35 @@
+import logging, os
+import tracing
+import order_state, responses
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+MAX_LIMIT = int(os.environ.get('LATE_MAX_LIMIT', '1000'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+@tracing.handler("pedidos-atrasados")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Lists the orders whose next stage is overdue, read from the deadline index of the
+  order states, optionally limited with ?limite=<n>, between 1 and LATE_MAX_LIMIT.
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the API Gateway response, a JSON status message.
+  """
+  query = event.get("queryStringParameters") or {}
+  try:
+    limit = int(query.get("limite", min(100, MAX_LIMIT)))
+  except ValueError:
+    limit = None
+  # SQLite reads a negative LIMIT as no limit at all
+  if limit is None or not 1 <= limit <= MAX_LIMIT:
+    return responses.body(400, {"message": "limite must be a whole number between 1 and {}.".format(MAX_LIMIT)})
+  with tracing.span("late"):
+    late = order_state.default_store().late(limit=limit)
+  return responses.body(200, {"late": late})
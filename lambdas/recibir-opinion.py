@@ -0,0 +1,52 @@
+import logging, os
+import tracing
+import feedback, order_schema, responses
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Aggregate kind read for each query string parameter
+QUERIES = {"restaurante": "restaurant", "repartidor": "courier"}
+
+@tracing.handler("recibir-opinion")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Takes the rating of an order posted by the feedback form (pedido, calificacion,
+  token and optionally comentario, restaurante, repartidor and cliente, as in the link
+  of the feedback email) and adds it to the aggregates of its restaurant and courier.
+  A request without a body reads the aggregates of ?restaurante=<id> or ?repartidor=<id>.
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the API Gateway response, a JSON status message.
+  """
+  store = feedback.default_store()
+  if not event.get("body"):
+    query = event.get("queryStringParameters") or {}
+    for parameter, kind in QUERIES.items():
+      if parameter in query:
+        summary = store.summary(kind, query[parameter])
+        if summary is None:
+          return responses.body(404, {"message": "No feedback yet."})
+        return responses.body(200, {kind: query[parameter], "summary": summary})
+    return responses.body(400, {"message": "Send a rating, or ask for a restaurante or repartidor."})
+  try:
+    with tracing.span("parse"):
+      body = order_schema.parse(event["body"], event.get("isBase64Encoded", False), feedback.validate_feedback)
+  except order_schema.ValidationError as error:
+    logger.info("Rejected feedback: %s", error)
+    return responses.body(error.status, {"message": "Invalid feedback.", "errors": error.errors})
+  order_id, restaurant_id, courier_id, client = body["pedido"], body.get("restaurante"), body.get("repartidor"), body.get("cliente")
+  if not feedback.verify(order_id, restaurant_id, courier_id, client, body["token"]):
+    return responses.body(403, {"message": "Invalid feedback link."})
+  with tracing.span("aggregate"):
+    recorded = store.rate(order_id, body["calificacion"], body.get("comentario"), restaurant_id, courier_id, client)
+  if not recorded:
+    return responses.body(409, {"message": "The order was already rated."})
+  return responses.body(200, {"message": "¡Gracias por tu opinión!"})
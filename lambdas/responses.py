@@ -0,0 +1,29 @@
+import json
+
+def body(status, payload):
+  """
+  Parameters:
+    status: <int> with the HTTP status code.
+    payload: <Dict> sent as the JSON body.
+  Returns:
+    <Dict> with the API Gateway proxy response.
+  """
+  return {
+    "statusCode": status,
+    "headers": {"Content-Type": "application/json"},
+    "body": json.dumps(payload)
+  }
+
+def page(status, html):
+  """
+  Parameters:
+    status: <int> with the HTTP status code.
+    html: <string> with the HTML page.
+  Returns:
+    <Dict> with the API Gateway proxy response.
+  """
+  return {
+    "statusCode": status,
+    "headers": {"Content-Type": "text/html; charset=utf-8"},
+    "body": html
+  }
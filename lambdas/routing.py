@@ -0,0 +1,293 @@
+import heapq, json, math, os, threading, time
+from functools import lru_cache
+import eta, menu
+
+# Load env
+REGISTRY_PATH = os.environ.get('REGISTRY_PATH')
+RESTAURANT_EMAIL = os.environ.get('RESTAURANT_EMAIL')
+DELIVERY_EMAIL = os.environ.get('DELIVERY_EMAIL')
+CELL_KM = float(os.environ.get('ROUTING_CELL_KM', '1.0'))
+MAX_RADIUS_KM = float(os.environ.get('ROUTING_MAX_RADIUS_KM', '15'))
+COURIER_CAPACITY = int(os.environ.get('ROUTING_COURIER_CAPACITY', '2'))
+LOAD_PENALTY_KM = float(os.environ.get('ROUTING_LOAD_PENALTY_KM', '1.5'))
+
+KM_PER_DEGREE = math.pi * eta.EARTH_RADIUS_KM / 180
+
+# Snapshot used when REGISTRY_PATH is not set: the restaurant and courier served so far
+DEFAULT_SNAPSHOT = {
+  "restaurants": [{
+    "id": "el-ajolote-frito",
+    "name": "El Ajolote Frito",
+    "email": RESTAURANT_EMAIL,
+    "address": "Periférico Blvrd Manuel Ávila Camacho 261, Polanco",
+  }],
+  "couriers": [{
+    "id": "juan",
+    "name": "Juan",
+    "email": DELIVERY_EMAIL,
+    # A shared dispatch inbox rather than one person, it takes any number of orders
+    "capacity": None,
+  }],
+}
+
+class Restaurant:
+  __slots__ = ("id", "name", "email", "address", "zone", "location", "menu", "_index")
+
+  def __init__(self, id, name, email, address, zone, location, menu=None):
+    self.id = id
+    self.name = name
+    self.email = email
+    self.address = address
+    self.zone = zone
+    self.location = location
+    self.menu = menu
+    self._index = None
+
+  def index(self):
+    """
+    Returns:
+      <MenuIndex> of the restaurant menu, built on its first order, or the default one.
+    """
+    if self.menu is None:
+      return menu.default_index()
+    if self._index is None:
+      self._index = menu.MenuIndex(self.menu)
+    return self._index
+
+class Courier:
+  """
+  A courier, its last known location and how many orders it is carrying.
+  A capacity of None means no limit.
+  """
+  __slots__ = ("id", "name", "email", "location", "capacity", "active", "available")
+
+  def __init__(self, id, name, email, location, capacity=COURIER_CAPACITY, available=True):
+    self.id = id
+    self.name = name
+    self.email = email
+    self.location = location
+    self.capacity = capacity
+    self.active = 0
+    self.available = available
+
+  @property
+  def free(self):
+    return self.available and (self.capacity is None or self.active < self.capacity)
+
+class GridIndex:
+  """
+  Points bucketed in square cells of cell_km, searched ring by ring around a location,
+  so a lookup touches the cells near it whatever the number of points indexed.
+  """
+  def __init__(self, cell_km=CELL_KM, latitude=eta.ZONES["polanco"]["location"][0]):
+    self.cell_km = cell_km
+    # Equirectangular projection, accurate within a city
+    self.lon_km = KM_PER_DEGREE * math.cos(math.radians(latitude))
+    self.cells = {}
+    self.points = {}
+
+  def project(self, location):
+    return location[0] * KM_PER_DEGREE, location[1] * self.lon_km
+
+  def cell(self, location):
+    y, x = self.project(location)
+    return int(y // self.cell_km), int(x // self.cell_km)
+
+  def insert(self, key, location):
+    self.remove(key)
+    self.points[key] = location
+    self.cells.setdefault(self.cell(location), set()).add(key)
+
+  def remove(self, key):
+    location = self.points.pop(key, None)
+    if location is None:
+      return
+    cell = self.cell(location)
+    bucket = self.cells[cell]
+    bucket.discard(key)
+    if not bucket:
+      del self.cells[cell]
+
+  def distance(self, a, b):
+    (ay, ax), (by, bx) = self.project(a), self.project(b)
+    return math.hypot(ay - by, ax - bx)
+
+  def nearest(self, location, k=1, score=None, max_km=MAX_RADIUS_KM):
+    """
+    Parameters:
+      location: <tuple> with the latitude and longitude searched from.
+      k: <int> with the number of points wanted.
+      score: function of (key, km) returning the rank of a point, lower is better,
+        or None to skip it. It must not be lower than km. Defaults to the distance.
+      max_km: <float> with the search radius.
+    Returns:
+      <list> of (score, km, key) tuples, best first.
+    """
+    row, column = self.cell(location)
+    best = []
+    seen = 0
+    rings = int(max_km // self.cell_km) + 1
+    for ring in range(rings + 1):
+      # Every point past this ring is at least this far away
+      if len(best) >= k and -best[0][0] <= (ring - 1) * self.cell_km:
+        break
+      # Nothing left to find in a small pool
+      if seen == len(self.points):
+        break
+      for cell in _ring(row, column, ring):
+        for key in self.cells.get(cell, ()):
+          seen += 1
+          km = self.distance(location, self.points[key])
+          if km > max_km:
+            continue
+          rank = km if score is None else score(key, km)
+          if rank is None:
+            continue
+          if len(best) < k:
+            heapq.heappush(best, (-rank, km, key))
+          elif rank < -best[0][0]:
+            heapq.heapreplace(best, (-rank, km, key))
+    return sorted((-rank, km, key) for rank, km, key in best)
+
+def _ring(row, column, ring):
+  if ring == 0:
+    yield row, column
+    return
+  for offset in range(-ring, ring + 1):
+    yield row - ring, column + offset
+    yield row + ring, column + offset
+  for offset in range(-ring + 1, ring):
+    yield row + offset, column - ring
+    yield row + offset, column + ring
+
+class CourierPool:
+  """
+  Couriers indexed by location. Orders go to the closest free courier, with every
+  order a courier is already carrying counted as LOAD_PENALTY_KM of extra distance.
+  Assignments are released when delivered or, at the latest, at the expected arrival.
+  """
+  def __init__(self, couriers=(), cell_km=CELL_KM):
+    self.index = GridIndex(cell_km)
+    self.couriers = {}
+    self.releases = []
+    self._lock = threading.Lock()
+    for courier in couriers:
+      self.add(courier)
+
+  def add(self, courier):
+    with self._lock:
+      self.couriers[courier.id] = courier
+      self.index.insert(courier.id, courier.location)
+
+  def move(self, courier_id, location):
+    with self._lock:
+      courier = self.couriers[courier_id]
+      courier.location = location
+      self.index.insert(courier_id, location)
+
+  def set_available(self, courier_id, available):
+    with self._lock:
+      self.couriers[courier_id].available = available
+
+  def _expire(self, now):
+    while self.releases and self.releases[0][0] <= now:
+      _, courier_id = heapq.heappop(self.releases)
+      courier = self.couriers.get(courier_id)
+      if courier is not None and courier.active:
+        courier.active -= 1
+
+  def _score(self, key, km):
+    courier = self.couriers[key]
+    return km + LOAD_PENALTY_KM * courier.active if courier.free else None
+
+  def nearest(self, location, k=1, now=None, exclude=()):
+    """
+    Returns:
+      <list> of (score, km, Courier) tuples with up to k free couriers, best first,
+      leaving out the ids in exclude.
+    """
+    score = self._score
+    if exclude:
+      score = lambda key, km: None if key in exclude else self._score(key, km)
+    with self._lock:
+      self._expire(time.time() if now is None else now)
+      return [(rank, km, self.couriers[key]) for rank, km, key in self.index.nearest(location, k, score)]
+
+  def assign(self, location, until, now=None):
+    """
+    Assign an order picked up at location to the best free courier.
+    Parameters:
+      location: <tuple> with the latitude and longitude of the pickup.
+      until: <float> with the timestamp the assignment is released at, if not before.
+    Returns:
+      <tuple> with the Courier and its kilometers to the pickup, or None when no courier is free.
+    """
+    with self._lock:
+      self._expire(time.time() if now is None else now)
+      found = self.index.nearest(location, 1, self._score)
+      if not found:
+        return None
+      _, km, key = found[0]
+      self.claim(key, until)
+      return self.couriers[key], km
+
+  def claim(self, courier_id, until):
+    """
+    Count an order on a courier until it is released. The caller holds the lock.
+    """
+    self.couriers[courier_id].active += 1
+    heapq.heappush(self.releases, (until, courier_id))
+
+  def take(self, courier_id, until):
+    """
+    Count an order on a courier chosen elsewhere, e.g. the one that accepted an offer.
+    """
+    with self._lock:
+      if courier_id in self.couriers:
+        self.claim(courier_id, until)
+
+  def release(self, courier_id):
+    with self._lock:
+      courier = self.couriers.get(courier_id)
+      if courier is not None and courier.active:
+        courier.active -= 1
+
+class Registry:
+  """
+  Restaurants by id and the courier pool, built from a snapshot like DEFAULT_SNAPSHOT.
+  """
+  def __init__(self, snapshot, matrix=None):
+    matrix = matrix or eta.default_estimator().matrix
+    self.restaurants = {}
+    for entry in snapshot.get("restaurants", []):
+      zone = entry.get("zone") or matrix.zone(entry["address"]) or eta.RESTAURANT_ZONE
+      location = tuple(entry["location"]) if entry.get("location") else eta.ZONES.get(zone, eta.ZONES[eta.RESTAURANT_ZONE])["location"]
+      self.restaurants[entry["id"]] = Restaurant(entry["id"], entry["name"], entry.get("email"), entry["address"], zone, location, entry.get("menu"))
+    self.default = next(iter(self.restaurants.values()), None)
+    couriers = []
+    for entry in snapshot.get("couriers", []):
+      # Couriers without a known location wait at the first restaurant
+      location = tuple(entry["location"]) if entry.get("location") else self.default.location
+      couriers.append(Courier(entry["id"], entry["name"], entry.get("email"), location, entry.get("capacity", COURIER_CAPACITY), entry.get("available", True)))
+    self.couriers = CourierPool(couriers)
+
+  def restaurant(self, restaurant_id=None):
+    """
+    Returns:
+      <Restaurant> with the id, the default one when not given, or None when unknown.
+    """
+    if restaurant_id is None:
+      return self.default
+    return self.restaurants.get(restaurant_id)
+
+@lru_cache(maxsize=None)
+def default_registry():
+  """
+  Returns:
+    <Registry> of the snapshot at REGISTRY_PATH, or of DEFAULT_SNAPSHOT, loaded on
+    the first order and kept with its courier assignments across warm invocations.
+  """
+  if REGISTRY_PATH:
+    with open(REGISTRY_PATH) as file:
+      return Registry(json.load(file))
+  return Registry(DEFAULT_SNAPSHOT)
@@ -0,0 +1,134 @@
+import base64, hashlib, math, os
+
+# Load env
+COMPRESSION = int(os.environ.get('SKETCH_COMPRESSION', '50'))
+HLL_PRECISION = int(os.environ.get('SKETCH_HLL_PRECISION', '10'))
+
+class TDigest:
+  """
+  Merging t-digest: a few weighted centroids, small near the tails and larger in the
+  middle, estimate any quantile of a stream. Two digests merge into one of the union.
+  """
+  __slots__ = ("compression", "means", "weights", "minimum", "maximum", "_buffer")
+
+  def __init__(self, compression=COMPRESSION, means=(), weights=(), minimum=math.inf, maximum=-math.inf):
+    self.compression = compression
+    self.means = list(means)
+    self.weights = list(weights)
+    self.minimum = minimum
+    self.maximum = maximum
+    self._buffer = []
+
+  @property
+  def count(self):
+    return sum(self.weights) + sum(weight for _, weight in self._buffer)
+
+  def add(self, value, weight=1):
+    self._buffer.append((value, weight))
+    self.minimum = min(self.minimum, value)
+    self.maximum = max(self.maximum, value)
+    if len(self._buffer) > self.compression * 4:
+      self._compress()
+
+  def merge(self, other):
+    self._buffer.extend(zip(other.means, other.weights))
+    self._buffer.extend(other._buffer)
+    self.minimum = min(self.minimum, other.minimum)
+    self.maximum = max(self.maximum, other.maximum)
+    self._compress()
+
+  def _compress(self):
+    if not self._buffer:
+      return
+    points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+    self._buffer = []
+    total = sum(weight for _, weight in points)
+    means, weights = [], []
+    done = 0
+    mean, weight = points[0]
+    for value, extra in points[1:]:
+      # Centroids may hold up to 4 * n * q * (1 - q) / compression points
+      q = (done + weight + extra / 2) / total
+      if weight + extra <= max(4 * total * q * (1 - q) / self.compression, 1):
+        weight += extra
+        mean += (value - mean) * extra / weight
+      else:
+        means.append(mean)
+        weights.append(weight)
+        done += weight
+        mean, weight = value, extra
+    means.append(mean)
+    weights.append(weight)
+    self.means, self.weights = means, weights
+
+  def quantile(self, q):
+    """
+    Returns:
+      <float> with the estimated value at quantile q (0 to 1), None when empty.
+    """
+    self._compress()
+    if not self.weights:
+      return None
+    total = sum(self.weights)
+    target = q * total
+    # Interpolate between the centers of the centroids, and towards min and max at the tails
+    previous_center, previous_mean = 0.0, self.minimum
+    cumulative = 0.0
+    for mean, weight in zip(self.means, self.weights):
+      center = cumulative + weight / 2
+      if target < center:
+        span = center - previous_center
+        return previous_mean + (mean - previous_mean) * ((target - previous_center) / span if span else 0)
+      previous_center, previous_mean = center, mean
+      cumulative += weight
+    span = total - previous_center
+    return previous_mean + (self.maximum - previous_mean) * ((target - previous_center) / span if span else 0)
+
+  def to_dict(self):
+    self._compress()
+    return {"c": self.compression, "m": [round(mean, 4) for mean in self.means], "w": self.weights, "min": self.minimum if self.weights else None, "max": self.maximum if self.weights else None}
+
+  @classmethod
+  def from_dict(cls, data):
+    if not data["w"]:
+      return cls(data["c"])
+    return cls(data["c"], data["m"], data["w"], data["min"], data["max"])
+
+class HyperLogLog:
+  """
+  Distinct count of a stream in 2^precision one-byte registers, about 1.04 / sqrt(2^precision)
+  relative error. Two sketches merge by keeping the largest register of each.
+  """
+  __slots__ = ("precision", "registers")
+
+  def __init__(self, precision=HLL_PRECISION, registers=None):
+    self.precision = precision
+    self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+  def add(self, item):
+    hashed = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+    index = hashed >> (64 - self.precision)
+    rest = hashed & ((1 << (64 - self.precision)) - 1)
+    rank = 64 - self.precision - rest.bit_length() + 1
+    if rank > self.registers[index]:
+      self.registers[index] = rank
+
+  def merge(self, other):
+    self.registers = bytearray(map(max, self.registers, other.registers))
+
+  def count(self):
+    size = len(self.registers)
+    alpha = 0.7213 / (1 + 1.079 / size)
+    estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+    zeros = self.registers.count(0)
+    if estimate <= 2.5 * size and zeros:
+      # Linear counting is more accurate for small cardinalities
+      estimate = size * math.log(size / zeros)
+    return int(round(estimate))
+
+  def to_dict(self):
+    return {"p": self.precision, "r": base64.b64encode(bytes(self.registers)).decode()}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(data["p"], base64.b64decode(data["r"]))
@@ -0,0 +1,190 @@
+import logging, os
+import clients, digest, eta, feedback as ratings, order_state, templates, tracing
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Renderers of the order lifecycle notifications. Each takes the scheduled event and
+# returns the (receiver, subject, body, sender) of its email.
+
+def check_in(event):
+  id = event["order_id"]
+  subject = "Recordatorio Pedido - {}".format(id)
+  body = templates.render(
+    "check_in", title=subject, name=event["restaurant_name"], order_id=id, expected_pickup=event["expected_pickup"],
+    lead_minutes="{:g}".format(eta.CHECK_IN_LEAD_MINUTES)
+  )
+  return event["restaurant_email"], subject, body, event["from_email"]
+
+def order_sent(event):
+  id = event["order_id"]
+  subject = "¡Tu pedido #{} va en camino!".format(id)
+  body = templates.render("order_sent", title=subject, name=event["client_name"], expected_delivery=event["expected_delivery"])
+  return event["client_email"], subject, body, event["from_email"]
+
+def order_delivered(event):
+  id = event["order_id"]
+  subject = "El pedido #{} ha sido entregado".format(id)
+  body = templates.render("order_delivered", title=subject, order_id=id)
+  return event["client_email"], subject, body, event["from_email"]
+
+def feedback(event):
+  id = event["order_id"]
+  subject = "¿Cómo te fue con el pedido #{}?".format(id)
+  url = ratings.link(id, event.get("restaurant_id"), event.get("courier_id"), event["client_email"])
+  link = templates.render("feedback_link", url=url) if url else ""
+  body = templates.render("feedback", title=subject, name=event["client_name"], link=link)
+  return event["client_email"], subject, body, event["from_email"]
+
+def record_delivery(order_id, courier_id):
+  """
+  Add the minutes from the order to the delivery the courier confirmed to the
+  aggregates of its restaurant and courier.
+  """
+  store = order_state.default_store()
+  record, restaurant_id = store.get(order_id), store.restaurant(order_id)
+  if record is not None and record.at[order_state.DELIVERED]:
+    ratings.default_store().observe_delivery(restaurant_id, courier_id, record.minutes(order_state.RECEIVED, order_state.DELIVERED))
+
+RENDERERS = {
+  "check_in": check_in,
+  "order_sent": order_sent,
+  "order_delivered": order_delivered,
+  "feedback": feedback,
+}
+
+# Run after a courier confirmed the stage of an order
+AFTER_CONFIRM = {
+  order_state.DELIVERED: record_delivery,
+}
+
+def claim(event_type, event):
+  """
+  Claim the stage of an event before its notification is sent, so a retried or
+  repeated schedule, or one for a stage the order is already past, sends nothing.
+  Returns:
+    <bool> False when the notification must not be sent.
+  """
+  state = order_state.EVENT_STATES.get(event_type)
+  if state is None or "order_id" not in event:
+    return True
+  # A missing ORDER_STATE_DB raises here, only an unavailable store lets the notification through
+  store = order_state.default_store()
+  try:
+    return store.claim(event["order_id"], state) is not False
+  except Exception as error:
+    logger.error("Cannot claim %s of order %s: %r", event_type, event["order_id"], error)
+    return True
+
+def release(event_type, event):
+  """
+  Give back the claim of a notification that failed, so its retry sends it.
+  """
+  state = order_state.EVENT_STATES.get(event_type)
+  if state is None or "order_id" not in event:
+    return
+  try:
+    order_state.default_store().release(event["order_id"], state)
+  except Exception as error:
+    logger.error("Cannot release %s of order %s: %r", event_type, event["order_id"], error)
+
+def confirmed(order_id, state, courier_id):
+  """
+  Run the hook of a stage the courier confirmed.
+  """
+  hook = AFTER_CONFIRM.get(state)
+  try:
+    if hook is not None:
+      hook(order_id, courier_id)
+  except Exception as error:
+    logger.error("Confirmation hook of %s %s failed: %r", order_state.STATES[state], order_id, error)
+
+# Event type handled by each single-purpose lambda
+FUNCTIONS = {
+  "orderCheckIn": "check_in",
+  "orderSent": "order_sent",
+  "orderDelivered": "order_delivered",
+  "orderFeedback": "feedback",
+}
+
+def notify(event_type, event, dispatcher=None):
+  """
+  Render and send the notification of a lifecycle event.
+  Parameters:
+    event_type: <string> with the key of the renderer in RENDERERS.
+    event: <Dict> with the scheduled event data.
+    dispatcher: <EmailDispatcher> batching the emails, defaults to the shared one.
+  """
+  if not claim(event_type, event):
+    logger.info("Order %s is past %s, skipping the notification", event.get("order_id"), event_type)
+    return
+  try:
+    with tracing.span("render"):
+      receiver, subject, body, sender = RENDERERS[event_type](event)
+    with tracing.span("email." + event_type):
+      (dispatcher or clients.dispatcher()).send(receiver, subject, body, sender)
+  except Exception:
+    release(event_type, event)
+    raise
+
+def notify_batch(events, dispatcher=None):
+  """
+  Render a batch of mixed lifecycle events and send all of their emails together.
+  In digest mode the check-ins of the same restaurant become a single kitchen ticket.
+  Parameters:
+    events: <list> of <Dict>, each with its "event_type".
+    dispatcher: <EmailDispatcher> batching the emails, defaults to the shared one.
+  Returns:
+    <list> with None for every event sent or skipped, or its error message, including
+    the events without a known "event_type".
+  """
+  dispatcher = dispatcher or clients.dispatcher()
+  types = [event.get("event_type") if isinstance(event, dict) else None for event in events]
+  futures = [None] * len(events)
+  for index, event_type in enumerate(types):
+    if event_type not in RENDERERS:
+      logger.error("Cannot route event %d with event_type %r", index, event_type)
+      futures[index] = ValueError("unknown event_type {!r}".format(event_type))
+  # Only the events whose stage was claimed here are released when they fail
+  claimed = {index for index, event in enumerate(events) if futures[index] is None and claim(types[index], event)}
+  tickets = {}
+  if digest.enabled():
+    for index in sorted(claimed):
+      if types[index] == "check_in" and "restaurant_email" in events[index]:
+        tickets.setdefault(events[index]["restaurant_email"], []).append(index)
+    tickets = {inbox: indexes for inbox, indexes in tickets.items() if len(indexes) > 1}
+  for inbox, indexes in tickets.items():
+    grouped = [events[index] for index in indexes]
+    with tracing.span("render"):
+      subject, body = digest.ticket("check_in", grouped[0]["restaurant_name"], grouped)
+    future = dispatcher.enqueue(inbox, subject, body, grouped[0]["from_email"])
+    for index in indexes:
+      futures[index] = future
+  for index in sorted(claimed):
+    if futures[index] is not None:
+      continue
+    event = events[index]
+    try:
+      with tracing.span("render"):
+        receiver, subject, body, sender = RENDERERS[types[index]](event)
+    except Exception as error:
+      logger.error("Cannot render event %s: %r", event.get("order_id"), error)
+      futures[index] = error
+      continue
+    futures[index] = dispatcher.enqueue(receiver, subject, body, sender)
+  with tracing.span("email"):
+    dispatcher.flush()
+  results = []
+  for index, future in enumerate(futures):
+    if future is None:
+      results.append(None)
+      continue
+    error = future if isinstance(future, Exception) else future.exception()
+    results.append(None if error is None else str(error))
+    if error is not None and index in claimed:
+      release(types[index], events[index])
+  return results
@@ -0,0 +1,249 @@
+import html, re
+from functools import lru_cache
+from string import Formatter
+
+# Every email body is compiled once, at import time, into static segments and slots
+
+LAYOUT = """
+  <!DOCTYPE html>
+  <html lang="es">
+  <head>
+      <meta charset="UTF-8">
+      <title>{title}</title>
+  </head>
+  <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+      <div style="background-color: #f8f8f8; padding: 20px; border-radius: 5px;">{content}</div>
+  </body>
+  </html>
+"""
+
+# Shared snippets
+H1 = '<h1 style="color: #2b2b2b; margin-bottom: 20px;">{}</h1>'
+BOX = '<div style="background-color: white; padding: 15px; border-radius: 5px; margin: 20px 0;">{}</div>'
+AUTOMATIC = '<p style="color: #666;">Este es un mensaje automático, por favor no respondas a este correo.</p>'
+
+SOURCES = {
+  # Partial rendered once per restaurant and cached
+  "restaurant_header": H1.format("¡Nuevo Pedido Recibido!") + """
+    <p>Estimado {restaurant},</p>
+  """,
+  # Itemized order table of the restaurant email, one order_item row per line
+  "order_items": """
+    <table style="width: 100%; border-collapse: collapse;">
+      <tr><th style="text-align: left;">Cant.</th><th style="text-align: left;">Platillo</th><th style="text-align: right;">Precio</th><th style="text-align: right;">Subtotal</th></tr>{rows}</table>
+  """,
+  "order_item": """
+    <tr><td>{quantity}</td><td>{name}</td><td style="text-align: right;">{price}</td><td style="text-align: right;">{subtotal}</td></tr>
+  """,
+  "new_order": "{header}<p>Has recibido un nuevo pedido con el número #{order_id}.</p>" + BOX.format("""
+      <h3 style="margin-top: 0;">Detalles del Pedido:</h3>
+      <p><strong>Items:</strong></p>
+      {order}
+      <p><strong>Total:</strong> ${amount}</p>
+  """) + """
+    <p>Por favor, confirma la recepción de este pedido en tu panel de control.</p>
+    <p>La orden debería estar lista a las: {expected_pickup}</p>
+  """ + AUTOMATIC,
+  "new_delivery": H1.format("¡Nueva Entrega Disponible!") + """
+    <p>Hola {delivery_name},</p>
+    <p>Hay un nuevo pedido disponible para entrega.</p>
+  """ + BOX.format("""
+      <h3 style="margin-top: 0;">Información de la Entrega:</h3>
+      <p><strong>Restaurante:</strong> {restaurant}</p>
+      <p><strong>Dirección del restaurante:</strong> {restaurant_address}</p>
+      <p><strong>Dirección de entrega:</strong> {delivery_address}</p>
+      <p><strong>Distancia aproximada:</strong> {distance}</p>
+      <p><strong>Se estima que lo recojas del restaurante a las:</strong> {expected_pickup}</p>
+  """) + """
+    <div style="background-color: #4CAF50; color: white; padding: 15px; border-radius: 5px; text-align: center; margin: 20px 0;">
+      <p style="margin: 0;">¿Aceptas esta entrega?</p>
+      <p style="margin: 5px 0;">Tienes 30 segundos para responder</p>
+    </div>
+    <p>Accede a la app para aceptar o rechazar este pedido.</p>{actions}""" + AUTOMATIC,
+  # Offer sent to every courier of a dispatch wave, the first to accept gets the order
+  "delivery_offer": H1.format("¡Nueva Entrega Disponible!") + """
+    <p>Hola {delivery_name},</p>
+    <p>Hay un nuevo pedido #{order_id} disponible para entrega.</p>
+  """ + BOX.format("""
+      <h3 style="margin-top: 0;">Información de la Entrega:</h3>
+      <p><strong>Restaurante:</strong> {restaurant}</p>
+      <p><strong>Dirección del restaurante:</strong> {restaurant_address}</p>
+      <p><strong>Dirección de entrega:</strong> {delivery_address}</p>
+      <p><strong>Distancia aproximada:</strong> {distance}</p>
+      <p><strong>Se estima que lo recojas del restaurante a las:</strong> {expected_pickup}</p>
+  """) + """
+    <div style="background-color: #4CAF50; color: white; padding: 15px; border-radius: 5px; text-align: center; margin: 20px 0;">
+      <p style="margin: 0;">¿Aceptas esta entrega?</p>
+      <p style="margin: 5px 0;">Tienes {timeout} segundos para responder</p>
+    </div>{actions}""" + AUTOMATIC,
+  "offer_actions": """
+    <p><a href="{accept}">Aceptar</a> | <a href="{decline}">Rechazar</a></p>
+  """,
+  # Page opened by the links of the courier emails, the action only happens once the
+  # form is sent so mail scanners following the links change nothing
+  "link_confirmation": H1.format("{question}") + """
+    <form method="post">
+      <input type="hidden" name="order" value="{order_id}">
+      <input type="hidden" name="courier" value="{courier_id}">
+      <input type="hidden" name="action" value="{action}">
+      <input type="hidden" name="token" value="{token}">
+      <button type="submit" style="background-color: #4CAF50; color: white; padding: 10px 20px; border: none; border-radius: 5px;">{button}</button>
+    </form>
+  """,
+  # Links the assigned courier confirms the pickup and the delivery with
+  "courier_actions": """
+    <p>Confirma cuando recojas el pedido y cuando lo entregues:</p>
+    <p><a href="{pickup}">Recogí el pedido</a> | <a href="{deliver}">Entregué el pedido</a></p>
+  """,
+  "offer_assigned": H1.format("¡La entrega es tuya!") + """
+    <p>Hola {delivery_name},</p>
+    <p>El pedido #{order_id} te fue asignado, recógelo en {restaurant_address}.</p>{actions}""" + AUTOMATIC,
+  "offer_cancelled": H1.format("Entrega asignada") + """
+    <p>Hola {delivery_name},</p>
+    <p>El pedido #{order_id} ya fue asignado a otro repartidor. ¡Gracias por tu tiempo!</p>
+  """ + AUTOMATIC,
+  # Consolidated ticket with the orders a restaurant got during a rush, one ticket_order row each
+  "kitchen_ticket": H1.format("{heading}") + """
+    <p>Estimado {restaurant},</p>
+    <p>{intro}</p>
+    <table style="width: 100%; border-collapse: collapse;">
+      <tr><th style="text-align: left;">Pedido</th><th style="text-align: left;">Recoger a las</th><th style="text-align: left;">Detalle</th></tr>{rows}</table>
+  """ + AUTOMATIC,
+  "ticket_order": """
+    <tr><td>#{order_id}</td><td>{expected_pickup}</td><td>{items}</td></tr>
+  """,
+  "order_confirmation": H1.format("¡Gracias por tu pedido!") + """
+    <p>Hola {name},</p>
+    <p>Hemos recibido tu pedido #{order_id} correctamente. A continuación, te mostramos los detalles:</p>
+  """ + BOX.format("""
+      <p><strong>Restaurante:</strong> {restaurant}</p>
+      <p><strong>Total:</strong> ${amount}</p>
+      <p><strong>Tiempo estimado de entrega:</strong> {expected_arrival}</p>
+      <p><strong>Dirección de entrega:</strong> {client_address}</p>
+  """) + """
+    <p>Te mantendremos informado sobre el estado de tu pedido.</p>
+    <p><strong>¿Preguntas?</strong> Contáctanos a través de nuestra app o responde a este correo.</p>
+    <p style="margin-top: 20px;">¡Que disfrutes tu comida!</p>
+  """,
+  "check_in": H1.format("¡Recordatorio de pedido por entregar!") + """
+    <p>Estimado {name},</p>
+    <p>Te recordamos que en {lead_minutes} minutos debes entregar el pedido #{order_id}.</p>
+  """ + BOX.format("""
+      <p><strong>Hora esperada para ser recogido:</strong></p>
+      {expected_pickup}
+  """) + """
+    <p>Si tienes algún inconveniente para cumplir con el tiempo estimado, por favor, contáctanos a través del panel de control.</p>
+  """ + AUTOMATIC,
+  "order_sent": H1.format("¡Pedido en camino!") + """
+    <p>Estimado {name},</p>
+  """ + BOX.format("""
+      <h3 style="margin-top: 0;">Detalles del Pedido:</h3>
+      <p>Nos complace informarte que tu pedido está en camino, debes recibirlo a las {expected_delivery}</p>
+  """) + AUTOMATIC,
+  "order_delivered": H1.format("¡Tu pedido ha sido entregado!") + """
+    <p>El pedido #{order_id} ha sido entregado.</p>
+    <p>Si tienes algún inconveniente, por favor comunícate con nosotros a través de tu aplicación.</p>
+  """ + AUTOMATIC,
+  "feedback": H1.format("¿Qué tal estuvo tu pedido?") + """
+    <p>Estimado {name},</p>
+  """ + BOX.format("""
+      <h3 style="margin-top: 0;">Detalles del Pedido:</h3>
+      <p>Ya hace unos minutos que recibiste tu pedido y queríamos preguntarte <strong>¿Qué tal estuvo tu experiencia?</strong></p>
+      <p>Te pedimos que, por favor, entres a tu aplicación y nos cuentes tu experiencia. Esto nos ayuda a darte un mejor servicio y ofrecerte las opciones que más te gustan.</p>
+  """) + "{link}" + AUTOMATIC,
+  "feedback_link": """
+    <p><a href="{url}">Califica tu pedido</a></p>
+  """,
+}
+
+# Partials are not wrapped in the HTML layout
+PARTIALS = {"restaurant_header", "order_items", "order_item", "offer_actions", "courier_actions", "ticket_order", "feedback_link"}
+
+_style = re.compile(r'style="([^"]*)"')
+_between_tags = re.compile(r">\s+<")
+_spaces = re.compile(r"\s+")
+
+def minify(source):
+  """
+  Collapse the whitespace of an HTML template and compact its inline CSS.
+  Parameters:
+    source: <string> with the HTML.
+  Returns:
+    <string> with the minified HTML.
+  """
+  html = _between_tags.sub("><", _spaces.sub(" ", source)).strip()
+  return _style.sub(lambda match: 'style="{}"'.format(re.sub(r"\s*([:;,])\s*", r"\1", match.group(1)).rstrip(";")), html)
+
+class Markup(str):
+  """
+  HTML that goes into a slot as is, like a rendered partial. Any other value is escaped.
+  """
+  __slots__ = ()
+
+class Template:
+  """
+  A template compiled into its static segments and the slots filled at render time.
+  """
+  __slots__ = ("name", "parts", "slots")
+
+  def __init__(self, name, source):
+    self.name = name
+    self.parts = []
+    self.slots = []
+    for literal, field, _, _ in Formatter().parse(minify(source)):
+      if literal:
+        self.parts.append(literal)
+      if field is not None:
+        self.slots.append((len(self.parts), field))
+        self.parts.append(None)
+
+  def render(self, values):
+    """
+    Parameters:
+      values: <Dict> with a value for every slot, escaped unless it is Markup.
+    Returns:
+      <Markup> with the rendered template.
+    """
+    parts = self.parts.copy()
+    for index, field in self.slots:
+      value = values[field]
+      parts[index] = value if isinstance(value, Markup) else html.escape(str(value))
+    return Markup("".join(parts))
+
+def compile_all(sources=SOURCES, partials=PARTIALS):
+  """
+  Returns:
+    <Dict> mapping every template name to its compiled Template.
+  """
+  return {
+    name: Template(name, source if name in partials else LAYOUT.replace("{content}", source))
+    for name, source in sources.items()
+  }
+
+registry = compile_all()
+
+def render(template, **values):
+  """
+  Render a registered template.
+  Parameters:
+    template: <string> with the template name.
+    values: the slot values, escaped unless they are Markup.
+  Returns:
+    <Markup> with the rendered HTML.
+  """
+  return registry[template].render(values)
+
+@lru_cache(maxsize=1024)
+def _render_cached(template, items):
+  return registry[template].render(dict(items))
+
+def render_cached(template, **values):
+  """
+  Render a registered template whose inputs repeat, like the per-restaurant header,
+  keeping the output in an LRU cache. Values must be hashable.
+  Parameters:
+    Same as render.
+  Returns:
+    <Markup> with the rendered HTML.
+  """
+  return _render_cached(template, tuple(sorted(values.items())))
@@ -0,0 +1,191 @@
+import logging, os, random, threading, time
+import tracing
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Per provider defaults: requests per second, burst, concurrency bounds and retries.
+# Each value can be overridden with <PROVIDER>_RATE, _BURST, _MIN_CONCURRENCY,
+# _MAX_CONCURRENCY and _RETRIES, e.g. POSTMARK_RATE=20.
+DEFAULTS = {
+  "postmark": {"rate": 10.0, "burst": 20.0, "min_concurrency": 1, "max_concurrency": 16, "retries": 4},
+  "scheduler": {"rate": 50.0, "burst": 50.0, "min_concurrency": 1, "max_concurrency": 32, "retries": 4},
+}
+
+THROTTLE_CODES = {"ThrottlingException", "Throttling", "TooManyRequestsException", "RequestLimitExceeded"}
+
+def is_throttle(error):
+  """
+  Tell whether an error is the provider pushing back.
+  Parameters:
+    error: <Exception> raised by a boto3 or Postmark call.
+  Returns:
+    <bool> True for throttling errors (AWS throttling codes or HTTP 429).
+  """
+  while error is not None:
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+      if response.get("Error", {}).get("Code") in THROTTLE_CODES:
+        return True
+      if response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 429:
+        return True
+    elif getattr(response, "status_code", None) == 429:
+      return True
+    if getattr(error, "error_code", None) == 429:
+      return True
+    error = error.__cause__
+  return False
+
+class TokenBucket:
+  """
+  Classic token bucket: rate tokens per second, holding at most burst tokens.
+  """
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self._tokens = float(burst)
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """
+    Take a token, sleeping until one is available.
+    Returns:
+      <float> with the seconds spent waiting.
+    """
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return waited
+        wait = (1 - self._tokens) / self.rate
+      time.sleep(wait)
+      waited += wait
+
+class AdaptiveLimiter:
+  """
+  AIMD concurrency limit: grows by one call per window of successful calls and is
+  halved whenever the provider throttles.
+  """
+  def __init__(self, min_concurrency, max_concurrency, decrease=0.5):
+    self.min = float(min_concurrency)
+    self.max = float(max_concurrency)
+    self.limit = float(max_concurrency)
+    self.decrease = decrease
+    self.in_flight = 0
+    self.waiting = 0
+    self._condition = threading.Condition()
+
+  def acquire(self):
+    """
+    Returns:
+      <int> with the calls waiting for a slot, this one included, when it arrived.
+    """
+    with self._condition:
+      self.waiting += 1
+      depth = self.waiting
+      while self.in_flight >= int(self.limit):
+        self._condition.wait()
+      self.waiting -= 1
+      self.in_flight += 1
+      return depth
+
+  def release(self, throttled):
+    with self._condition:
+      self.in_flight -= 1
+      if throttled:
+        self.limit = max(self.min, self.limit * self.decrease)
+      else:
+        self.limit = min(self.max, self.limit + 1 / self.limit)
+      self._condition.notify_all()
+
+class Provider:
+  """
+  Rate limiter, adaptive concurrency and throttling retries for one provider.
+  Each call reports to the invocation trace <name>_calls, _throttles and _errors
+  counts, the <name>_queue_depth gauge and the <name>_wait stage.
+  """
+  def __init__(self, name, rate, burst, min_concurrency, max_concurrency, retries, backoff=0.1):
+    self.name = name
+    self.bucket = TokenBucket(rate, burst)
+    self.limiter = AdaptiveLimiter(min_concurrency, max_concurrency)
+    self.retries = retries
+    self.backoff = backoff
+
+  def call(self, fn, *args, **kwargs):
+    """
+    Run a provider call within the limits, retrying when it is throttled.
+    Parameters:
+      fn: <callable> with the provider call.
+      args, kwargs: its arguments.
+    Returns:
+      The result of the call.
+    """
+    attempt = 0
+    while True:
+      start = time.perf_counter()
+      tracing.gauge(self.name + "_queue_depth", self.limiter.acquire())
+      throttled = False
+      try:
+        self.bucket.acquire()
+        tracing.add(self.name + "_wait", (time.perf_counter() - start) * 1000)
+        tracing.count(self.name + "_calls")
+        return fn(*args, **kwargs)
+      except Exception as error:
+        throttled = is_throttle(error)
+        if not throttled:
+          tracing.count(self.name + "_errors")
+          raise
+        tracing.count(self.name + "_throttles")
+        if attempt >= self.retries:
+          raise
+      finally:
+        self.limiter.release(throttled)
+      # Exponential backoff with full jitter before retrying the throttled call
+      delay = random.uniform(0, self.backoff * 2 ** attempt)
+      logger.warning("%s throttled, retrying in %.2fs", self.name, delay)
+      time.sleep(delay)
+      attempt += 1
+
+class ThrottledClient:
+  """
+  Proxy that routes the API methods of a client through a Provider.
+  """
+  def __init__(self, client, provider, methods):
+    self._client = client
+    self._provider = provider
+    self._methods = methods
+
+  def __getattr__(self, name):
+    attribute = getattr(self._client, name)
+    if name not in self._methods:
+      return attribute
+    def call(*args, **kwargs):
+      return self._provider.call(attribute, *args, **kwargs)
+    return call
+
+_providers = {}
+_lock = threading.Lock()
+
+def provider(name):
+  """
+  Parameters:
+    name: <string> with the provider name, e.g. "postmark" or "scheduler".
+  Returns:
+    <Provider> shared by the process, configured from DEFAULTS and the environment.
+  """
+  with _lock:
+    if name not in _providers:
+      settings = dict(DEFAULTS.get(name, DEFAULTS["postmark"]))
+      for key, value in settings.items():
+        settings[key] = type(value)(os.environ.get("{}_{}".format(name.upper(), key.upper()), value))
+      _providers[name] = Provider(name, **settings)
+    return _providers[name]
@@ -0,0 +1,271 @@
+import json, logging, os, threading, time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import stages
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+DISPATCHER_FUNCTION = os.environ.get('TIMELINE_FUNCTION', 'orderTimeline')
+RETRY_SECONDS = int(os.environ.get('TIMELINE_RETRY_SECONDS', '60'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Constants
+scheduler_time_format = "%Y-%m-%dT%H:%M:%S"
+class SchedulerError(Exception):
+  """
+  Raised by the local schedulers, carrying the botocore style error code
+  (ConflictException, ResourceNotFoundException) so callers handle both alike.
+  """
+  def __init__(self, code, message):
+    super().__init__(message)
+    self.response = {"Error": {"Code": code, "Message": message}}
+
+def error_code(error):
+  """
+  Parameters:
+    error: <Exception> raised by a scheduler client.
+  Returns:
+    <string> with its AWS error code, or None.
+  """
+  return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+def load_handler(function):
+  """
+  Get the handler of a stage lambda so it can run in-process.
+  Parameters:
+    function: <string> with the Lambda function name of the stage, or of the router.
+  Returns:
+    <callable> taking the step input and the Lambda context.
+  """
+  default_type = stages.FUNCTIONS.get(function)
+  def handler(event, context):
+    stages.notify(event.get("event_type", default_type), event)
+  return handler
+
+def encode_steps(steps):
+  """
+  Convert order steps into the compact, time ordered form stored in the schedule.
+  Parameters:
+    steps: <list> of <Dict> with name, at (<datetime>), function and input.
+  Returns:
+    <list> of <Dict> with name, at (epoch seconds), function and input.
+  """
+  encoded = [{
+    "name": step["name"],
+    "at": int(step["at"].timestamp()),
+    "function": step["function"],
+    "input": step["input"]
+  } for step in steps]
+  return sorted(encoded, key=lambda step: step["at"])
+
+def schedule_arguments(order_id, steps, target_arn, role_arn, at):
+  """
+  Build the create/update_schedule arguments of an order timeline.
+  Parameters:
+    order_id: <string> with the order identifier.
+    steps: <list> with the encoded steps still pending.
+    target_arn: <string> with the ARN of the timeline dispatcher lambda.
+    role_arn: <string> with the role the scheduler assumes to invoke it.
+    at: <int> with the epoch seconds of the next firing.
+  Returns:
+    <Dict> with the schedule keyword arguments. The firing that runs the last steps
+    deletes the schedule itself, saving a delete_schedule call per order.
+  """
+  final = steps[-1]["at"] <= at
+  timeline = {"order_id": order_id, "steps": steps}
+  if final:
+    timeline["final"] = True
+  return {
+    "ActionAfterCompletion": 'DELETE' if final else 'NONE',
+    "Name": "{}_timeline".format(order_id),
+    "Description": "Timeline with the pending lifecycle steps of order #{}".format(order_id),
+    "FlexibleTimeWindow": {
+      'Mode': 'OFF'
+    },
+    "ScheduleExpression": "at({})".format(datetime.fromtimestamp(at, timezone.utc).strftime(scheduler_time_format)),
+    "ScheduleExpressionTimezone": "UTC",
+    "State": "ENABLED",
+    "Target": {
+      'Arn': target_arn,
+      'RoleArn': role_arn,
+      'Input': json.dumps(timeline, separators=(",", ":"))
+    }
+  }
+
+def registration(order_id, steps, target_arn, role_arn):
+  """
+  Build the create_schedule arguments of a new order timeline.
+  Parameters:
+    order_id: <string> with the order identifier.
+    steps: <list> with the steps returned by build_steps.
+    target_arn: <string> with the ARN of the timeline dispatcher lambda.
+    role_arn: <string> with the role the scheduler assumes to invoke it.
+  Returns:
+    <Dict> with the schedule keyword arguments.
+  """
+  encoded = encode_steps(steps)
+  return schedule_arguments(order_id, encoded, target_arn, role_arn, encoded[0]["at"])
+
+def register(client, order_id, steps, target_arn, role_arn):
+  """
+  Register a single schedule holding every lifecycle step of an order.
+  Parameters:
+    client: EventBridge Scheduler client.
+    Same as registration.
+  """
+  return client.create_schedule(**registration(order_id, steps, target_arn, role_arn))
+
+def run_due(timelines, context, now=None, executor=None, handler_loader=load_handler):
+  """
+  Run the due steps of many timelines in a single invocation.
+  Steps of the same order run in order; different orders run concurrently when an
+  executor is given.
+  Parameters:
+    timelines: <list> of <Dict> with order_id and steps.
+    context: Lambda runtime context passed to the stage handlers.
+    now: <int> with the current epoch seconds.
+    executor: <Executor> used to run orders concurrently.
+    handler_loader: <callable> returning the handler for a function name.
+  Returns:
+    <list> of <Dict> with order_id, the steps still pending, the failures and whether
+    the schedule that fired deletes itself.
+  """
+  now = int(time.time()) if now is None else now
+
+  def run(timeline):
+    pending, failures = [], {}
+    for step in timeline["steps"]:
+      if step["at"] > now or step["name"] in failures:
+        pending.append(step)
+        continue
+      try:
+        handler_loader(step["function"])(step["input"], context)
+      except Exception as error:
+        logger.error("Step %s of order %s failed: %s", step["name"], timeline["order_id"], error)
+        failures[step["name"]] = str(error)
+        pending.append(step)
+    return {"order_id": timeline["order_id"], "steps": pending, "failures": failures, "final": timeline.get("final", False)}
+
+  if executor is None:
+    return [run(timeline) for timeline in timelines]
+  return list(executor.map(run, timelines))
+
+def advance(client, result, target_arn, role_arn, now=None):
+  """
+  Move the timeline schedule to its next step, or delete it when it is done and did
+  not delete itself. Failed steps are retried after TIMELINE_RETRY_SECONDS, with a new
+  schedule when the one that fired deleted itself.
+  Parameters:
+    client: EventBridge Scheduler client.
+    result: <Dict> returned by run_due for the order.
+    target_arn: <string> with the ARN of the timeline dispatcher lambda.
+    role_arn: <string> with the role the scheduler assumes to invoke it.
+    now: <int> with the current epoch seconds.
+  """
+  now = int(time.time()) if now is None else now
+  name = "{}_timeline".format(result["order_id"])
+  if not result["steps"]:
+    return None if result.get("final") else client.delete_schedule(Name=name)
+  at = max(result["steps"][0]["at"], now + RETRY_SECONDS if result["failures"] else now + 1)
+  arguments = schedule_arguments(result["order_id"], result["steps"], target_arn, role_arn, at)
+  if not result.get("final"):
+    return client.update_schedule(**arguments)
+  try:
+    return client.create_schedule(**arguments)
+  except Exception as error:
+    # The schedule that fired may not be deleted yet
+    if error_code(error) != "ConflictException":
+      raise
+    return client.update_schedule(**arguments)
+
+class FakeScheduler:
+  """
+  In-memory stand-in for the EventBridge Scheduler client, to run schedules offline.
+  Supports one-time "at()" expressions only.
+  """
+  def __init__(self):
+    self.schedules = {}
+    self.fired = set()
+    self._lock = threading.Lock()
+
+  def create_schedule(self, **kwargs):
+    with self._lock:
+      if kwargs["Name"] in self.schedules:
+        raise SchedulerError("ConflictException", "Schedule {} already exists".format(kwargs["Name"]))
+      self.schedules[kwargs["Name"]] = kwargs
+    return {"ScheduleArn": "arn:fake:scheduler:::schedule/default/{}".format(kwargs["Name"])}
+
+  def update_schedule(self, **kwargs):
+    with self._lock:
+      if kwargs["Name"] not in self.schedules:
+        raise SchedulerError("ResourceNotFoundException", "Schedule {} does not exist".format(kwargs["Name"]))
+      self.schedules[kwargs["Name"]] = kwargs
+      self.fired.discard(kwargs["Name"])
+    return {"ScheduleArn": "arn:fake:scheduler:::schedule/default/{}".format(kwargs["Name"])}
+
+  def delete_schedule(self, Name, **kwargs):
+    with self._lock:
+      if self.schedules.pop(Name, None) is None:
+        raise SchedulerError("ResourceNotFoundException", "Schedule {} does not exist".format(Name))
+      self.fired.discard(Name)
+    return {}
+
+  def get_schedule(self, Name, **kwargs):
+    return self.schedules[Name]
+
+  @staticmethod
+  def fire_time(schedule):
+    """
+    Parameters:
+      schedule: <Dict> with the schedule keyword arguments.
+    Returns:
+      <int> with the epoch seconds of its at() expression.
+    """
+    when = datetime.strptime(schedule["ScheduleExpression"][3:-1], scheduler_time_format)
+    return int(when.replace(tzinfo=timezone.utc).timestamp())
+
+  def due(self, now=None):
+    """
+    Pop the schedules that should have fired by now.
+    Parameters:
+      now: <int> with the current epoch seconds.
+    Returns:
+      <list> of (target ARN, input <Dict>) tuples, ordered by firing time.
+    """
+    now = int(time.time()) if now is None else now
+    with self._lock:
+      due = sorted(
+        (self.fire_time(schedule), name) for name, schedule in self.schedules.items()
+        if name not in self.fired and schedule.get("State", "ENABLED") == "ENABLED" and self.fire_time(schedule) <= now
+      )
+      fired = []
+      for _, name in due:
+        schedule = self.schedules[name]
+        if schedule.get("ActionAfterCompletion") == 'DELETE':
+          del self.schedules[name]
+        else:
+          self.fired.add(name)
+        fired.append((schedule["Target"]["Arn"], json.loads(schedule["Target"]["Input"])))
+    return fired
+
+  def run_due(self, handlers, now=None):
+    """
+    Invoke the handler of every due schedule, once per schedule as EventBridge does.
+    Parameters:
+      handlers: <Dict> mapping a target ARN to a lambda_handler. Targets handled by
+        the timeline dispatcher also receive the simulated time.
+      now: <int> with the current epoch seconds.
+    Returns:
+      <list> with the handler results.
+    """
+    now = int(time.time()) if now is None else now
+    results = []
+    for arn, payload in self.due(now):
+      context = SimpleNamespace(invoked_function_arn=arn, aws_request_id="local")
+      if arn.endswith(":" + DISPATCHER_FUNCTION):
+        payload = dict(payload, now=now)
+      results.append(handlers[arn](payload, context))
+    return results
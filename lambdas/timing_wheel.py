@@ -0,0 +1,372 @@
+import fcntl, json, logging, os, sys, threading, time
+from contextlib import contextmanager
+import stages, timeline
+from timeline import FakeScheduler, SchedulerError
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+WHEEL_PATH = os.environ.get('WHEEL_PATH', '/tmp/ajoloeats-wheel.log')
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Constants
+# 4 levels of 64 one-second slots cover ~194 days
+LEVEL_BITS = 6
+LEVELS = 4
+LEVEL_MASK = (1 << LEVEL_BITS) - 1
+
+class Timer:
+  """
+  A pending schedule inside the wheel.
+  """
+  __slots__ = ("name", "expires", "arn", "input", "delete_after", "level", "slot")
+
+  def __init__(self, name, expires, arn, input, delete_after):
+    self.name = name
+    self.expires = expires
+    self.arn = arn
+    self.input = input
+    self.delete_after = delete_after
+    self.level = None
+    self.slot = None
+
+class TimingWheel:
+  """
+  Hierarchical timing wheel with one-second ticks.
+  Insert and cancel are O(1); advancing pops every expired timer in O(1) per timer,
+  cascading the timers of the upper levels down as the lower level wraps around.
+  """
+  def __init__(self, now=None):
+    self.timers = {}
+    self._reset(int(time.time()) if now is None else int(now))
+
+  def _reset(self, now):
+    self.current = now
+    self.levels = [[{} for _ in range(LEVEL_MASK + 1)] for _ in range(LEVELS)]
+    self.overdue = {}
+
+  def __len__(self):
+    return len(self.timers)
+
+  def insert(self, timer):
+    """
+    Parameters:
+      timer: <Timer> to add, replacing any timer with the same name.
+    """
+    if timer.name in self.timers:
+      self.cancel(timer.name)
+    self.timers[timer.name] = timer
+    self._place(timer)
+
+  def cancel(self, name):
+    """
+    Parameters:
+      name: <string> with the name of the timer to remove.
+    Returns:
+      <Timer> removed, or None when it was not pending.
+    """
+    timer = self.timers.pop(name, None)
+    if timer is not None:
+      bucket = self.overdue if timer.level is None else self.levels[timer.level][timer.slot]
+      bucket.pop(name, None)
+    return timer
+
+  def advance(self, now):
+    """
+    Move the wheel up to now and pop every timer that expired.
+    Parameters:
+      now: <int> with the current epoch seconds.
+    Returns:
+      <list> of <Timer> expired, ordered by expiry.
+    """
+    now = int(now)
+    due = list(self.overdue.values())
+    self.overdue.clear()
+    if not self.timers or now - self.current > (1 << (LEVEL_BITS * LEVELS)):
+      # Nothing pending, or a gap longer than the wheel: jump straight to now
+      due = [timer for timer in self.timers.values() if timer.expires <= now]
+      for timer in due:
+        self.cancel(timer.name)
+      self._reset(now + 1)
+      for timer in self.timers.values():
+        self._place(timer)
+      return sorted(due, key=lambda timer: timer.expires)
+    while self.current <= now:
+      index = self.current & LEVEL_MASK
+      level = 1
+      while index == 0 and level < LEVELS:
+        index = (self.current >> (LEVEL_BITS * level)) & LEVEL_MASK
+        self._cascade(level, index)
+        level += 1
+      slot = self.levels[0][self.current & LEVEL_MASK]
+      due.extend(slot.values())
+      slot.clear()
+      self.current += 1
+    for timer in due:
+      self.timers.pop(timer.name, None)
+    return sorted(due, key=lambda timer: timer.expires)
+
+  def _cascade(self, level, index):
+    slot = self.levels[level][index]
+    timers = list(slot.values())
+    slot.clear()
+    for timer in timers:
+      self._place(timer)
+
+  def _place(self, timer):
+    delta = timer.expires - self.current
+    if delta < 0:
+      timer.level = timer.slot = None
+      self.overdue[timer.name] = timer
+      return
+    for level in range(LEVELS):
+      if delta < 1 << (LEVEL_BITS * (level + 1)) or level == LEVELS - 1:
+        timer.level = level
+        timer.slot = (timer.expires >> (LEVEL_BITS * level)) & LEVEL_MASK
+        self.levels[level][timer.slot][timer.name] = timer
+        return
+
+class TimingWheelScheduler(FakeScheduler):
+  """
+  Local EventBridge Scheduler backend built on a TimingWheel.
+  Pending schedules are journaled to an append-only file, replayed on start-up and
+  compacted once most of the journal records are stale. Like EventBridge, a fired
+  schedule without ActionAfterCompletion DELETE is retained until it is updated or
+  deleted. Processes sharing the journal (e.g. on an EFS mount) take a file lock and
+  read the records written by the others before every change, so the functions that
+  create schedules and the one ticking the wheel see the same schedules.
+  """
+  def __init__(self, path=WHEEL_PATH, now=None):
+    """
+    Parameters:
+      path: <string> with the journal file path, or None to keep the wheel in memory.
+      now: <int> with the epoch seconds the wheel starts at.
+    """
+    self.wheel = TimingWheel(now)
+    self.retained = {}
+    self.path = path
+    self._lock = threading.Lock()
+    self._records = 0
+    self._journal = None
+    self._inode = None
+    self._offset = 0
+    if path is not None:
+      self._journal = open(path, "ab+")
+      with self._exclusive():
+        pass
+
+  @property
+  def schedules(self):
+    timers = dict(self.retained, **self.wheel.timers)
+    return {name: self._arguments(timer) for name, timer in timers.items()}
+
+  def create_schedule(self, **kwargs):
+    with self._exclusive():
+      if kwargs["Name"] in self.wheel.timers or kwargs["Name"] in self.retained:
+        raise SchedulerError("ConflictException", "Schedule {} already exists".format(kwargs["Name"]))
+      self._add(kwargs)
+    return {"ScheduleArn": "arn:local:scheduler:::schedule/default/{}".format(kwargs["Name"])}
+
+  def update_schedule(self, **kwargs):
+    with self._exclusive():
+      if kwargs["Name"] not in self.wheel.timers and self.retained.pop(kwargs["Name"], None) is None:
+        raise SchedulerError("ResourceNotFoundException", "Schedule {} does not exist".format(kwargs["Name"]))
+      self._add(kwargs)
+    return {"ScheduleArn": "arn:local:scheduler:::schedule/default/{}".format(kwargs["Name"])}
+
+  def delete_schedule(self, Name, **kwargs):
+    with self._exclusive():
+      if self.wheel.cancel(Name) is None and self.retained.pop(Name, None) is None:
+        raise SchedulerError("ResourceNotFoundException", "Schedule {} does not exist".format(Name))
+      self._write({"op": "del", "name": Name})
+    return {}
+
+  def get_schedule(self, Name, **kwargs):
+    with self._exclusive():
+      timer = self.wheel.timers.get(Name) or self.retained.get(Name)
+    if timer is None:
+      raise SchedulerError("ResourceNotFoundException", "Schedule {} does not exist".format(Name))
+    return self._arguments(timer)
+
+  def due(self, now=None):
+    """
+    Pop the schedules that should have fired by now.
+    Parameters:
+      now: <int> with the current epoch seconds.
+    Returns:
+      <list> of (target ARN, input <Dict>) tuples, ordered by firing time.
+    """
+    now = int(time.time()) if now is None else now
+    with self._exclusive():
+      timers = self.wheel.advance(now)
+      for timer in timers:
+        if timer.delete_after:
+          self._write({"op": "del", "name": timer.name})
+        else:
+          self.retained[timer.name] = timer
+          self._write({"op": "fire", "name": timer.name})
+      self._compact()
+    return [(timer.arn, json.loads(timer.input)) for timer in timers]
+
+  def close(self):
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
+
+  @contextmanager
+  def _exclusive(self):
+    """
+    Hold the journal for a change, after reading what other processes wrote to it.
+    """
+    with self._lock:
+      if self._journal is None:
+        yield
+        return
+      fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX)
+      try:
+        self._sync()
+        yield
+        self._journal.flush()
+        self._offset = os.fstat(self._journal.fileno()).st_size
+      finally:
+        fcntl.flock(self._journal.fileno(), fcntl.LOCK_UN)
+
+  def _sync(self):
+    status = os.stat(self.path)
+    if status.st_ino != os.fstat(self._journal.fileno()).st_ino:
+      # Compacted by another process, follow the new file
+      self._journal.close()
+      self._journal = open(self.path, "ab+")
+      fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX)
+      status = os.fstat(self._journal.fileno())
+    if status.st_ino != self._inode or status.st_size < self._offset:
+      self.wheel = TimingWheel(self.wheel.current)
+      self.retained = {}
+      self._records = 0
+      self._inode, self._offset = status.st_ino, 0
+    if status.st_size == self._offset:
+      return
+    self._journal.seek(self._offset)
+    for line in self._journal:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        logger.warning("Skipping corrupt journal record in %s", self.path)
+        continue
+      self._records += 1
+      self._apply(record)
+    self._offset = self._journal.tell()
+
+  def _apply(self, record):
+    if record["op"] == "add":
+      self.retained.pop(record["name"], None)
+      self.wheel.insert(Timer(record["name"], record["at"], sys.intern(record["arn"]), record["input"], record["delete"]))
+    elif record["op"] == "fire":
+      timer = self.wheel.cancel(record["name"])
+      if timer is not None:
+        self.retained[record["name"]] = timer
+    else:
+      self.wheel.cancel(record["name"])
+      self.retained.pop(record["name"], None)
+
+  def _add(self, kwargs):
+    timer = Timer(
+      kwargs["Name"],
+      self.fire_time(kwargs),
+      sys.intern(kwargs["Target"]["Arn"]),
+      kwargs["Target"]["Input"],
+      kwargs.get("ActionAfterCompletion") == 'DELETE'
+    )
+    self.wheel.insert(timer)
+    self._write(self._record(timer))
+
+  @staticmethod
+  def _record(timer):
+    return {"op": "add", "name": timer.name, "at": timer.expires, "arn": timer.arn, "input": timer.input, "delete": timer.delete_after}
+
+  @staticmethod
+  def _arguments(timer):
+    return {
+      "Name": timer.name,
+      "ActionAfterCompletion": 'DELETE' if timer.delete_after else 'NONE',
+      "ScheduleExpression": "at({})".format(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timer.expires))),
+      "ScheduleExpressionTimezone": "UTC",
+      "State": "ENABLED",
+      "Target": {'Arn': timer.arn, 'Input': timer.input}
+    }
+
+  def _write(self, record):
+    self._records += 1
+    if self._journal is not None:
+      self._journal.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+
+  def _compact(self):
+    live = len(self.wheel) + len(self.retained)
+    if self._journal is None or self._records < 2 * live + 1024:
+      return
+    temporary = "{}.{}.tmp".format(self.path, os.getpid())
+    with open(temporary, "w", encoding="utf-8") as journal:
+      for timer in self.wheel.timers.values():
+        journal.write(json.dumps(self._record(timer), separators=(",", ":")) + "\n")
+      for timer in self.retained.values():
+        journal.write(json.dumps(self._record(timer), separators=(",", ":")) + "\n")
+        journal.write(json.dumps({"op": "fire", "name": timer.name}, separators=(",", ":")) + "\n")
+    # Still holding the lock of the old file, so no other process writes in between
+    os.replace(temporary, self.path)
+    old, self._journal = self._journal, open(self.path, "ab+")
+    fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX)
+    fcntl.flock(old.fileno(), fcntl.LOCK_UN)
+    old.close()
+    status = os.fstat(self._journal.fileno())
+    self._inode, self._offset = status.st_ino, status.st_size
+    self._records = len(self.wheel) + 2 * len(self.retained)
+
+_schedulers = {}
+
+def shared(path=WHEEL_PATH):
+  """
+  Parameters:
+    path: <string> with the journal file path.
+  Returns:
+    <TimingWheelScheduler> shared by every caller in this process for that path.
+  """
+  if path not in _schedulers:
+    _schedulers[path] = TimingWheelScheduler(path)
+  return _schedulers[path]
+
+def tick(scheduler=None, now=None, context=None):
+  """
+  Fire every due schedule of the wheel in-process, as EventBridge would invoke their
+  targets: stage events go to stages.notify, router batches to stages.notify_batch
+  and order timelines run their due steps and move forward on the wheel.
+  Parameters:
+    scheduler: <TimingWheelScheduler> to tick, the shared one by default.
+    now: <int> with the current epoch seconds.
+    context: Lambda runtime context passed to the timeline steps.
+  Returns:
+    <tuple> with the number of schedules fired and the errors per schedule target.
+  """
+  scheduler = scheduler or shared()
+  now = int(time.time()) if now is None else now
+  fired, failures = 0, {}
+  for arn, event in scheduler.due(now):
+    fired += 1
+    function = arn.rsplit(":", 1)[-1]
+    try:
+      if function == timeline.DISPATCHER_FUNCTION:
+        for result in timeline.run_due([event], context, now):
+          timeline.advance(scheduler, result, arn, None, now)
+          if result["failures"]:
+            failures.setdefault(function, []).append(result["failures"])
+      elif "events" in event:
+        errors = [error for error in stages.notify_batch(event["events"]) if error is not None]
+        if errors:
+          failures.setdefault(function, []).extend(errors)
+      else:
+        stages.notify(event.get("event_type", stages.FUNCTIONS.get(function)), event)
+    except Exception as error:
+      logger.error("Schedule for %s failed: %r", function, error)
+      failures.setdefault(function, []).append(str(error))
+  return fired, failures
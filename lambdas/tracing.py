@@ -0,0 +1,177 @@
+import contextvars, json, os, random, sys, threading, time
+from functools import wraps
+
+# Load env
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AjoloEats')
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1.0'))
+
+# The handlers import this module first, so the init phase is measured from here
+INIT_STARTED = time.perf_counter()
+
+# Trace of the invocation running in the current context, None when not sampled.
+# Work handed to other threads keeps it through timed().
+_current = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+  """
+  Milliseconds spent per stage during one invocation, and counts of what happened in
+  it. Repeated stages and counts add up, gauges keep their highest value.
+  """
+  __slots__ = ("function", "stages", "counts", "_lock")
+
+  def __init__(self, function):
+    self.function = function
+    self.stages = {}
+    self.counts = {}
+    self._lock = threading.Lock()
+
+  def add(self, stage, elapsed_ms):
+    with self._lock:
+      self.stages[stage] = self.stages.get(stage, 0.0) + elapsed_ms
+
+  def count(self, name, value):
+    with self._lock:
+      self.counts[name] = self.counts.get(name, 0) + value
+
+  def gauge(self, name, value):
+    with self._lock:
+      self.counts[name] = max(self.counts.get(name, value), value)
+
+class Span:
+  __slots__ = ("trace", "stage", "started")
+
+  def __init__(self, trace, stage):
+    self.trace = trace
+    self.stage = stage
+
+  def __enter__(self):
+    self.started = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.trace.add(self.stage, (time.perf_counter() - self.started) * 1000)
+    return False
+
+class _NoSpan:
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+NO_SPAN = _NoSpan()
+
+def span(stage):
+  """
+  Time a block of code as a stage of the current invocation.
+  Parameters:
+    stage: <string> with the metric name of the stage.
+  Returns:
+    A context manager, a shared no-op one when the invocation is not sampled.
+  """
+  trace = _current.get()
+  return NO_SPAN if trace is None else Span(trace, stage)
+
+def add(stage, elapsed_ms):
+  """
+  Add time measured elsewhere, e.g. by another thread, to a stage of the current invocation.
+  """
+  trace = _current.get()
+  if trace is not None:
+    trace.add(stage, elapsed_ms)
+
+def count(name, value=1):
+  """
+  Count something that happened during the current invocation, e.g. a throttled call.
+  """
+  trace = _current.get()
+  if trace is not None:
+    trace.count(name, value)
+
+def gauge(name, value):
+  """
+  Report a level seen during the current invocation, e.g. a queue depth; the highest is emitted.
+  """
+  trace = _current.get()
+  if trace is not None:
+    trace.gauge(name, value)
+
+def timed(stage, function):
+  """
+  Returns:
+    The callable timed as a stage of the current invocation, also from another thread.
+  """
+  trace = _current.get()
+  if trace is None:
+    return function
+  def call(*args, **kwargs):
+    token = _current.set(trace)
+    try:
+      with Span(trace, stage):
+        return function(*args, **kwargs)
+    finally:
+      _current.reset(token)
+  return call
+
+def emit(trace, context, cold, init_ms, duration_ms, error):
+  """
+  Write the stages and counts of an invocation to stdout as a CloudWatch Embedded
+  Metric Format line.
+  """
+  metrics = dict(trace.stages)
+  metrics["Duration"] = duration_ms
+  if init_ms is not None:
+    metrics["InitDuration"] = init_ms
+  record = {
+    "_aws": {
+      "Timestamp": int(time.time() * 1000),
+      "CloudWatchMetrics": [{
+        "Namespace": NAMESPACE,
+        "Dimensions": [["Function"], ["Function", "Start"]],
+        "Metrics": [{"Name": name, "Unit": "Milliseconds"} for name in metrics] + [{"Name": name, "Unit": "Count"} for name in trace.counts] + [{"Name": "Error", "Unit": "Count"}],
+      }],
+    },
+    "Function": trace.function,
+    "Start": "cold" if cold else "warm",
+    "Error": int(error),
+    "SampleRate": SAMPLE_RATE,
+    "RequestId": getattr(context, "aws_request_id", None),
+  }
+  record.update((name, round(value, 3)) for name, value in metrics.items())
+  record.update(trace.counts)
+  sys.stdout.write(json.dumps(record) + "\n")
+
+def handler(function):
+  """
+  Decorator tracing a lambda_handler: every cold start and a SAMPLE_RATE fraction of
+  the warm invocations emit their stage timings, counts, total duration and errors.
+  Parameters:
+    function: <string> with the name reported in the Function dimension.
+  """
+  def decorate(lambda_handler):
+    state = {"cold": True}
+    lock = threading.Lock()
+
+    @wraps(lambda_handler)
+    def traced(event, context, *args, **kwargs):
+      started = time.perf_counter()
+      with lock:
+        cold, state["cold"] = state["cold"], False
+      if SAMPLE_RATE <= 0 or (not cold and random.random() >= SAMPLE_RATE):
+        return lambda_handler(event, context, *args, **kwargs)
+      trace = Trace(function)
+      token = _current.set(trace)
+      error = False
+      try:
+        return lambda_handler(event, context, *args, **kwargs)
+      except Exception:
+        error = True
+        raise
+      finally:
+        _current.reset(token)
+        duration = (time.perf_counter() - started) * 1000
+        emit(trace, context, cold, (started - INIT_STARTED) * 1000 if cold else None, duration, error)
+    return traced
+  return decorate
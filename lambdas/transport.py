@@ -0,0 +1,232 @@
+import logging, os, socket, threading, time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+import tracing
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '32'))
+POOL_BLOCK = os.environ.get('HTTP_POOL_BLOCK', 'false').lower() == 'true'
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+# Keep idle pooled sockets alive between warm invocations instead of paying a new
+# TCP + TLS handshake per request.
+KEEPALIVE_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for option, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+  if hasattr(socket, option):
+    KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, option), value))
+
+# Phases of the connection being opened by the current thread, if any
+_local = threading.local()
+
+def _phases():
+  phases = getattr(_local, "phases", None)
+  if phases is None:
+    phases = _local.phases = {}
+  return phases
+
+def record(timing):
+  """
+  Add the timing of a request to the invocation trace: an http_requests count, the
+  http_new_connections opened and one http_<phase> stage per measured phase.
+  Parameters:
+    timing: <Dict> with whether the connection was reused and the milliseconds per phase.
+  """
+  tracing.count("http_requests")
+  if timing["reused"] is False:
+    tracing.count("http_new_connections")
+  for phase in ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms"):
+    if timing[phase]:
+      tracing.add("http_" + phase[:-3], timing[phase])
+
+class TimedConnection:
+  """
+  Connection mixin recording how long the DNS lookup and TCP connect took.
+  """
+  default_socket_options = KEEPALIVE_OPTIONS
+
+  def _new_conn(self):
+    phases = _phases()
+    start = time.perf_counter()
+    original = self._dns_host
+    try:
+      addresses = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(original, self.port, 0, socket.SOCK_STREAM)))
+    except socket.gaierror:
+      addresses = [original]  # let urllib3 raise its own resolution error
+    resolved = time.perf_counter()
+    try:
+      # Try the addresses in order, as socket.create_connection would
+      for position, address in enumerate(addresses):
+        self._dns_host = address
+        try:
+          sock = super()._new_conn()
+          break
+        except (ConnectTimeoutError, NewConnectionError) as error:
+          if position == len(addresses) - 1:
+            raise
+          logger.warning("Cannot connect to %s at %s, trying the next address: %r", original, address, error)
+    finally:
+      self._dns_host = original
+    phases["dns_ms"] = (resolved - start) * 1000
+    phases["connect_ms"] = (time.perf_counter() - resolved) * 1000
+    return sock
+
+class TimedHTTPConnection(TimedConnection, HTTPConnection):
+  pass
+
+class TimedHTTPSConnection(TimedConnection, HTTPSConnection):
+  """
+  HTTPS connection also recording how long the TLS handshake took.
+  """
+  def connect(self):
+    start = time.perf_counter()
+    super().connect()
+    phases = _phases()
+    total = (time.perf_counter() - start) * 1000
+    phases["tls_ms"] = max(0.0, total - phases.get("dns_ms", 0.0) - phases.get("connect_ms", 0.0))
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+  ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+  ConnectionCls = TimedHTTPSConnection
+
+class PooledAdapter(HTTPAdapter):
+  """
+  HTTPAdapter over keep-alive connection pools, recording the timing of every request.
+  """
+  def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=POOL_BLOCK):
+    super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+  def send(self, request, timeout=None, **kwargs):
+    _local.phases = {}
+    start = time.perf_counter()
+    response = None
+    try:
+      # returns once the headers are read, the body is streamed afterwards
+      response = super().send(request, timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+      return response
+    finally:
+      total = (time.perf_counter() - start) * 1000
+      phases = _phases()
+      _local.phases = None
+      handshake = sum(phases.values())
+      record({
+        "host": requests.utils.urlparse(request.url).hostname,
+        "status": response.status_code if response is not None else None,
+        "reused": not phases,
+        "dns_ms": phases.get("dns_ms", 0.0),
+        "connect_ms": phases.get("connect_ms", 0.0),
+        "tls_ms": phases.get("tls_ms", 0.0),
+        "ttfb_ms": total - handshake if response is not None else None,
+        "total_ms": total,
+      })
+
+def session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+  """
+  Build a requests session over keep-alive connection pools.
+  HTTP/2 is not offered: requests and urllib3 only speak HTTP/1.1, so concurrency comes
+  from pool_maxsize reusable connections per host instead of multiplexed streams.
+  Parameters:
+    pool_connections: <int> with the number of hosts kept in the pool.
+    pool_maxsize: <int> with the connections kept per host, at least the concurrent callers.
+  Returns:
+    <requests.Session>
+  """
+  pooled = requests.Session()
+  adapter = PooledAdapter(pool_connections, pool_maxsize)
+  pooled.mount("https://", adapter)
+  pooled.mount("http://", adapter)
+  return pooled
+
+def botocore_config(max_pool_connections=POOL_MAXSIZE):
+  """
+  Returns:
+    <botocore.config.Config> with a keep-alive pool sized for the concurrent callers.
+  """
+  from botocore.config import Config
+  return Config(
+    max_pool_connections=max_pool_connections,
+    tcp_keepalive=True,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+  )
+
+def instrument_boto(client):
+  """
+  Record the timing of every call made by a boto3 client. botocore hides its
+  connections, so only the total of each call is known.
+  Parameters:
+    client: boto3 client.
+  Returns:
+    The same client.
+  """
+  service = client.meta.service_model.service_name
+  host = requests.utils.urlparse(client.meta.endpoint_url).hostname
+
+  def before_send(**kwargs):
+    _local.boto_start = time.perf_counter()
+
+  def after_call(http_response=None, **kwargs):
+    start = getattr(_local, "boto_start", None)
+    if start is None:
+      return
+    _local.boto_start = None
+    elapsed = (time.perf_counter() - start) * 1000
+    record({
+      "host": host,
+      "status": getattr(http_response, "status_code", None),
+      "reused": None,
+      "dns_ms": None,
+      "connect_ms": None,
+      "tls_ms": None,
+      "ttfb_ms": None,
+      "total_ms": elapsed,
+    })
+
+  client.meta.events.register("before-send.{}".format(service), before_send)
+  client.meta.events.register("after-call.{}".format(service), after_call)
+  return client
+
+def warm(pooled, url, connections=1):
+  """
+  Open connections ahead of the first real request, e.g. during the Lambda init phase.
+  Any response, even an error status, leaves its connection in the pool.
+  Parameters:
+    pooled: <requests.Session> built by session().
+    url: <string> on the host to connect to.
+    connections: <int> with the connections to open in parallel.
+  Returns:
+    <int> with the connections opened.
+  """
+  def open_one():
+    try:
+      pooled.head(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+      return True
+    except requests.RequestException as error:
+      logger.warning("Cannot warm up %s: %r", url, error)
+      return False
+
+  if connections <= 1:
+    return int(open_one())
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(open_one())) for _ in range(connections)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(results)
@@ -0,0 +1,34 @@
+import logging, os
+import tracing
+import outbox
+
+# Load env
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# A default /tmp outbox would be this function's own, empty one
+if not os.environ.get('OUTBOX_DB'):
+  raise RuntimeError("OUTBOX_DB must point to the outbox shared with hacer-pedido")
+
+# Logger setup
+logger = logging.getLogger("__name__")
+logger.setLevel(LOG_LEVEL)
+
+@tracing.handler("vaciar-outbox")
+def lambda_handler(event, context):
+  """
+  Lambda handler function
+  Retries the effects of the order outbox that hacer-pedido could not perform, and
+  sends the digest tickets once due. Meant to run on a rate schedule, with OUTBOX_DB
+  on storage shared with hacer-pedido (e.g. an EFS mount).
+  Parameters:
+    event: <Dict> with the Lambda function event data.
+    context: Lambda runtime context.
+  Returns:
+    <Dict> with the number of effects attempted and the effects per status.
+  """
+  with tracing.span("drain"):
+    attempted = outbox.default_flusher().drain()
+  return {
+    "statusCode": 200,
+    "attempted": attempted,
+    "effects": outbox.default_outbox().counts()
+  }
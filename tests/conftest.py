@@ -0,0 +1,58 @@
+import importlib.util, os, sys, tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS = os.path.join(ROOT, "lambdas")
+WORKDIR = tempfile.mkdtemp(prefix="ajoloeats-tests-")
+
+# The lambdas read their settings at import time
+for key, value in {
+  "POSTMARK_API_TOKEN": "POSTMARK_API_TEST",
+  "AWS_DEFAULT_REGION": "us-west-2",
+  "EMAIL_FROM": "bot@example.com",
+  "RESTAURANT_EMAIL": "restaurant@example.com",
+  "DELIVERY_EMAIL": "delivery@example.com",
+  "OFFERS_SECRET": "test-offers-secret",
+  "FEEDBACK_SECRET": "test-feedback-secret",
+  "LOG_LEVEL": "ERROR",
+  "METRICS_SAMPLE_RATE": "0",
+  "OUTBOX_DB": os.path.join(WORKDIR, "outbox.db"),
+  "OFFERS_DB": os.path.join(WORKDIR, "offers.db"),
+  "FEEDBACK_DB": os.path.join(WORKDIR, "feedback.db"),
+  "ORDER_STATE_DB": os.path.join(WORKDIR, "orders.db"),
+  "WHEEL_PATH": os.path.join(WORKDIR, "wheel.log"),
+}.items():
+  os.environ.setdefault(key, value)
+sys.path[:0] = [LAMBDAS, os.path.join(ROOT, "bench")]
+
+from fakes import FakePostmark
+
+def load(filename):
+  """
+  Import a lambda handler file, whose hyphenated name is not importable as is.
+  """
+  spec = importlib.util.spec_from_file_location(filename.replace("-", "_")[:-3], os.path.join(LAMBDAS, filename))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+class RecordingPostmark(FakePostmark):
+  """
+  FakePostmark keeping the subject of every email sent.
+  """
+  def __init__(self):
+    super().__init__()
+    self.subjects = []
+    send_batch = self.emails.send_batch
+    def record(*messages):
+      self.subjects.extend(message["Subject"] for message in messages)
+      return send_batch(*messages)
+    self.emails.send_batch = record
+
+@pytest.fixture
+def postmark():
+  import clients
+  from email_dispatch import EmailDispatcher
+  fake = RecordingPostmark()
+  clients.override(postmark=fake, dispatcher=EmailDispatcher(fake))
+  return fake
@@ -0,0 +1,94 @@
+import html, json, re
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import pytest
+from conftest import load
+
+import feedback, offers, order_state
+
+@pytest.fixture(scope="module")
+def courier():
+  return load("asignar-repartidor.py")
+
+@pytest.fixture
+def order(tmp_path, monkeypatch):
+  store = order_state.OrderStateStore(str(tmp_path / "orders.db"), estimator=SimpleNamespace(observe=lambda *args: None))
+  monkeypatch.setattr(order_state, "default_store", lambda: store)
+  now = datetime.now(tz=timezone.utc)
+  estimate = SimpleNamespace(confirmation=now + timedelta(minutes=5), pickup=now + timedelta(minutes=20), arrival=now + timedelta(minutes=40), feedback=now + timedelta(minutes=60))
+  store.create("order-1", "restaurant-1", "zone-1", now, estimate, "courier-1")
+  return store
+
+def link(action, order_id="order-1", courier_id="courier-1"):
+  return {"order": order_id, "courier": courier_id, "action": action, "token": offers.token(order_id, courier_id, action)}
+
+def test_opening_a_link_changes_nothing(courier, order):
+  response = courier.lambda_handler({"httpMethod": "GET", "queryStringParameters": link("pickup")}, None)
+  assert response["statusCode"] == 200
+  assert response["headers"]["Content-Type"].startswith("text/html")
+  assert '<form method="post">' in response["body"]
+  assert order.get("order-1").at[order_state.PICKED_UP] == 0
+
+def test_posting_the_form_confirms(courier, order):
+  event = {"httpMethod": "POST", "queryStringParameters": link("pickup"), "body": urlencode(link("pickup"))}
+  response = courier.lambda_handler(event, None)
+  assert response["statusCode"] == 200
+  assert json.loads(response["body"])["message"] == "Recolección registrada."
+  assert order.get("order-1").at[order_state.PICKED_UP] > 0
+  assert order.get("order-1").progress == order_state.PICKED_UP
+
+def test_delivery_minutes_come_from_the_confirmation(courier, order, tmp_path, monkeypatch):
+  ratings = feedback.FeedbackStore(str(tmp_path / "feedback.db"))
+  monkeypatch.setattr(feedback, "default_store", lambda: ratings)
+  received = datetime.now(tz=timezone.utc) - timedelta(minutes=30)
+  estimate = SimpleNamespace(confirmation=received, pickup=received, arrival=received + timedelta(minutes=10), feedback=received + timedelta(minutes=20))
+  order.create("order-2", "restaurant-1", "zone-1", received, estimate, "courier-1")
+  response = courier.lambda_handler({"httpMethod": "POST", "body": urlencode(link("deliver", "order-2"))}, None)
+  assert response["statusCode"] == 200
+  # Half an hour as confirmed, not the 10 minutes estimated
+  summary = ratings.summary("courier", "courier-1")
+  assert summary["deliveries"] == 1
+  assert 29 <= summary["delivery_minutes"]["p50"] <= 31
+  assert ratings.summary("restaurant", "restaurant-1")["deliveries"] == 1
+
+def test_forged_link_is_rejected(courier, order):
+  query = dict(link("pickup"), courier="courier-2")
+  response = courier.lambda_handler({"httpMethod": "POST", "body": urlencode(query)}, None)
+  assert response["statusCode"] == 403
+  assert order.get("order-1").at[order_state.PICKED_UP] == 0
+
+def test_link_is_signed_for_its_action(courier, order):
+  query = dict(link("pickup"), action="deliver")
+  response = courier.lambda_handler({"httpMethod": "POST", "body": urlencode(query)}, None)
+  assert response["statusCode"] == 403
+  assert order.get("order-1").at[order_state.DELIVERED] == 0
+
+def test_only_the_assigned_courier_confirms(courier, order):
+  response = courier.lambda_handler({"httpMethod": "POST", "body": urlencode(link("pickup", courier_id="courier-2"))}, None)
+  assert response["statusCode"] == 403
+  assert order.get("order-1").at[order_state.PICKED_UP] == 0
+  # A courier that accepts an offer becomes the assigned one
+  assert order.assign("order-1", "courier-1")
+  assert not order.assign("order-1", "courier-2")
+  assert order.courier("order-1") == "courier-1"
+
+def test_courier_email_has_the_confirmation_links(monkeypatch):
+  intake = load("hacer-pedido.py")
+  monkeypatch.setattr(offers, "RESPOND_URL", "https://ajoloeats.test/repartidor")
+  _, _, body = intake.delivery_email("courier@example.com", "Col. Roma Norte", "01:00 PM", "2.0Km", "Luis", "El Ajolote Frito", "Av. Juárez 1", "order-1", "courier-1")
+  links = [dict(parse_qsl(urlsplit(html.unescape(href)).query)) for href in re.findall(r'href="(https://ajoloeats\.test/repartidor\?[^"]+)"', body)]
+  assert [query["action"] for query in links] == ["pickup", "deliver"]
+  assert all(offers.verify("order-1", "courier-1", query["action"], query["token"]) for query in links)
+
+def test_links_are_not_signed_without_a_secret(monkeypatch):
+  monkeypatch.setattr(offers, "SECRET", b"")
+  with pytest.raises(RuntimeError):
+    offers.token("order-1", "courier-1", "pickup")
+  with pytest.raises(RuntimeError):
+    offers.verify("order-1", "courier-1", "pickup", "")
+
+def test_offers_need_a_shared_store(monkeypatch):
+  monkeypatch.setattr(offers, "DB_PATH", None)
+  with pytest.raises(RuntimeError):
+    offers.default_engine.__wrapped__()
@@ -0,0 +1,27 @@
+import pytest
+
+from email_dispatch import EmailDispatcher, EmailError
+from fakes import FakePostmark
+
+def test_messages_without_a_response_fail():
+  postmark = FakePostmark()
+  send_batch = postmark.emails.send_batch
+  postmark.emails.send_batch = lambda *messages: send_batch(*messages)[:1]
+  dispatcher = EmailDispatcher(postmark)
+  first = dispatcher.enqueue("a@example.com", "Uno", "", "bot@example.com")
+  second = dispatcher.enqueue("b@example.com", "Dos", "", "bot@example.com")
+  results = dispatcher.flush()
+  assert first.result(timeout=1)["To"] == "a@example.com"
+  with pytest.raises(EmailError):
+    second.result(timeout=1)
+  assert [message["To"] for message, _ in results] == ["a@example.com", "b@example.com"]
+
+def test_rejected_message_fails_alone():
+  postmark = FakePostmark()
+  send_batch = postmark.emails.send_batch
+  postmark.emails.send_batch = lambda *messages: [dict(response, ErrorCode=300, Message="Invalid email") if message["To"] == "mal" else response for message, response in zip(messages, send_batch(*messages))]
+  dispatcher = EmailDispatcher(postmark)
+  good, bad = (dispatcher.enqueue(to, "Pedido", "", "bot@example.com") for to in ("a@example.com", "mal"))
+  dispatcher.flush()
+  assert good.exception(timeout=1) is None
+  assert bad.exception(timeout=1).error_code == 300
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+
+import eta, stages
+
+NOW = datetime(2026, 5, 1, 13, 0, tzinfo=timezone.utc)
+
+def items(*minutes):
+  return SimpleNamespace(prep_minutes=list(minutes))
+
+@pytest.fixture
+def estimator():
+  return eta.Estimator()
+
+def test_stages_follow_the_prep_and_travel_estimates(estimator):
+  estimate = estimator.estimate(NOW, items(10, 4), "Col. Roma Norte, CDMX", "restaurant-1")
+  assert estimate.prep_minutes == pytest.approx(10 + eta.PARALLEL_PREP * 4)
+  assert estimate.zone == "roma"
+  assert estimate.distance_km == pytest.approx(estimator.matrix.distance(eta.RESTAURANT_ZONE, "roma"))
+  assert estimate.travel_minutes == pytest.approx(eta.HANDOFF_MINUTES + estimate.distance_km / eta.SPEED_KMH * 60)
+  assert estimate.pickup == NOW + timedelta(minutes=estimate.prep_minutes)
+  assert estimate.confirmation == estimate.pickup - timedelta(minutes=eta.CHECK_IN_LEAD_MINUTES)
+  assert estimate.arrival == estimate.pickup + timedelta(minutes=estimate.travel_minutes)
+  assert estimate.feedback == estimate.arrival + timedelta(minutes=eta.FEEDBACK_DELAY_MINUTES)
+
+def test_check_in_is_never_before_now(estimator):
+  estimate = estimator.estimate(NOW, items(1), "Polanco", "restaurant-1")
+  assert estimate.confirmation == NOW + timedelta(minutes=1)
+
+def test_unknown_address_travels_the_default_distance(estimator):
+  zone, km, _ = estimator.travel("Calle sin zona 12")
+  assert zone is None
+  assert km == eta.DEFAULT_DISTANCE_KM
+
+def test_kitchen_load_is_clamped(estimator):
+  for _ in range(eta.KITCHEN_CAPACITY * 10):
+    minutes = estimator.prep_minutes(items(10), "restaurant-1", NOW.timestamp())
+  assert minutes == pytest.approx(10 * eta.MAX_LOAD_FACTOR)
+
+def test_correction_waits_for_samples_and_is_clamped(tmp_path):
+  estimator = eta.Estimator(corrections=eta.CorrectionStore(str(tmp_path / "eta.db")), refresh=0)
+  for _ in range(eta.MIN_SAMPLES - 1):
+    estimator.observe("prep", "restaurant-1", 20, 2)
+  assert estimator.correction("prep", "restaurant-1") == 1.0
+  estimator.observe("prep", "restaurant-1", 20, 2)
+  # Far faster than estimated, still never under half the estimate
+  assert estimator.correction("prep", "restaurant-1") == 0.5
+
+def test_corrections_are_shared_between_instances(tmp_path):
+  path = str(tmp_path / "eta.db")
+  # The confirmations reach asignar-repartidor, the estimates are made by hacer-pedido
+  confirming, estimating = eta.Estimator(corrections=eta.CorrectionStore(path)), eta.Estimator(corrections=eta.CorrectionStore(path), refresh=0)
+  for _ in range(eta.MIN_SAMPLES):
+    confirming.observe("travel", "roma", 10, 15)
+  assert estimating.correction("travel", "roma") >= 1.5
+  assert estimating.correction("travel", None) == 1.0
+
+def test_estimates_are_uncorrected_without_a_store(estimator):
+  for _ in range(eta.MIN_SAMPLES):
+    estimator.observe("prep", "restaurant-1", 10, 30)
+  assert estimator.correction("prep", "restaurant-1") == 1.0
+
+def test_check_in_email_tells_the_lead_time():
+  event = {"order_id": "order-1", "restaurant_name": "El Ajolote Frito", "expected_pickup": "01:00 PM", "restaurant_email": "r@example.com", "from_email": "bot@example.com"}
+  _, _, body, _ = stages.check_in(event)
+  assert "en {:g} minutos".format(eta.CHECK_IN_LEAD_MINUTES) in body
@@ -0,0 +1,30 @@
+import json
+import pytest
+from conftest import load
+
+import feedback
+
+@pytest.fixture(scope="module")
+def opinion():
+  return load("recibir-opinion.py")
+
+def test_links_are_not_signed_without_a_secret(monkeypatch):
+  monkeypatch.setattr(feedback, "SECRET", b"")
+  with pytest.raises(RuntimeError):
+    feedback.token("order-1", "restaurant-1", "courier-1")
+
+def test_ratings_need_a_shared_store(monkeypatch):
+  monkeypatch.setattr(feedback, "DB_PATH", None)
+  with pytest.raises(RuntimeError):
+    feedback.default_store.__wrapped__()
+
+def test_rating_is_answered_with_a_json_body(opinion, tmp_path, monkeypatch):
+  store = feedback.FeedbackStore(str(tmp_path / "feedback.db"))
+  monkeypatch.setattr(feedback, "default_store", lambda: store)
+  rating = {"pedido": "order-1", "calificacion": 5, "restaurante": "restaurant-1", "token": feedback.token("order-1", "restaurant-1", None)}
+  response = opinion.lambda_handler({"body": json.dumps(rating)}, None)
+  assert response["statusCode"] == 200
+  assert response["headers"]["Content-Type"] == "application/json"
+  assert json.loads(response["body"])["message"] == "¡Gracias por tu opinión!"
+  response = opinion.lambda_handler({"queryStringParameters": {"restaurante": "restaurant-1"}}, None)
+  assert json.loads(response["body"])["summary"]["ratings"] == 1
@@ -0,0 +1,23 @@
+import time
+
+import idempotency
+
+def test_claim_expires_after_the_lease(tmp_path, monkeypatch):
+  store = idempotency.IdempotencyStore(persistent=idempotency.SQLiteStore(str(tmp_path / "idempotency.db")), ttl=3600, lease=30)
+  assert store.claim("order")
+  assert store.get("order") == idempotency.IN_PROGRESS
+  assert not store.claim("order")
+  # A request killed mid-flight frees its key once the lease runs out
+  now = time.time()
+  monkeypatch.setattr(idempotency.time, "time", lambda: now + 31)
+  assert store.get("order") is None
+  assert store.claim("order")
+
+def test_result_is_kept_for_the_ttl(monkeypatch):
+  store = idempotency.IdempotencyStore(ttl=3600, lease=30)
+  assert store.claim("order")
+  store.put("order", {"statusCode": 200})
+  now = time.time()
+  monkeypatch.setattr(idempotency.time, "time", lambda: now + 600)
+  assert store.get("order") == {"statusCode": 200}
+  assert not store.claim("order")
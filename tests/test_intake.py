@@ -0,0 +1,85 @@
+import json, time
+from types import SimpleNamespace
+import pytest
+from conftest import load
+
+import clients, idempotency, timeline
+
+ORDER = {
+  "nombre": "Itzel",
+  "apellido": "López",
+  "correo": "itzel-intake@example.com",
+  "pedido": "Pizza Margarita, Brownie",
+  "total": "180.00",
+  "direccion": "Col. Roma Norte, CDMX",
+}
+CONTEXT = SimpleNamespace(aws_request_id="test", invoked_function_arn="arn:local")
+
+@pytest.fixture(scope="module")
+def intake():
+  return load("hacer-pedido.py")
+
+@pytest.fixture
+def store(monkeypatch):
+  store = idempotency.IdempotencyStore()
+  monkeypatch.setattr(idempotency, "default_store", lambda: store)
+  return store
+
+def test_invalid_order_is_a_400_response(intake, store):
+  response = intake.lambda_handler({"body": json.dumps(dict(ORDER, correo="no"))}, CONTEXT)
+  assert response["statusCode"] == 400
+  assert response["headers"]["Content-Type"] == "application/json"
+  assert json.loads(response["body"])["errors"] == {"correo": "must be an email address"}
+
+def test_repeated_order_returns_the_original_response(intake, store, postmark):
+  clients.override(scheduler=timeline.FakeScheduler())
+  event = {"body": json.dumps(ORDER), "headers": {"idempotency-key": "repeated"}}
+  first = intake.lambda_handler(event, CONTEXT)
+  assert first["statusCode"] == 200
+  sent = len(postmark.subjects)
+  second = intake.lambda_handler(event, CONTEXT)
+  assert second == first
+  assert len(postmark.subjects) == sent
+
+def test_order_in_progress_is_a_409_response(intake, store):
+  event = {"body": json.dumps(ORDER), "headers": {"idempotency-key": "in-progress"}}
+  assert store.claim(idempotency.request_key(ORDER, "in-progress"))
+  response = intake.lambda_handler(event, CONTEXT)
+  assert response["statusCode"] == 409
+
+def test_batch_with_an_invalid_order_is_a_207_response(intake, store, postmark):
+  clients.override(scheduler=timeline.FakeScheduler())
+  orders = [dict(ORDER, correo="batch-{}@example.com".format(n)) for n in range(2)] + [dict(ORDER, total="gratis")]
+  response = intake.lambda_handler({"body": json.dumps(orders)}, CONTEXT)
+  assert response["statusCode"] == 207
+  results = json.loads(response["body"])["orders"]
+  assert [result["statusCode"] for result in results] == [200, 200, 400]
+
+def test_malformed_batch_is_a_400_response(intake, store):
+  response = intake.lambda_handler({"body": "[{\"nombre\": "}, CONTEXT)
+  assert response["statusCode"] == 400
+  assert json.loads(response["body"])["message"] == "Invalid batch."
+
+@pytest.mark.parametrize("mode", ["concurrent", "sequential"])
+def test_failing_task_does_not_stop_the_others(intake, mode):
+  ran = []
+  def fail():
+    raise RuntimeError("Scheduler unavailable")
+  def slow():
+    time.sleep(0.05)
+    ran.append("slow")
+  tasks = {"first": lambda: ran.append("first"), "fail": fail, "slow": slow}
+  assert intake.run_tasks(tasks, mode) == {"fail": "Scheduler unavailable"}
+  assert sorted(ran) == ["first", "slow"]
+
+def test_task_failures_reach_the_response(intake, store, postmark):
+  class FailingScheduler(timeline.FakeScheduler):
+    def create_schedule(self, **kwargs):
+      raise RuntimeError("Scheduler unavailable")
+  clients.override(scheduler=FailingScheduler())
+  response = intake.lambda_handler({"body": json.dumps(dict(ORDER, correo="failing@example.com"))}, CONTEXT)
+  assert response["statusCode"] == 502
+  failures = json.loads(response["body"])["failures"]
+  assert failures and set(failures.values()) == {"Scheduler unavailable"}
+  # The emails went out all the same
+  assert len(postmark.subjects) >= 2
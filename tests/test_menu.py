@@ -0,0 +1,26 @@
+import pytest
+
+import menu, order_schema
+
+@pytest.fixture(scope="module")
+def index():
+  return menu.MenuIndex(menu.MENU)
+
+def test_quantities(index):
+  lines = index.parse("2x Pizza Margarita, Brownie x3, coca").lines
+  assert [(line.quantity, line.item.name) for line in lines] == [(2, "Pizza Margarita"), (3, "Brownie"), (1, "Coca-Cola regular")]
+
+@pytest.mark.parametrize("order", ["0 brownie", "0x Brownie", "Brownie x0"])
+def test_zero_quantity_is_rejected(index, order):
+  with pytest.raises(order_schema.ValidationError) as raised:
+    index.parse(order)
+  assert "pedido" in raised.value.errors
+
+@pytest.mark.parametrize("order", ["1000x brownie", "Pizza Margarita, {} brownies".format(menu.MAX_QUANTITY + 1), "Brownie x1000"])
+def test_quantity_above_the_maximum_is_rejected(index, order):
+  with pytest.raises(order_schema.ValidationError) as raised:
+    index.parse(order)
+  assert "pedido" in raised.value.errors
+
+def test_maximum_quantity_is_accepted(index):
+  assert index.parse("{}x Brownie".format(menu.MAX_QUANTITY)).lines[0].quantity == menu.MAX_QUANTITY
@@ -0,0 +1,59 @@
+import threading
+
+import order_ids
+
+def frozen(monkeypatch, milliseconds):
+  monkeypatch.setattr(order_ids.time, "time_ns", lambda: milliseconds * 1000000)
+
+def test_ids_within_a_millisecond_are_unique_and_sorted(monkeypatch):
+  frozen(monkeypatch, 1767225600000)
+  generator = order_ids.OrderIdGenerator(node=7)
+  ids = [generator.new_id() for _ in range(5000)]
+  assert len(set(ids)) == len(ids)
+  assert ids == sorted(ids)
+  assert {order_ids.timestamp(id) for id in ids} == {1767225600000}
+
+def test_ids_sort_by_time(monkeypatch):
+  generator = order_ids.OrderIdGenerator(node=7)
+  ids = []
+  for milliseconds in (1767225600000, 1767225600001, 1767225661000):
+    frozen(monkeypatch, milliseconds)
+    ids.extend(generator.new_id() for _ in range(3))
+  assert ids == sorted(ids)
+  assert [order_ids.timestamp(id) for id in ids[::3]] == [1767225600000, 1767225600001, 1767225661000]
+
+def test_ids_stay_monotonic_when_the_clock_goes_back(monkeypatch):
+  generator = order_ids.OrderIdGenerator(node=7)
+  frozen(monkeypatch, 1767225600005)
+  first = generator.new_id()
+  frozen(monkeypatch, 1767225600000)
+  assert generator.new_id() > first
+
+def test_exhausted_counter_borrows_the_next_millisecond(monkeypatch):
+  frozen(monkeypatch, 1767225600000)
+  generator = order_ids.OrderIdGenerator(node=7)
+  first = generator.new_id()
+  generator._counter = order_ids.COUNTER_MAX
+  last = generator.new_id()
+  assert order_ids.timestamp(last) == 1767225600001
+  assert last > first
+
+def test_ids_have_a_fixed_length_and_alphabet():
+  generators = [order_ids.OrderIdGenerator(node) for node in (0, 1, (1 << order_ids.NODE_BITS) - 1, None)]
+  ids = [generator.new_id() for generator in generators for _ in range(100)] + [order_ids.new_id()]
+  assert {len(id) for id in ids} == {20}
+  assert set("".join(ids)) <= set(order_ids.ALPHABET)
+  # The node tells apart the ids of concurrent containers
+  assert len({id[order_ids.TIME_CHARS:order_ids.TIME_CHARS + 6] for id in ids[:400]}) == 4
+
+def test_ids_are_unique_across_threads():
+  generator = order_ids.OrderIdGenerator()
+  ids = []
+  def create():
+    ids.extend(generator.new_id() for _ in range(2000))
+  threads = [threading.Thread(target=create) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(set(ids)) == 8000
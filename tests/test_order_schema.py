@@ -0,0 +1,111 @@
+import base64, json
+from decimal import Decimal
+import pytest
+
+import order_schema
+
+ORDER = {
+  "nombre": "Itzel",
+  "apellido": "López",
+  "correo": "itzel@example.com",
+  "pedido": "Pizza Margarita,\nBrownie",
+  "total": "180.5",
+  "direccion": "Col. Roma Norte, CDMX",
+}
+
+def test_order_is_normalized():
+  order = order_schema.parse(json.dumps(dict(ORDER, nombre="  Itzel ", latitud=19.4, extra="ignorado")))
+  assert order["nombre"] == "Itzel"
+  assert order["total"] == Decimal("180.50")
+  assert order["latitud"] == 19.4
+  assert "extra" not in order
+
+def test_base64_body_is_decoded():
+  raw = base64.b64encode(json.dumps(ORDER).encode()).decode()
+  assert order_schema.parse(raw, base64_encoded=True)["correo"] == "itzel@example.com"
+
+@pytest.mark.parametrize("payload, field", [
+  (dict(ORDER, correo="itzel"), "correo"),
+  (dict(ORDER, total="-1"), "total"),
+  (dict(ORDER, total=True), "total"),
+  (dict(ORDER, total="NaN"), "total"),
+  (dict(ORDER, nombre="Itzel\x00"), "nombre"),
+  (dict(ORDER, nombre="   "), "nombre"),
+  (dict(ORDER, nombre="x" * 101), "nombre"),
+  (dict(ORDER, latitud=91), "latitud"),
+  ({key: value for key, value in ORDER.items() if key != "direccion"}, "direccion"),
+])
+def test_invalid_fields_are_rejected(payload, field):
+  with pytest.raises(order_schema.ValidationError) as error:
+    order_schema.parse(json.dumps(payload))
+  assert error.value.status == 400
+  assert field in error.value.errors
+
+@pytest.mark.parametrize("raw, status", [
+  (None, 400),
+  ("{", 400),
+  ("[]", 400),
+  ("x" * (order_schema.MAX_BODY_BYTES + 1), 413),
+])
+def test_malformed_bodies_are_rejected(raw, status):
+  with pytest.raises(order_schema.ValidationError) as error:
+    order_schema.parse(raw)
+  assert error.value.status == status
+
+def test_size_limit_counts_bytes_not_characters():
+  raw = json.dumps(dict(ORDER, pedido="ñ" * 1000), ensure_ascii=False)
+  with pytest.raises(order_schema.ValidationError) as error:
+    order_schema.parse(raw, max_bytes=len(raw) + 10)
+  assert error.value.status == 413
+
+def test_oversized_base64_body_is_rejected_before_decoding():
+  raw = base64.b64encode(b"x" * 200).decode()
+  with pytest.raises(order_schema.ValidationError) as error:
+    order_schema.parse(raw, base64_encoded=True, max_bytes=100)
+  assert error.value.status == 413
+
+def stream(raw, **kwargs):
+  return [(order and order["correo"], error and error.status) for order, error in order_schema.parse_stream(raw, **kwargs)]
+
+@pytest.mark.parametrize("raw, content_type, expected", [
+  ("[{}]", None, True),
+  ("  \n[", None, True),
+  (b"[", None, True),
+  ("{}", None, False),
+  ('{"pedido": "[x]"}', None, False),
+  ("", None, False),
+  (None, None, False),
+  ('{}\n{}', "application/x-ndjson", True),
+])
+def test_batch_is_told_apart(raw, content_type, expected):
+  assert order_schema.is_batch(raw, content_type=content_type) is expected
+
+def test_base64_batch_is_told_apart():
+  assert order_schema.is_batch(base64.b64encode(b"[" + b" " * 100).decode(), base64_encoded=True)
+  assert not order_schema.is_batch(base64.b64encode(json.dumps(ORDER).encode()).decode(), base64_encoded=True)
+  assert not order_schema.is_batch("no es base64!", base64_encoded=True)
+
+def test_array_orders_fail_alone():
+  raw = json.dumps([ORDER, dict(ORDER, correo="no"), 3, dict(ORDER, correo="b@example.com")])
+  assert stream(raw) == [("itzel@example.com", None), (None, 400), (None, 400), ("b@example.com", None)]
+
+def test_ndjson_skips_blank_lines_and_rejects_invalid_ones():
+  raw = "\n".join([json.dumps(ORDER), "", "   ", "{no es json", json.dumps(dict(ORDER, correo="b@example.com")), ""])
+  assert stream(raw, ndjson=True) == [("itzel@example.com", None), (None, 400), ("b@example.com", None)]
+
+@pytest.mark.parametrize("raw", ["{}", "[{}", "[{} {}]", "[{}],", "[{},]"])
+def test_malformed_array_rejects_the_batch(raw):
+  with pytest.raises(order_schema.ValidationError):
+    stream(raw)
+
+def test_batch_limits():
+  line = json.dumps(ORDER)
+  with pytest.raises(order_schema.ValidationError) as error:
+    stream("\n".join([line] * 3), ndjson=True, max_orders=2)
+  assert error.value.status == 413
+  with pytest.raises(order_schema.ValidationError) as error:
+    stream("\n".join([line] * 3), ndjson=True, max_bytes=len(line) * 2)
+  assert error.value.status == 413
+  # An order over its own limit only rejects itself
+  big = json.dumps(dict(ORDER, pedido="x" * 200))
+  assert stream("\n".join([line, big]), ndjson=True, max_order_bytes=len(line)) == [("itzel@example.com", None), (None, 413)]
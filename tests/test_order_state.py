@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from conftest import load
+
+import order_state, stages
+
+class Estimator:
+  def __init__(self):
+    self.observed = []
+
+  def observe(self, kind, key, expected, actual):
+    self.observed.append((kind, key))
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+  store = order_state.OrderStateStore(str(tmp_path / "orders.db"), estimator=Estimator())
+  monkeypatch.setattr(order_state, "default_store", lambda: store)
+  now = datetime.now(tz=timezone.utc)
+  estimate = SimpleNamespace(confirmation=now + timedelta(minutes=5), pickup=now + timedelta(minutes=20), arrival=now + timedelta(minutes=40), feedback=now + timedelta(minutes=60))
+  store.create("order-1", "restaurant-1", "zone-1", now, estimate)
+  return store
+
+def event(event_type):
+  return {"event_type": event_type, "order_id": "order-1", "from_email": "bot@example.com", "client_email": "c@example.com", "client_name": "Itzel", "expected_delivery": "01:10 PM"}
+
+def test_late_confirmations_are_recorded(store):
+  # The scheduled notifications went out at the estimates before the courier confirmed
+  assert store.claim("order-1", order_state.PICKED_UP)
+  assert store.claim("order-1", order_state.DELIVERED)
+  assert store.confirm("order-1", order_state.PICKED_UP)
+  assert store.confirm("order-1", order_state.DELIVERED)
+  assert store.estimator.observed == [("prep", "restaurant-1"), ("travel", "zone-1")]
+  assert store.confirm("order-1", order_state.DELIVERED) is False
+  assert store.confirm("order-2", order_state.DELIVERED) is None
+
+def test_early_pickup_still_tells_the_customer(store, postmark):
+  store.confirm("order-1", order_state.PICKED_UP)
+  stages.notify("order_sent", event("order_sent"))
+  assert any("va en camino" in subject for subject in postmark.subjects)
+
+def test_only_stages_passed_are_suppressed(store, postmark):
+  store.confirm("order-1", order_state.DELIVERED)
+  assert stages.notify_batch([event("order_sent"), event("order_delivered")]) == [None, None]
+  assert not any("va en camino" in subject for subject in postmark.subjects)
+  assert sum("ha sido entregado" in subject for subject in postmark.subjects) == 1
+
+def test_notification_is_claimed_once(store, postmark):
+  stages.notify("order_sent", event("order_sent"))
+  stages.notify("order_sent", event("order_sent"))
+  assert sum("va en camino" in subject for subject in postmark.subjects) == 1
+
+def test_failed_notification_is_released(store, postmark, monkeypatch):
+  def fail(event):
+    raise RuntimeError("render failed")
+  monkeypatch.setitem(stages.RENDERERS, "order_sent", fail)
+  with pytest.raises(RuntimeError):
+    stages.notify("order_sent", event("order_sent"))
+  assert store.get("order-1").notified == 0
+  monkeypatch.undo()
+  stages.notify("order_sent", event("order_sent"))
+  assert sum("va en camino" in subject for subject in postmark.subjects) == 1
+
+def test_malformed_events_fail_alone_in_a_batch(store, postmark):
+  untyped = {key: value for key, value in event("order_sent").items() if key != "event_type"}
+  broken = dict(event("order_delivered"))
+  del broken["client_email"]
+  results = stages.notify_batch([untyped, event("order_sent"), dict(event("feedback"), event_type="unknown"), broken])
+  assert results[1] is None
+  assert "event_type" in results[0] and "event_type" in results[2]
+  assert "client_email" in results[3]
+  assert sum("va en camino" in subject for subject in postmark.subjects) == 1
+  # The stage that failed to render was released, the one sent stays claimed
+  assert store.get("order-1").notified == 1 << order_state.PICKED_UP
+
+@pytest.mark.parametrize("limit, status", [("-1", 400), ("0", 400), ("abc", 400), ("1001", 400), ("1", 200)])
+def test_late_orders_limit_is_bounded(store, limit, status):
+  late = load("pedidos-atrasados.py")
+  response = late.lambda_handler({"queryStringParameters": {"limite": limit}}, None)
+  assert response["statusCode"] == status
@@ -0,0 +1,75 @@
+import json, threading, time
+from types import SimpleNamespace
+import pytest
+from conftest import load
+
+import clients, outbox, timeline
+
+ORDER = {
+  "nombre": "Itzel",
+  "apellido": "López",
+  "correo": "itzel-outbox@example.com",
+  "pedido": "Pizza Margarita, Brownie",
+  "total": "180.00",
+  "direccion": "Col. Roma Norte, CDMX",
+}
+
+@pytest.fixture(scope="module")
+def intake():
+  return load("hacer-pedido.py")
+
+def test_outbox_effects_are_performed_before_returning(tmp_path, monkeypatch, postmark, intake):
+  store = outbox.Outbox(str(tmp_path / "outbox.db"))
+  scheduler = timeline.FakeScheduler()
+  clients.override(scheduler=scheduler)
+  monkeypatch.setattr(outbox, "default_outbox", lambda: store)
+  monkeypatch.setattr(outbox, "default_flusher", lambda: outbox.Flusher(store))
+  monkeypatch.setattr(intake, "SIDE_EFFECTS", "outbox")
+  context = SimpleNamespace(aws_request_id="test", invoked_function_arn="arn:local")
+  response = intake.lambda_handler({"body": json.dumps(ORDER)}, context)
+  assert response["statusCode"] == 202
+  assert json.loads(response["body"])["order_id"]
+  # Nothing is left to a thread that a frozen container would never run
+  assert store.counts() == {"done": len(scheduler.schedules) + len(postmark.subjects)}
+  assert len(postmark.subjects) >= 2
+
+def test_only_the_effects_of_the_order_are_performed(tmp_path, monkeypatch, postmark, intake):
+  store = outbox.Outbox(str(tmp_path / "outbox.db"))
+  store.record("other", {}, [("email", {"From": "bot@example.com", "To": "other@example.com", "Subject": "Otro pedido", "HtmlBody": ""})])
+  clients.override(scheduler=timeline.FakeScheduler())
+  monkeypatch.setattr(outbox, "default_outbox", lambda: store)
+  monkeypatch.setattr(outbox, "default_flusher", lambda: outbox.Flusher(store))
+  monkeypatch.setattr(intake, "SIDE_EFFECTS", "outbox")
+  context = SimpleNamespace(aws_request_id="test", invoked_function_arn="arn:local")
+  response = intake.lambda_handler({"body": json.dumps(dict(ORDER, correo="itzel-own@example.com"))}, context)
+  assert response["statusCode"] == 202
+  # The rest of the shared outbox is left to vaciar-outbox
+  assert store.counts()["pending"] == 1
+  assert "Otro pedido" not in postmark.subjects
+
+def test_flush_waits_at_most_the_budget(tmp_path):
+  store = outbox.Outbox(str(tmp_path / "outbox.db"))
+  release = threading.Event()
+  class SlowScheduler(timeline.FakeScheduler):
+    def create_schedule(self, **kwargs):
+      release.wait(5)
+      return super().create_schedule(**kwargs)
+  store.record("order-1", {}, [("schedule", {"Name": "order-1-check-in"})])
+  flusher = outbox.Flusher(store, scheduler=SlowScheduler())
+  started = time.monotonic()
+  assert flusher.perform(["order-1"], budget=0.1) == 1
+  assert time.monotonic() - started < 1
+  # Still leased, not failed, and recorded once it finishes
+  assert store.counts() == {"pending": 1}
+  assert store.claim(order_ids=["order-1"]) == []
+  release.set()
+  flusher.executor.shutdown(wait=True)
+  assert store.counts() == {"done": 1}
+
+def test_claim_rolls_back_on_error(tmp_path, monkeypatch):
+  store = outbox.Outbox(str(tmp_path / "outbox.db"))
+  store.record("order-1", {}, [("email", {"From": "bot@example.com", "To": "a@example.com", "Subject": "Pedido", "HtmlBody": ""})])
+  with pytest.raises(Exception):
+    store.claim(limit="no es un límite")
+  # The transaction was closed, the outbox is still usable
+  assert len(store.claim()) == 1
@@ -0,0 +1,56 @@
+import pytest
+from conftest import load
+
+import digest, stages
+
+BASE = {"from_email": "bot@example.com", "client_email": "c@example.com", "client_name": "Itzel", "restaurant_email": "r@example.com", "restaurant_name": "El Ajolote Frito", "expected_pickup": "01:00 PM", "expected_delivery": "01:30 PM"}
+SUBJECTS = {
+  "check_in": "Recordatorio Pedido",
+  "order_sent": "va en camino",
+  "order_delivered": "ha sido entregado",
+  "feedback": "Cómo te fue",
+}
+
+@pytest.fixture(scope="module")
+def router():
+  return load("enrutar-notificaciones.py")
+
+def event(event_type, order_id="1", **fields):
+  # Without a known order the stages are not claimed, every event is sent
+  return dict(BASE, event_type=event_type, order_id=order_id, **fields)
+
+@pytest.mark.parametrize("event_type", sorted(SUBJECTS))
+def test_each_event_type_goes_to_its_renderer(router, postmark, event_type):
+  result = router.lambda_handler(event(event_type), None)
+  assert result == {"statusCode": 200, "sent": 1, "failures": {}}
+  assert len(postmark.subjects) == 1
+  assert SUBJECTS[event_type] in postmark.subjects[0]
+
+def test_mixed_batch_is_sent_in_one_request(router, postmark):
+  result = router.lambda_handler({"events": [event(event_type) for event_type in SUBJECTS]}, None)
+  assert result["statusCode"] == 200
+  assert result["sent"] == len(SUBJECTS)
+  assert postmark.emails.calls == 1
+  for subject in SUBJECTS.values():
+    assert any(subject in sent for sent in postmark.subjects)
+
+def test_mixed_batch_reports_failures_per_event(router, postmark, monkeypatch):
+  send_batch = postmark.emails.send_batch
+  def bounce(*messages):
+    responses = send_batch(*messages)
+    return [dict(response, ErrorCode=406, Message="Inactive recipient") if message["To"] == "rebota@example.com" else response for message, response in zip(messages, responses)]
+  monkeypatch.setattr(postmark.emails, "send_batch", bounce)
+  events = [event("order_sent"), event("order_sent", client_email="rebota@example.com"), {"order_id": "2"}, event("feedback")]
+  result = router.lambda_handler({"events": events}, None)
+  assert result["statusCode"] == 502
+  assert result["sent"] == 2
+  assert sorted(result["failures"]) == [1, 2]
+  assert "Inactive recipient" in result["failures"][1]
+  assert "event_type" in result["failures"][2]
+
+def test_check_ins_of_a_restaurant_share_a_ticket(postmark, monkeypatch):
+  monkeypatch.setattr(digest, "MODE", "on")
+  events = [event("check_in", order_id=str(order)) for order in range(3)] + [event("check_in", restaurant_email="otro@example.com")]
+  assert stages.notify_batch(events) == [None] * 4
+  assert len(postmark.subjects) == 2
+  assert any("3 pedidos" in subject for subject in postmark.subjects)
@@ -0,0 +1,88 @@
+import json, random
+import pytest
+
+import routing
+
+ORIGIN = (19.4333, -99.1950)
+KM = 1 / routing.KM_PER_DEGREE
+
+def north(km, location=ORIGIN):
+  return location[0] + km * KM, location[1]
+
+def test_nearest_matches_a_full_scan():
+  generator = random.Random(7)
+  index = routing.GridIndex(cell_km=0.5)
+  for key in range(300):
+    index.insert(key, (ORIGIN[0] + generator.uniform(-0.1, 0.1), ORIGIN[1] + generator.uniform(-0.1, 0.1)))
+  for k in (1, 5, 20):
+    found = index.nearest(ORIGIN, k)
+    expected = sorted((index.distance(ORIGIN, location), key) for key, location in index.points.items())[:k]
+    assert [key for _, _, key in found] == [key for _, key in expected]
+
+def test_search_stops_at_the_first_rings():
+  index = routing.GridIndex(cell_km=1.0)
+  index.insert("close", north(0.1))
+  for key in range(100):
+    index.insert(key, north(8 + key * 0.01))
+  scored = []
+  def score(key, km):
+    scored.append(key)
+    return km
+  assert [key for _, _, key in index.nearest(ORIGIN, 1, score)] == ["close"]
+  # The far points are never looked at
+  assert scored == ["close"]
+
+def test_points_past_the_radius_are_left_out():
+  index = routing.GridIndex()
+  index.insert("far", north(20))
+  assert index.nearest(ORIGIN, 1, max_km=15) == []
+  index.insert("far", north(10))
+  assert [key for _, _, key in index.nearest(ORIGIN, 1, max_km=15)] == ["far"]
+  index.remove("far")
+  assert index.points == {} and index.cells == {}
+
+def test_load_penalty_prefers_an_idle_courier():
+  pool = routing.CourierPool([routing.Courier("busy", "A", None, north(0.5)), routing.Courier("idle", "B", None, north(1.5))])
+  pool.take("busy", until=100)
+  rank, km, courier = pool.nearest(ORIGIN, now=0)[0]
+  assert courier.id == "idle"
+  assert rank == pytest.approx(km)
+  # Once the order is released the closest courier wins again
+  assert pool.nearest(ORIGIN, now=100)[0][2].id == "busy"
+
+def test_full_couriers_are_skipped():
+  pool = routing.CourierPool([routing.Courier("one", "A", None, north(0.1), capacity=1), routing.Courier("inbox", "B", None, north(5), capacity=None)])
+  assert pool.assign(ORIGIN, until=100, now=0)[0].id == "one"
+  assert pool.assign(ORIGIN, until=100, now=0)[0].id == "inbox"
+  # Without a capacity the courier takes any number of orders
+  for _ in range(10):
+    assert pool.assign(ORIGIN, until=100, now=0)[0].id == "inbox"
+  pool.set_available("inbox", False)
+  assert pool.assign(ORIGIN, until=100, now=0) is None
+
+def test_excluded_couriers_are_not_offered():
+  pool = routing.CourierPool([routing.Courier(key, key, None, north(distance)) for key, distance in (("a", 0.1), ("b", 0.2), ("c", 0.3))])
+  assert [courier.id for _, _, courier in pool.nearest(ORIGIN, 2, now=0, exclude={"a"})] == ["b", "c"]
+
+def test_registry_finds_restaurants_and_places_couriers():
+  registry = routing.Registry({
+    "restaurants": [
+      {"id": "roma", "name": "Roma", "address": "Col. Roma Norte"},
+      {"id": "fija", "name": "Fija", "address": "Sin zona", "location": [19.40, -99.15]},
+    ],
+    "couriers": [{"id": "luis", "name": "Luis"}, {"id": "ana", "name": "Ana", "location": [19.41, -99.16], "capacity": 3}],
+  })
+  assert registry.restaurant().id == "roma"
+  assert registry.restaurant("roma").zone == "roma"
+  assert registry.restaurant("fija").location == (19.40, -99.15)
+  assert registry.restaurant("desconocido") is None
+  assert registry.couriers.couriers["luis"].location == registry.restaurant("roma").location
+  assert registry.couriers.couriers["ana"].capacity == 3
+
+def test_registry_is_loaded_from_its_path(tmp_path, monkeypatch):
+  path = tmp_path / "registry.json"
+  path.write_text(json.dumps({"restaurants": [{"id": "cafe", "name": "Café", "address": "Condesa"}], "couriers": []}))
+  monkeypatch.setattr(routing, "REGISTRY_PATH", str(path))
+  registry = routing.default_registry.__wrapped__()
+  assert registry.restaurant().name == "Café"
+  assert registry.restaurant("cafe").zone == "condesa"
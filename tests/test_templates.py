@@ -0,0 +1,42 @@
+import json
+from types import SimpleNamespace
+import pytest
+from conftest import load
+
+import digest, templates
+
+@pytest.fixture(scope="module")
+def intake():
+  return load("hacer-pedido.py")
+
+def test_client_fields_are_escaped(intake):
+  _, _, body = intake.customer_email("c@example.com", '<script>alert("x")</script>', "order-1", "180.00", "01:30 PM", "Roma & <b>Norte</b>", "El Ajolote Frito")
+  assert "<script>" not in body and "<b>" not in body
+  assert "&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt;" in body
+  assert "Roma &amp; &lt;b&gt;Norte&lt;/b&gt;" in body
+
+def test_partials_are_not_escaped_twice(intake):
+  items = SimpleNamespace(lines=[SimpleNamespace(quantity=2, name="Pizza <rara> & Brownie", item=None, subtotal=None)])
+  table = intake.items_table(items)
+  assert isinstance(table, templates.Markup)
+  _, _, body = intake.restaurant_email("r@example.com", "order-1", table, "180.00", "01:00 PM", "El Ajolote Frito")
+  assert "<table" in body
+  assert body.count("Pizza &lt;rara&gt; &amp; Brownie") == 1
+  assert "&amp;amp;" not in body
+
+def test_cached_partials_stay_markup():
+  header = templates.render_cached("restaurant_header", restaurant="Tacos & Más")
+  assert isinstance(header, templates.Markup)
+  assert "Tacos &amp; Más" in header
+
+def test_ticket_items_survive_the_outbox(intake):
+  items = SimpleNamespace(lines=[SimpleNamespace(quantity=1, name="Brownie", item=None, subtotal=None)])
+  # The table is stored as a plain string in the outbox payload
+  stored = json.loads(json.dumps({"order_id": "order-1", "expected_pickup": "01:00 PM", "items": intake.items_table(items)}))
+  _, body = digest.ticket("new_order", "El Ajolote <Frito>", [stored])
+  assert "<table" in body
+  assert "El Ajolote &lt;Frito&gt;" in body
+
+def test_link_urls_are_attribute_safe():
+  link = templates.render("feedback_link", url='https://ajoloeats.test/opinion?pedido=1&token="x"')
+  assert 'href="https://ajoloeats.test/opinion?pedido=1&amp;token=&quot;x&quot;"' in link
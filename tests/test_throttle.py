@@ -0,0 +1,27 @@
+import json
+
+import throttle, tracing
+
+class Throttled(Exception):
+  response = {"Error": {"Code": "ThrottlingException"}}
+
+def test_calls_and_throttles_are_emitted(monkeypatch, capsys):
+  monkeypatch.setattr(tracing, "SAMPLE_RATE", 1.0)
+  provider = throttle.Provider("scheduler", rate=1000, burst=1000, min_concurrency=1, max_concurrency=4, retries=2, backoff=0)
+  answers = iter([Throttled(), "ok"])
+  def call():
+    answer = next(answers)
+    if isinstance(answer, Exception):
+      raise answer
+    return answer
+
+  @tracing.handler("test")
+  def handler(event, context):
+    return provider.call(call)
+
+  assert handler({}, None) == "ok"
+  record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+  assert record["scheduler_calls"] == 2
+  assert record["scheduler_throttles"] == 1
+  assert record["scheduler_queue_depth"] == 1
+  assert "scheduler_errors" not in record
@@ -0,0 +1,57 @@
+import json, time
+from types import SimpleNamespace
+import pytest
+from conftest import load
+
+import clients, timing_wheel
+
+ORDER = {
+  "nombre": "Itzel",
+  "apellido": "López",
+  "correo": "itzel@example.com",
+  "pedido": "Pizza Margarita, Brownie",
+  "total": "180.00",
+  "direccion": "Col. Roma Norte, CDMX",
+}
+STAGE_SUBJECTS = ("Recordatorio Pedido", "va en camino", "ha sido entregado", "Cómo te fue")
+
+@pytest.fixture(scope="module")
+def intake():
+  return load("hacer-pedido.py")
+
+@pytest.mark.parametrize("schedule_mode, router", [("per_event", None), ("timeline", None), ("per_event", "orderNotify")])
+def test_order_on_the_wheel_fires_every_stage(tmp_path, monkeypatch, postmark, intake, schedule_mode, router):
+  path = str(tmp_path / "wheel.log")
+  clients.override(scheduler=timing_wheel.TimingWheelScheduler(path))
+  monkeypatch.setattr(intake, "SCHEDULE_MODE", schedule_mode)
+  monkeypatch.setattr(intake, "NOTIFICATION_ROUTER", router)
+  context = SimpleNamespace(aws_request_id="test", invoked_function_arn="arn:local")
+  response = intake.lambda_handler({"body": json.dumps(dict(ORDER, correo="{}-{}@example.com".format(schedule_mode, router)))}, context)
+  assert response["statusCode"] == 200
+  assert response["headers"]["Content-Type"] == "application/json"
+  # The tick runs in another process sharing the journal
+  ticker = timing_wheel.TimingWheelScheduler(path)
+  fired, failures = timing_wheel.tick(ticker, now=int(time.time()) + 4 * 3600, context=context)
+  assert failures == {}
+  assert fired >= 1
+  for subject in STAGE_SUBJECTS:
+    assert sum(subject in sent for sent in postmark.subjects) == 1, subject
+  assert ticker.schedules == {}
+  # Nothing fires twice
+  assert timing_wheel.tick(ticker, now=int(time.time()) + 5 * 3600) == (0, {})
+
+def test_journal_is_shared_between_processes(tmp_path):
+  path = str(tmp_path / "wheel.log")
+  writer, reader = timing_wheel.TimingWheelScheduler(path), timing_wheel.TimingWheelScheduler(path)
+  arguments = {
+    "Name": "a",
+    "ActionAfterCompletion": "DELETE",
+    "ScheduleExpression": "at(2030-01-01T00:00:00)",
+    "Target": {"Arn": "arn:aws:lambda:us-west-2:1:function:orderCheckIn", "Input": "{}"},
+  }
+  writer.create_schedule(**arguments)
+  assert reader.get_schedule(Name="a")["Name"] == "a"
+  reader.delete_schedule(Name="a")
+  with pytest.raises(timing_wheel.SchedulerError):
+    writer.get_schedule(Name="a")
+  writer.create_schedule(**arguments)
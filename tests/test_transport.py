@@ -0,0 +1,42 @@
+import json, socket, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+
+import tracing, transport
+
+class Ok(BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def server():
+  httpd = HTTPServer(("127.0.0.1", 0), Ok)
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  yield httpd.server_address[1]
+  httpd.shutdown()
+
+def test_falls_back_to_the_next_address(server, monkeypatch, capsys):
+  getaddrinfo = socket.getaddrinfo
+  def resolve(host, *args, **kwargs):
+    if host != "ajoloeats.test":
+      return getaddrinfo(host, *args, **kwargs)
+    # Nothing listens on the first address
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, server)) for address in ("127.0.0.2", "127.0.0.1")]
+  monkeypatch.setattr(socket, "getaddrinfo", resolve)
+  monkeypatch.setattr(tracing, "SAMPLE_RATE", 1.0)
+
+  @tracing.handler("test")
+  def handler(event, context):
+    return transport.session().get("http://ajoloeats.test:{}/".format(server)).status_code
+
+  assert handler({}, None) == 200
+  # The timing of the request reaches the metrics line
+  record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+  assert record["http_requests"] == 1
+  assert record["http_new_connections"] == 1
+  assert {"Name": "http_requests", "Unit": "Count"} in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]